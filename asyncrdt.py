@@ -0,0 +1,205 @@
+from network import StreamSocket
+from rdt import RDTSocket, RDTProtocol
+from timers import LoopScheduler
+import asyncio
+import queue
+
+
+class AsyncRDTSocket(RDTSocket):
+    '''
+    RDT socket for asyncio code - connect, accept, send, flush, sendall and
+    the recv family are coroutines instead of blocking calls, and a
+    listening socket can be iterated with async for to accept connections.
+
+    Everything else (segmenting, ACKs, retransmission) is the same RDTSocket
+    machinery, run on the event loop by AsyncRDTProtocol. Tasks waiting on a
+    socket park on futures that notify() resolves whenever something they
+    might be waiting for changes.
+    '''
+    __slots__ = ('waiters',)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiters = [] #futures of tasks waiting on this socket
+
+    def new_queue(self):
+        return NotifyQueue(self)
+
+    def notify(self):
+        '''
+        Wakes every task waiting on this socket, so they recheck what they're
+        waiting for. Safe to call from any thread.
+        '''
+        timers = self.proto.timers
+        if not timers.on_loop():
+            timers.loop.call_soon_threadsafe(self.notify)
+            return
+        waiters, self.waiters = self.waiters, []
+        for fut in waiters:
+            if not fut.done():
+                fut.set_result(None)
+
+    async def wait_until(self, predicate, timeout=None):
+        '''
+        Waits until predicate() is true, or timeout seconds have passed, and
+        returns its last value - the asyncio version of Scheduler.wait_for.
+        '''
+        loop = self.proto.timers.loop
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            result = predicate()
+            if result:
+                return result
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return result
+            fut = loop.create_future()
+            self.waiters.append(fut)
+            try:
+                await asyncio.wait_for(fut, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if fut in self.waiters:
+                    self.waiters.remove(fut)
+
+    async def get(self, q, timeout=None):
+        '''
+        Takes an item from one of our queues, waiting for one if it's empty.
+        '''
+        item = []
+        def ready():
+            try:
+                item.append(q.get_nowait())
+            except queue.Empty:
+                return False
+            return True
+        if not await self.wait_until(ready, timeout):
+            raise queue.Empty
+        return item[0]
+
+    #hooks that wake waiting tasks
+    def delivered(self):
+        super().delivered()
+        self.notify()
+
+    def handle_ack(self, ack_num, sack_num=None, rwnd=None, seq=None):
+        super().handle_ack(ack_num, sack_num, rwnd, seq)
+        self.notify()
+
+    def teardown(self):
+        super().teardown()
+        self.notify()
+
+    #coroutine versions of the blocking calls
+    async def accept(self):
+        if self.closed:
+            raise StreamSocket.Closed
+        if(self.state != 'LISTENING'):
+            raise StreamSocket.NotListening
+        return self.accepted(await self.get(self.conn_q))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        '''
+        async for yields (socket, (rhost, rport)) for every new connection.
+        '''
+        return await self.accept()
+
+    async def connect(self, addr):
+        key = self.start_connect(addr)
+        seg_q = self.seg_q
+        while True:
+            synack = await self.get(seg_q)
+            if isinstance(synack, Exception):
+                raise synack
+            if self.our_synack(synack):
+                break
+        self.finish_connect(synack, key)
+
+    async def wait_send(self, predicate):
+        await self.wait_until(lambda: predicate() or self.state == 'CLOSED')
+        if not predicate():
+            raise StreamSocket.Closed
+
+    async def send(self, data):
+        self.write(data)
+        await self.wait_send(self.sndbuf_ok)
+
+    async def flush(self):
+        await self.wait_send(self.flushed)
+
+    async def sendall(self, data):
+        await self.send(data)
+        await self.flush()
+
+    async def recv(self, n=None, timeout=None):
+        return await self.read_when_ready(n, timeout)
+
+    async def recv_exactly(self, n, timeout=None):
+        return await self.read_when_ready(n, timeout, exactly=True)
+
+    async def recv_into(self, buffer, nbytes=0, timeout=None):
+        return await self.read_when_ready(nbytes, timeout, into=buffer)
+
+    async def read_when_ready(self, n, timeout, **kwargs):
+        '''
+        StreamSocket.read, waiting on the loop instead of blocking the thread.
+        '''
+        result = []
+        def ready():
+            try:
+                result.append(self.read(n, 0, **kwargs))
+            except StreamSocket.Timeout:
+                return False
+            return True
+        if not await self.wait_until(ready, timeout):
+            raise StreamSocket.Timeout
+        return result[0]
+
+
+class NotifyQueue(queue.Queue):
+    '''
+    Queue that notifies its socket on every put, so a task waiting in
+    AsyncRDTSocket.get wakes up.
+    '''
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+
+    def _put(self, item):
+        super()._put(item)
+        self.sock.notify()
+
+
+class AsyncRDTProtocol(RDTProtocol):
+    '''
+    RDTProtocol driven by the running asyncio event loop, for
+    AsyncRDTSockets. Its timers are loop callbacks and segments that arrive
+    on other threads (a delayed link, a queued host) are handed over to the
+    loop, so every socket of the protocol lives on the loop's thread and one
+    thread can serve any number of connections.
+
+    Register it with the host from a coroutine running on that loop.
+    '''
+    SOCKET_CLS = AsyncRDTSocket
+
+    def __init__(self, host):
+        if host.net.scheduler.virtual:
+            raise ValueError("AsyncRDTProtocol runs on the event loop's "
+                             "clock, not a virtual one")
+        super().__init__(host)
+        self.timers = LoopScheduler(asyncio.get_running_loop())
+
+    def input(self, raw, rhost):
+        if not self.timers.on_loop():
+            try:
+                self.timers.loop.call_soon_threadsafe(super().input, raw, rhost)
+            except RuntimeError:
+                pass #the loop has been closed, so the segment goes nowhere
+            return
+        super().input(raw, rhost)
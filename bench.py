@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the RDT protocol.
+
+    python bench.py checksum [--segments N] [--per P]
+    python bench.py throughput [--delay D] [--rate R] [--congestion NAME] ...
+    python bench.py memory [--connections N] [--exchange]
+
+checksum: cost of each checksum engine in microseconds per KB of segment,
+  single and batched, and the fraction of corrupted segments each engine
+  fails to detect, both for the corruption Network(per=...) applies and for
+  multi-byte error patterns.
+
+throughput: goodput of one RDT transfer over a link with the given delay,
+  rate and queue, as a fraction of the link rate, and how many data
+  segments were sent per segment of payload.  With --virtual the network
+  runs as a discrete-event simulation and times are simulated seconds.
+
+memory: bytes allocated per open RDT connection, both ends and the
+  protocols' tables included, measured with tracemalloc over N connections
+  on an instant network.  With --exchange every connection also moves a
+  byte each way first, so its send and receive buffers exist.
+"""
+
+import argparse
+import gc
+import random
+import threading
+import time
+import timeit
+import tracemalloc
+
+from congestion import CONTROLLERS
+from network import Network, Host
+from rdt import (CHECKSUMS, IPPROTO_RDT, HDR_SIZE, RDTProtocol, make_segment,
+                 get_checksum, verify_checksum, verify_batch, np)
+
+
+class Collector:
+    """Stands in for a Host, keeping whatever the network delivers"""
+
+    def __init__(self):
+        self.segments = []
+
+    def input(self, proto, data, src):
+        self.segments.append(data)
+
+
+def random_segments(count, size, checksum):
+    rng = random.Random(size)
+    return [make_segment(1234, 80, i, 0, 0, rng.randbytes(size), checksum=checksum)
+            for i in range(count)]
+
+
+def network_errors(segments, per):
+    """Corrupted copies of segments, as delivered by Network(per=per)"""
+    net = Network(per=per)
+    sink = Collector()
+    net.attach(sink, 'dst')
+    for seg in segments:
+        net.tx(IPPROTO_RDT, seg, 'src', 'dst')
+    return [got for got, sent in zip(sink.segments, segments) if got != sent]
+
+
+def swap_errors(segments):
+    """Copies with two differing payload bytes swapped"""
+    out = []
+    for seg in segments:
+        bad = bytearray(seg)
+        i, j = random.sample(range(HDR_SIZE, len(bad)), 2)
+        bad[i], bad[j] = bad[j], bad[i]
+        if bad != seg:
+            out.append(bad)
+    return out
+
+
+def burst_errors(segments, max_len=8):
+    """Copies with a burst of 2 to max_len random bytes in the payload"""
+    out = []
+    for seg in segments:
+        bad = bytearray(seg)
+        n = random.randint(2, max_len)
+        pos = random.randint(HDR_SIZE, len(bad) - n)
+        bad[pos:pos + n] = random.randbytes(n)
+        if bad != seg:
+            out.append(bad)
+    return out
+
+
+def bench_checksum(args):
+    print('checksum cost (us per KB, %d byte segments)' % args.size)
+    print('%-8s %10s %10s' % ('engine', 'single', 'batch'))
+    for name, engine in CHECKSUMS.items():
+        segs = random_segments(args.segments, args.size, engine)
+        kb = args.segments * len(segs[0]) / 1024
+        single = min(timeit.repeat(lambda: [get_checksum(s, engine) for s in segs],
+                                   number=1, repeat=5))
+        if engine.batch is not None and np is not None:
+            batch = min(timeit.repeat(lambda: verify_batch(segs, engine),
+                                      number=1, repeat=5))
+            batch = '%10.3f' % (batch / kb * 1e6)
+        else:
+            batch = '%10s' % '-'
+        print('%-8s %10.3f %s' % (name, single / kb * 1e6, batch))
+
+    print()
+    print('undetected errors (fraction of corrupted segments that verify)')
+    print('%-8s %12s %12s %12s' % ('engine', 'network', 'swap', 'burst'))
+    for name, engine in CHECKSUMS.items():
+        segs = random_segments(args.segments, args.size, engine)
+        rates = []
+        for corrupted in (network_errors(segs, args.per), swap_errors(segs), burst_errors(segs)):
+            missed = sum(verify_checksum(seg, engine) for seg in corrupted)
+            rates.append('%12.5f' % (missed / len(corrupted)) if corrupted else '%12s' % '-')
+        print('%-8s %s' % (name, ' '.join(rates)))
+
+
+def bench_throughput(args):
+    class Proto(RDTProtocol):
+        ARQ = args.arq
+        WINDOW = args.window
+        SEND_BUFFER = 2 ** 20
+        RECV_BUFFER = args.rcvbuf
+        CONGESTION = args.congestion
+        RTO_INITIAL = max(RDTProtocol.RTO_INITIAL, 4 * (args.delay + args.jitter))
+
+    net = Network(loss=args.loss, delay=args.delay, jitter=args.jitter,
+                  rate=args.rate, queue=args.queue, reorder=args.reorder,
+                  virtual=args.virtual)
+    clock = net.scheduler.now
+    client, server = Host(net, '10.0.0.1'), Host(net, '10.0.0.2')
+    for host in client, server:
+        host.register_protocol(Proto)
+    ls = server.socket(IPPROTO_RDT)
+    ls.bind(8000)
+    ls.listen()
+    cs = client.socket(IPPROTO_RDT)
+    connector = threading.Thread(target=cs.connect, args=(('10.0.0.2', 8000),))
+    connector.start()
+    ss, _ = ls.accept()
+    connector.join()
+
+    # count data segments leaving the client, retransmissions included
+    sent = 0
+    tx = net.tx
+    def count(proto, data, src, dst):
+        nonlocal sent
+        if src == '10.0.0.1' and len(data) > HDR_SIZE:
+            sent += 1
+        return tx(proto, data, src, dst)
+    net.tx = count
+
+    data = random.randbytes(args.bytes)
+    start, real = clock(), time.monotonic()
+    sender = threading.Thread(target=cs.sendall, args=(data,))
+    sender.start()
+    got = 0
+    while got < len(data):
+        got += len(ss.recv())
+    elapsed = clock() - start
+    real = time.monotonic() - real
+    sender.join()
+
+    segments = -(-len(data) // cs.send_mss)
+    rtt = 2 * args.delay
+    print('link: %.0f bytes/s, %.1f ms RTT, BDP %.0f bytes, queue %s'
+          % (args.rate, rtt * 1e3, args.rate * rtt, args.queue))
+    print('%s window %d, congestion %s'
+          % (args.arq, args.window, args.congestion))
+    print('%d bytes in %.3f s: %.0f bytes/s, %.1f%% of the link'
+          % (len(data), elapsed, len(data) / elapsed,
+             100 * len(data) / elapsed / args.rate))
+    print('%d data segments sent for %d segments of payload (%.3fx)'
+          % (sent, segments, sent / segments))
+    if args.virtual:
+        print('simulated in %.3f s of real time' % real)
+
+
+def bench_memory(args):
+    net = Network()
+    server = Host(net, '10.0.0.1')
+    server.register_protocol(RDTProtocol)
+    ls = server.socket(IPPROTO_RDT)
+    ls.bind(8000)
+    ls.listen()
+    # an instant network completes each handshake inline, so connect
+    # returns with the child already waiting in the accept queue
+    lo, hi = RDTProtocol.EPHEMERAL_PORTS
+    per_host = hi - lo + 1
+    clients = []
+    conns = []
+
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    for i in range(args.connections):
+        if i % per_host == 0:
+            n = len(clients) + 1
+            clients.append(Host(net, '10.1.%d.%d' % (n >> 8, n & 0xff)))
+            clients[-1].register_protocol(RDTProtocol)
+        cs = clients[-1].socket(IPPROTO_RDT)
+        cs.connect(('10.0.0.1', 8000))
+        ss, _ = ls.accept()
+        if args.exchange:
+            cs.send(b'x')
+            ss.recv(1)
+            ss.send(b'y')
+            cs.recv(1)
+        conns.append((cs, ss))
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    per_conn = used / args.connections
+    print('%d connections%s: %.0f bytes each (%.0f per socket)'
+          % (args.connections, ' after an exchange' if args.exchange else '',
+             per_conn, per_conn / 2))
+    print('100000 connections: %.1f MiB' % (per_conn * 100000 / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='bench', required=True)
+    p = sub.add_parser('checksum', help='checksum engine cost and error detection')
+    p.add_argument('--segments', type=int, default=20000)
+    p.add_argument('--size', type=int, default=1400, help='payload bytes per segment')
+    p.add_argument('--per', type=float, default=1.0, help='Network corruption probability')
+    p.set_defaults(func=bench_checksum)
+    p = sub.add_parser('throughput', help='RDT goodput over a delayed, rate limited link')
+    p.add_argument('--bytes', type=int, default=2 ** 22)
+    p.add_argument('--delay', type=float, default=0.01, help='one-way delay in seconds')
+    p.add_argument('--jitter', type=float, default=0.0)
+    p.add_argument('--rate', type=float, default=1e7, help='link rate in bytes/s')
+    p.add_argument('--queue', type=int, default=100, help='segments the link holds')
+    p.add_argument('--reorder', type=float, default=0.0)
+    p.add_argument('--loss', type=float, default=0.0)
+    p.add_argument('--arq', choices=('gbn', 'sr'), default='sr')
+    p.add_argument('--window', type=int, default=256)
+    p.add_argument('--rcvbuf', type=int, default=2 ** 20)
+    p.add_argument('--congestion', choices=sorted(CONTROLLERS))
+    p.add_argument('--virtual', action='store_true', help='simulate on a virtual clock')
+    p.set_defaults(func=bench_throughput)
+    p = sub.add_parser('memory', help='memory held per open RDT connection')
+    p.add_argument('--connections', type=int, default=10000)
+    p.add_argument('--exchange', action='store_true', help='move a byte each way first')
+    p.set_defaults(func=bench_memory)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import collections
+import math
+
+INITIAL_WINDOW = 4  # segments
+
+
+class CongestionControl:
+    """
+    Base class for per-connection congestion controllers
+
+    The sending socket reports every ACK that moves its send window with
+    on_ack, and every retransmission timeout with on_loss (at most once per
+    window of data), and never has more than cwnd payload bytes unacked at
+    once.  Windows are in bytes; mss is the connection's send MSS.
+
+    This base class never changes cwnd; subclasses implement an algorithm.
+    """
+
+    def __init__(self, mss, now):
+        self.mss = mss
+        self.cwnd = INITIAL_WINDOW * mss
+        self.ssthresh = math.inf
+
+    def on_ack(self, acked, rtt, now):
+        """acked payload bytes were newly acked; rtt is the sample they gave, or None"""
+
+    def on_loss(self, now):
+        """A segment's retransmission timer expired"""
+
+    def slow_start(self, acked):
+        """Grows cwnd by the bytes acked, up to ssthresh; returns the bytes left over"""
+        if self.cwnd >= self.ssthresh:
+            return acked
+        grow = min(acked, self.ssthresh - self.cwnd)
+        self.cwnd += grow
+        return acked - grow
+
+
+class Reno(CongestionControl):
+    """
+    Slow start and AIMD congestion avoidance (RFC 5681)
+
+    cwnd doubles every round trip up to ssthresh, then grows by one MSS per
+    round trip.  A timeout halves ssthresh and restarts from one segment.
+    """
+
+    def on_ack(self, acked, rtt, now):
+        acked = self.slow_start(acked)
+        if acked:
+            self.cwnd += self.mss * acked / self.cwnd
+
+    def on_loss(self, now):
+        self.ssthresh = max(self.cwnd / 2, 2 * self.mss)
+        self.cwnd = self.mss
+
+
+class Cubic(CongestionControl):
+    """
+    CUBIC congestion avoidance (RFC 9438)
+
+    After a loss cwnd follows a cubic function of the time since the loss,
+    flattening out around the window where the loss happened (w_max) before
+    probing beyond it.  It never grows slower than Reno would.  Windows in
+    the cubic function are in segments, as in the RFC.
+    """
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, mss, now):
+        super().__init__(mss, now)
+        self.w_max = 0.0      # window before the last loss, in segments
+        self.epoch = None     # when the current avoidance phase started
+        self.k = 0.0          # seconds from epoch until the cubic reaches w_max
+        self.origin = 0.0     # window the cubic plateaus at, in segments
+        self.w_est = 0.0      # what Reno would have by now, in segments
+        self.rtt = 0.0        # latest RTT sample
+
+    def on_ack(self, acked, rtt, now):
+        if rtt is not None:
+            self.rtt = rtt
+        acked = self.slow_start(acked)
+        if not acked:
+            return
+        segs = self.cwnd / self.mss
+        if self.epoch is None:
+            self.epoch = now
+            if segs < self.w_max:
+                self.k = ((self.w_max - segs) / self.C) ** (1 / 3)
+                self.origin = self.w_max
+            else:
+                self.k = 0.0
+                self.origin = segs
+            self.w_est = segs
+        t = now - self.epoch + self.rtt
+        target = self.origin + self.C * (t - self.k) ** 3
+        target = min(max(target, segs), 1.5 * segs)
+        # Reno-friendly region, alpha segments per round trip
+        alpha = 3 * (1 - self.BETA) / (1 + self.BETA)
+        self.w_est += alpha * acked / self.cwnd
+        target = max(target, self.w_est)
+        self.cwnd += (target - segs) / segs * acked
+
+    def on_loss(self, now):
+        segs = self.cwnd / self.mss
+        # fast convergence: give way to newer flows if we're shrinking
+        if segs < self.w_max:
+            self.w_max = segs * (1 + self.BETA) / 2
+        else:
+            self.w_max = segs
+        self.ssthresh = max(self.cwnd * self.BETA, 2 * self.mss)
+        self.cwnd = self.mss
+        self.epoch = None
+
+
+class BBR(CongestionControl):
+    """
+    Delay-based controller modelled on BBR
+
+    Rather than react to loss, it measures the bottleneck bandwidth (the
+    best delivery rate over the last BW_ROUNDS round trips) and the minimum
+    RTT, and keeps cwnd at CWND_GAIN times their product.  It starts out
+    doubling cwnd every round trip until the bandwidth stops growing by 25%
+    for three rounds in a row.  There is no pacing; cwnd is the only limit.
+    """
+    CWND_GAIN = 2
+    BW_ROUNDS = 10
+    MIN_RTT_WINDOW = 10.0  # seconds before a min RTT sample expires
+    MIN_CWND = 4           # segments
+
+    def __init__(self, mss, now):
+        super().__init__(mss, now)
+        self.min_rtt = None
+        self.min_rtt_at = now
+        self.bw_samples = collections.deque(maxlen=self.BW_ROUNDS)
+        self.round_start = now
+        self.round_bytes = 0
+        self.full_bw = 0.0
+        self.full_bw_rounds = 0
+        self.filled = False   # startup found the bottleneck
+
+    @property
+    def bw(self):
+        """Estimated bottleneck bandwidth in bytes per second"""
+        return max(self.bw_samples, default=0.0)
+
+    def bdp_window(self):
+        """CWND_GAIN times the bandwidth-delay product, in bytes"""
+        return max(self.CWND_GAIN * self.bw * (self.min_rtt or 0), self.MIN_CWND * self.mss)
+
+    def on_ack(self, acked, rtt, now):
+        if rtt is not None and (self.min_rtt is None or rtt <= self.min_rtt
+                                or now - self.min_rtt_at > self.MIN_RTT_WINDOW):
+            self.min_rtt = rtt
+            self.min_rtt_at = now
+        self.round_bytes += acked
+        elapsed = now - self.round_start
+        if self.min_rtt is not None and elapsed >= self.min_rtt and elapsed > 0:
+            self.bw_samples.append(self.round_bytes / elapsed)
+            self.round_start = now
+            self.round_bytes = 0
+            self.check_full_pipe()
+        if self.filled:
+            self.cwnd = self.bdp_window()
+        else:
+            self.cwnd += acked
+
+    def check_full_pipe(self):
+        if self.bw >= self.full_bw * 1.25:
+            self.full_bw = self.bw
+            self.full_bw_rounds = 0
+        else:
+            self.full_bw_rounds += 1
+            self.filled = self.filled or self.full_bw_rounds >= 3
+
+    def on_loss(self, now):
+        # random loss says nothing about the bottleneck, but a timeout during
+        # startup means we've overshot it
+        if not self.filled:
+            self.filled = True
+            self.cwnd = self.bdp_window() if self.bw_samples else max(self.cwnd / 2, self.MIN_CWND * self.mss)
+
+
+CONTROLLERS = {
+    'reno': Reno,
+    'cubic': Cubic,
+    'bbr': BBR,
+}
@@ -20,3 +20,14 @@ class ExThread(threading.Thread):
     def join(self, *args, **kwargs):
         super().join(*args, **kwargs)
         assert not self._exc, 'failure in subthread'
+
+
+def wait_for(scheduler, predicate, cond=None, timeout=10):
+    # waits through the network's scheduler, so virtual clocks keep running;
+    # cond, if given, is notified whenever predicate may have become true
+    if cond is None:
+        ok = scheduler.wait_for(predicate, timeout=timeout)
+    else:
+        with cond:
+            ok = scheduler.wait_for(predicate, cond, timeout)
+    assert ok, 'timed out waiting'
@@ -2,7 +2,12 @@ import sys
 import os
 import random
 import threading
-from queue import Queue
+import time
+import traceback
+from collections import deque
+from queue import Queue, Empty, Full
+
+from timers import Scheduler, VirtualClock
 
 
 def _trialgen(prob):
@@ -21,8 +26,63 @@ def _hexdump(data):
     print('%08x' % (len(data),), file=sys.stderr)
 
 
+class Link:
+    """
+    Delivery model for traffic from one host to another
+
+    delay is the one-way propagation delay in seconds, and jitter the most it
+    varies by either way, uniformly, so jitter alone can reorder segments.
+    rate is the serialization rate in bytes/s: segments queue up behind each
+    other and each takes len/rate seconds to leave.  queue bounds the number
+    of segments in flight on the link (queued or propagating), and segments
+    sent while it is full are dropped.  reorder is the probability that a
+    segment skips the propagation delay and overtakes those ahead of it, as
+    netem's reordering does.  rate and queue are unlimited when None.
+
+    A link with no delay, jitter, rate or reordering is instant, and the
+    network delivers over it inline on the sending thread.
+    """
+
+    def __init__(self, delay=0.0, jitter=0.0, rate=None, queue=None, reorder=0.0):
+        self.delay = delay
+        self.jitter = jitter
+        self.rate = rate
+        self.queue = queue
+        self.reorder = reorder
+        self.busy = 0.0      # when the last queued segment finishes serializing
+        self.inflight = 0    # segments sent but not yet delivered
+        self.lock = threading.Lock()
+
+    @property
+    def instant(self):
+        return not (self.delay or self.jitter or self.rate or self.reorder)
+
+    def schedule(self, size, now):
+        """
+        Puts a segment of size bytes on the link at time now
+
+        Returns when it arrives, or None if the queue is full.
+        """
+        with self.lock:
+            if self.queue is not None and self.inflight >= self.queue:
+                return None
+            when = now
+            if self.rate:
+                when = self.busy = max(now, self.busy) + size / self.rate
+            if not (self.reorder and random.random() < self.reorder):
+                when += max(self.delay + random.uniform(-self.jitter, self.jitter), 0.0)
+            self.inflight += 1
+            return when
+
+    def delivered(self):
+        """Takes an arrived segment off the link"""
+        with self.lock:
+            self.inflight -= 1
+
+
 class Network:
-    def __init__(self, loss=0.0, per=0.0, debug=None):
+    def __init__(self, loss=0.0, per=0.0, debug=None, delay=0.0, jitter=0.0,
+                 rate=None, queue=None, reorder=0.0, virtual=False):
         if debug is None:
             debug = 'NET_DEBUG' in os.environ
         if not hasattr(loss, '__next__'):
@@ -33,6 +93,16 @@ class Network:
         self.loss = loss
         self.per = per
         self.debug = debug
+        # Generators can't be advanced from two threads at once
+        self.trials = threading.Lock()
+        # Every pair of hosts starts out with these link parameters
+        self.link_params = dict(delay=delay, jitter=jitter, rate=rate,
+                                queue=queue, reorder=reorder)
+        self.links = {}
+        # Delivers segments over links that aren't instant.  A virtual
+        # network runs it on a VirtualClock as a discrete-event simulation,
+        # and protocols share it for their own timers
+        self.scheduler = Scheduler(VirtualClock() if virtual else time.monotonic)
 
     def attach(self, host, ip):
         if ip in self.hosts:
@@ -40,25 +110,65 @@ class Network:
                              .format(ip))
         self.hosts[ip] = host
 
+    def link(self, a, b, symmetric=True, **params):
+        """
+        Sets the link parameters (see Link) from host a to host b, and from b
+        to a as well if symmetric
+
+        Parameters not given keep the network-wide defaults.  Returns the
+        Link from a to b.
+        """
+        params = dict(self.link_params, **params)
+        self.links[a, b] = Link(**params)
+        if symmetric:
+            self.links[b, a] = Link(**params)
+        return self.links[a, b]
+
+    def get_link(self, src, dst):
+        """Returns the Link from src to dst, creating it with the defaults"""
+        link = self.links.get((src, dst))
+        if link is None:
+            link = self.links.setdefault((src, dst), Link(**self.link_params))
+        return link
+
     def tx(self, proto, data, src, dst):
-        # Ensure all transmitted data is encoded to bytes
-        if not isinstance(data, bytes):
+        # Ensure all transmitted data is encoded to bytes.  Other bytes-like
+        # objects are passed through as-is so senders don't have to copy
+        if not isinstance(data, (bytes, bytearray, memoryview)):
             raise TypeError("Network can only send bytes, not {}"
                             .format(type(data).__name__))
-        # TODO: add delay and reordering
-        lose = next(self.loss)
+        with self.trials:
+            lose = next(self.loss)
+            corrupt = not lose and dst in self.hosts and next(self.per)
+        link = self.get_link(src, dst)
+        when = None
+        if not lose and dst in self.hosts and not link.instant:
+            when = link.schedule(len(data), self.scheduler.now())
+            lose = when is None
         if self.debug:
             print('%s -> %s%s' % (src, dst, ' (LOST!)' if lose else ''),
                   file=sys.stderr)
             _hexdump(data)
         if not lose and dst in self.hosts:
-            if next(self.per):
+            if corrupt:
                 pos = random.randint(0, len(data) - 1)
                 byte = random.randint(0, 255)
-                data = data[:pos] + bytes((byte,)) + data[pos+1:]
-            self.hosts[dst].input(proto, data, src)
+                # Corrupt a copy; the sender may still hold the original
+                data = bytearray(data)
+                data[pos] = byte
+                data = bytes(data)
+            if when is None:
+                self.hosts[dst].input(proto, data, src)
+            else:
+                self.scheduler.call_at(when, self.deliver, link,
+                                       self.hosts[dst], proto, data, src)
         return len(data)
 
+    def deliver(self, link, host, proto, data, src):
+        """Hands a segment that has crossed a link to the destination host"""
+        link.delivered()
+        host.input(proto, data, src)
+
 
 # Handles:
 #  - net_address
@@ -67,10 +177,35 @@ class Network:
 #  - udt_sendto(proto, dst, seg)
 #  - udt_rcv(proto, src, seg)
 class Host:
-    def __init__(self, net, ip):
+    # Seconds the receive worker waits without segments before it exits
+    IDLE = 1.0
+
+    def __init__(self, net, ip, queued=False, backlog=0):
+        """
+        Attaches a new host to the network at address ip
+
+        By default segments from the network are processed on whichever
+        thread sent them.  A queued host puts them on an inbound queue
+        instead, so sends return at once, and its own receive worker thread
+        processes them in order.  The worker exits once it has had nothing
+        to do for IDLE seconds and the next segment starts a new one.  If
+        backlog is nonzero, segments that arrive while that many are
+        waiting are dropped.
+        """
         self.net = net
         self.ip = ip
         self.protos = {}
+        # Segments waiting for the receive worker, or None to process them
+        # inline
+        self.inbound = None
+        self.dropped = 0  # segments lost to a full inbound queue
+        if queued:
+            if net.scheduler.virtual:
+                raise ValueError("A virtual network has no threads to "
+                                 "drain a queued host")
+            self.inbound = Queue(backlog)
+        self.worker = None
+        self.worker_lock = threading.Lock()
         self.net.attach(self, ip)
         self.test_sock = None
 
@@ -90,8 +225,40 @@ class Host:
         self.net.tx(proto, data, self.ip, dst)
 
     def input(self, proto, data, src):
+        if self.inbound is None:
+            self.receive(proto, data, src)
+            return
+        try:
+            self.inbound.put_nowait((proto, data, src))
+        except Full:
+            self.dropped += 1
+            return
+        with self.worker_lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.receive_worker,
+                                               name='rx ' + self.ip, daemon=True)
+                self.worker.start()
+
+    def receive(self, proto, data, src):
+        """Passes a segment from the network up to its protocol"""
         self.protos[proto].input(data, src)
 
+    def receive_worker(self):
+        while True:
+            try:
+                proto, data, src = self.inbound.get(timeout=self.IDLE)
+            except Empty:
+                # input starts a new worker for anything queued after this
+                with self.worker_lock:
+                    if self.inbound.empty():
+                        self.worker = None
+                        return
+                continue
+            try:
+                self.receive(proto, data, src)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
 
 class Socket:
     """Base class for sockets associated with a particular protocol"""
@@ -102,6 +269,10 @@ class Socket:
         bound
         """
 
+    # Sockets are slotted so a host can hold many of them; subclasses that
+    # don't declare __slots__ get an instance __dict__ as usual
+    __slots__ = ('proto', '__weakref__')
+
     def __init__(self, proto):
         """Initializes a new socket, associating it with a Protocol instance"""
         self.proto = proto
@@ -202,13 +373,56 @@ class StreamSocket(Socket):
         already connected
         """
 
+    class Timeout(Exception):
+        """
+        Exception raised when a blocking receive times out before enough data
+        has been delivered
+        """
+
+    class EndOfStream(Exception):
+        """
+        Exception raised when the peer closes the stream before enough data
+        has been delivered
+        """
+
+    class WouldBlock(Exception):
+        """
+        Exception raised when a call on a nonblocking socket cannot complete
+        without waiting
+        """
+
+    class Closed(Exception):
+        """
+        Exception raised when attempting to bind, listen or connect using a
+        stream socket that has been closed
+        """
+
+    __slots__ = ('chunks', 'chunkofs', 'buffered', 'datamut', 'dataready',
+                 'eof', 'scheduler', 'blocking')
+
     # Constructor - subclasses should call using super() as seen here
     def __init__(self, *args, **kwargs):
         """Initializes a new stream socket"""
 
         super().__init__(*args, **kwargs)
-        self.data = b''
+        # Delivered data is kept as a queue of chunks rather than one bytes
+        # object, so delivering and consuming never copy the unread backlog.
+        # While nothing is buffered it's an empty tuple, so idle sockets
+        # don't carry a deque
+        self.chunks = ()
+        self.chunkofs = 0  # bytes of chunks[0] already consumed
+        self.buffered = 0  # unread bytes across all chunks
         self.datamut = threading.Lock()
+        # Condition on datamut that deliver() signals so blocked readers wake
+        # up, made by the first reader that has to wait
+        self.dataready = None
+        self.eof = False  # the peer has closed its end of the stream
+        # Scheduler that blocking reads wait through, so they keep a virtual
+        # network's timers running; None waits on dataready alone
+        self.scheduler = None
+        # Whether calls wait, or raise StreamSocket.WouldBlock; see
+        # setblocking()
+        self.blocking = True
 
     # Provided methods (you should not override these)
     def deliver(self, data):
@@ -219,25 +433,174 @@ class StreamSocket(Socket):
         retrieve it later.
         """
 
+        if not data:
+            return
+        with self.datamut:
+            if not self.chunks:
+                self.chunks = deque()
+            self.chunks.append(data)
+            self.buffered += len(data)
+            if self.dataready is not None:
+                self.dataready.notify_all()
+        self.delivered()
+
+    def deliver_eof(self):
+        """
+        Marks the end of the stream, after all data delivered so far
+
+        Once the application has read that data, receives return b'' (or 0)
+        instead of blocking.
+        """
+
         with self.datamut:
-            self.data += data
+            self.eof = True
+            if self.dataready is not None:
+                self.dataready.notify_all()
+        self.delivered()
 
-    def recv(self, n=None):
+    def recv(self, n=None, timeout=None):
         """
         Retrieves data from the stream buffer
 
         Returns n bytes or all currently buffered data, whichever is smaller.
 
-        TODO: If buffer is empty, the method should block until more data is
-        delivered.
+        If the buffer is empty, the method blocks until more data is
+        delivered.  If timeout (in seconds) is given and expires first, it
+        raises StreamSocket.Timeout.  At the end of the stream it returns
+        b''.
+        """
+
+        return self.read(n, timeout)
+
+    def recv_exactly(self, n, timeout=None):
+        """
+        Retrieves exactly n bytes from the stream buffer
+
+        Blocks until n bytes have been delivered.  If timeout (in seconds) is
+        given and expires first, it raises StreamSocket.Timeout and leaves
+        the buffered data in place.  If the stream ends first, it raises
+        StreamSocket.EndOfStream, also leaving the data in place.
+        """
+
+        return self.read(n, timeout, exactly=True)
+
+    def recv_into(self, buffer, nbytes=0, timeout=None):
+        """
+        Receives data directly into a writable bytes-like object
+
+        Copies up to nbytes bytes (or len(buffer) if nbytes is 0) into buffer
+        and returns the number of bytes copied.  Blocks, times out and ends
+        like recv().
+        """
+
+        return self.read(nbytes, timeout, into=buffer)
+
+    def read(self, n=None, timeout=None, exactly=False, into=None):
         """
+        Takes data out of the stream buffer for the recv family
 
+        Waits like recv(), or recv_exactly() if exactly is set; a timeout of
+        0 never waits.  With into, the data is copied into that buffer and
+        the count returned.  consumed() is called once the data is out.
+        """
+
+        if into is not None:
+            into = memoryview(into).cast('B')
+            if not n or n > len(into):
+                n = len(into)
+        if n == 0:
+            return b'' if into is None else 0
+        if exactly:
+            ready = lambda: self.buffered >= n or self.eof
+        else:
+            ready = lambda: self.buffered or self.eof
         with self.datamut:
-            if n is None:
-                n = len(self.data)
-            data, self.data = self.data[:n], self.data[n:]
+            if not self._wait(ready, timeout):
+                raise StreamSocket.Timeout
+            if exactly and self.buffered < n:
+                raise StreamSocket.EndOfStream
+            if n is None or n > self.buffered:
+                n = self.buffered
+            pieces = self._take(n)
+            if into is None:
+                data = b''.join(pieces)
+            else:
+                data = 0
+                for piece in pieces:
+                    into[data:data + len(piece)] = piece
+                    data += len(piece)
+        self.consumed(n)
         return data
 
+    def setblocking(self, flag):
+        """
+        Puts the socket in blocking (the default) or nonblocking mode
+
+        In nonblocking mode, receives that would have to wait for data raise
+        StreamSocket.WouldBlock instead.
+        """
+
+        self.blocking = bool(flag)
+
+    def _wait(self, predicate, timeout):
+        """Waits on dataready until predicate is true (caller holds datamut)"""
+
+        if predicate():
+            return True
+        if not self.blocking:
+            raise StreamSocket.WouldBlock
+        if timeout == 0:
+            return False
+        if self.dataready is None:
+            self.dataready = threading.Condition(self.datamut)
+        if self.scheduler is None:
+            return self.dataready.wait_for(predicate, timeout)
+        return self.scheduler.wait_for(predicate, self.dataready, timeout)
+
+    def _take(self, n):
+        """
+        Removes n buffered bytes (caller holds datamut and checks n is
+        available) and returns them as a list of bytes-like pieces
+        """
+
+        pieces = []
+        self.buffered -= n
+        while n:
+            chunk = self.chunks[0]
+            avail = len(chunk) - self.chunkofs
+            if avail <= n:
+                pieces.append(memoryview(chunk)[self.chunkofs:] if self.chunkofs else chunk)
+                self.chunks.popleft()
+                self.chunkofs = 0
+                n -= avail
+                if not self.chunks:
+                    self.chunks = ()
+            else:
+                pieces.append(memoryview(chunk)[self.chunkofs:self.chunkofs + n])
+                self.chunkofs += n
+                n = 0
+        return pieces
+
+    # Hooks, which subclasses may override
+    def delivered(self):
+        """
+        Called after deliver() has buffered data or deliver_eof() has marked
+        the end of the stream
+
+        It runs without datamut held, so a protocol can use it to wake
+        whatever waits on the socket other than a blocked recv.  The default
+        does nothing.
+        """
+
+    def consumed(self, n):
+        """
+        Called after the application has read n bytes out of the stream buffer
+
+        It runs on the reading thread without datamut held, so a protocol can
+        use it to tell the peer that buffer space has been freed.  The default
+        does nothing.
+        """
+
     # Abstract methods, to be overridden in subclasses
     def connect(self, addr):
         """
@@ -319,8 +682,11 @@ class Protocol:
 
     def output(self, seg, dst):
         """
-        Passes a segment (bytes) to the network layer for transmission to the
-        given destination host.
+        Passes a segment (bytes or another bytes-like object) to the network
+        layer for transmission to the given destination host.
+
+        The object is handed to the receiver without copying, so it must not
+        be modified afterwards.
         """
         self.host.output(self.getid(), seg, dst)
 
@@ -1,68 +1,172 @@
 from network import Protocol, StreamSocket
+from timers import Scheduler
+from congestion import CONTROLLERS
 import threading
+import collections
 import queue
 import struct
 import sys
 import os
 import random
+import math
+import hashlib
+import zlib
+try:
+    import numpy as np
+except ImportError:
+    np = None #verify_batch falls back to checking segments one by one
 
 # Reserved protocol number for experiments; see RFC 3692
 IPPROTO_RDT = 0xfe
 Q_SIZE = 10
-PRECHK_HDR_FRMT = '!HHIIBH'
-HDR_FRMT = '!HHIIBHB'
-HDR_SIZE = struct.calcsize(HDR_FRMT)
+#sport, dport, seq, ack, flags, data_len, pad, rwnd, checksum
+HDR_FRMT = '!HHIIBHxII'
+HDR = struct.Struct(HDR_FRMT)
+HDR_SIZE = HDR.size
+CHECKSUM_OFS = HDR_SIZE - 4 #checksum is the last 4 header bytes, 4-byte aligned
+CHECKSUM_FRMT = '!I'
+#SYN/SYNACK payload: the MSS the sender is willing to receive and the
+#id of the checksum engine it proposes (SYN) or picked (SYNACK)
+SYN_OPTS_FRMT = '!HB'
+#data_len is 16 bits
+MAX_MSS = 0xFFFF
+#rwnd is 32 bits, in bytes
+MAX_RWND = 0xFFFFFFFF
+
+#header flags
+ACK = 1
+SYN = 1 << 1
+FIN = 1 << 2
+SACK = 1 << 3 #selective ACK, seq field holds the segment being acked
+
+#sequence numbers are 32 bits and wrap around
+SEQ_MOD = 1 << 32
+
+#SYN cookies carry the peer's MSS rounded down to one of these, and are
+#good for one to two COOKIE_SLOTs of seconds
+COOKIE_MSS = (1, 256, 536, 1024, 1400, 1460, 8192, MAX_MSS)
+COOKIE_SLOT = 64
+
+#poll events, see RDTProtocol.poll
+POLLIN = 1 #data to recv, or a connection to accept
+POLLOUT = 4 #send won't block
+POLLERR = 8 #not connected or listening, always reported
 
 class RDTSocket(StreamSocket):
+    #the socket is the connection's control block - slotted, with queues,
+    #conditions and buffers made only once something needs them, so a host
+    #can hold a large number of mostly idle connections
+    __slots__ = ('state', 'closed', 'port', 'remote_addr', 'parent', 'lock', 'seg_q', 'conn_q',
+                 'half_open', 'arq', 'window', 'mss', 'send_mss', 'checksum', 'isn',
+                 'send_base', 'next_seq', 'unacked', 'unacked_bytes', 'sndbuf', 'unsent',
+                 'transmitting', 'congestion', 'cc', 'recover', 'snd_wnd', 'snd_wl1', 'snd_wl2',
+                 'persist_timer',
+                 'persist_backoffs', 'send_cond', 'retx_timer', 'rtt', 'timed', 'hs_sent',
+                 'hs_timer', 'hs_seg', 'fin_seq', 'close_timer', 'rcv_next', 'reorder',
+                 'rcvbuf', 'rcv_adv', 'ack_every', 'ack_delay', 'ack_now', 'ack_pending',
+                 'ack_timer', 'fin_rcvd')
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Other initialization here
-        
-        self.state = 'CLOSED' # Can be CLOSED, CONNECTING, CONNECTED, LISTENING
+
+        # Can be CLOSED, BOUND, CONNECTING, CONNECTED, LISTENING, or after
+        # close() FIN_WAIT (we closed first), LAST_ACK (the peer did) and
+        # TIME_WAIT - see close
+        self.state = 'CLOSED'
+        self.closed = False #close() was called, the socket can't be used again
 
         self.port = None
-        self.remote_addr = None #tuple (ip, port) 
+        self.remote_addr = None #tuple (ip, port)
         self.parent: RDTSocket = None #listening socket
         self.lock = threading.Lock()
-        self.seg_q = queue.Queue() #TODO - change to seg_q
-        self.conn_q = queue.Queue() #stores (socket, addr, port) items 
+        self.seg_q = None #handshake segments waiting on connect, while connecting
+        self.conn_q = None #stores (socket, addr, port) items, once listening
+        self.half_open = 0 #children in connecting_socks, see half_open_add
 
-        #packet drop info
-        self.seq_num = 0
-        self.last_recieved_num = 0
+        #sender side - sliding window
+        self.arq = self.proto.ARQ #'gbn' or 'sr'
+        self.window = self.proto.WINDOW #max unacked segments in flight
+        self.mss = self.proto.MSS #largest payload we accept, advertised in the SYN
+        self.send_mss = self.mss #largest payload we send, min of both sides' MSS
+        self.checksum = CHECKSUMS[self.proto.CHECKSUM] #engine proposed in the SYN, then the negotiated one
+        self.isn = 0 #initial sequence number
+        self.send_base = 0 #oldest unacked seq num
+        self.next_seq = 0 #seq num of the next new segment
+        self.unacked = () #TxSegment items, oldest first - a deque while there are any
+        self.unacked_bytes = 0 #payload bytes in self.unacked
+        self.sndbuf = self.proto.SEND_BUFFER #bytes send() may leave unacked before blocking
+        self.unsent = bytearray() #data accepted by send() but not segmented yet
+        self.transmitting = False #a thread is already inside transmit()
+        self.congestion = self.proto.CONGESTION #congestion controller name, see CONTROLLERS
+        self.cc = None #the connection's controller, created once the handshake sets send_mss
+        self.recover = None #next_seq when the last loss was reported to self.cc
+        self.snd_wnd = 0 #bytes past send_base the peer has room for, from its last ACK
+        self.snd_wl1 = 0 #seq and ack of the segment snd_wnd came from, so an older
+        self.snd_wl2 = 0 #one (a retransmission, say) can't put back a stale window
+        self.persist_timer = None #zero window probe timer
+        self.persist_backoffs = 0 #probes sent without the window opening
+        self.send_cond = None #signalled when the window moves, see wait_send
+        self.retx_timer = None #protocol timer for the send window
+        self.rtt = RTTEstimator(self.proto.RTO_INITIAL, self.proto.RTO_MIN, self.proto.RTO_MAX)
+        self.timed = None #(seq, send time) of the one segment being timed
+        self.hs_sent = None #when our SYN/SYNACK went out, None once resent (Karn)
+        self.hs_timer = None #SYN/SYNACK resend timer
+        self.hs_seg = None #a child's SYNACK, resent for a resent SYN
+        self.fin_seq = None #seq of our FIN, once close() has sent it
+        self.close_timer = None #TIME_WAIT timer
 
-        self.ack_event = threading.Event()
+        #receiver side
+        self.rcv_next = 0 #next in-order seq num expected from the peer
+        self.reorder = {} #seq -> payload for out-of-order segments (sr only)
+        self.rcvbuf = self.proto.RECV_BUFFER #most unread bytes we'll hold for the app
+        self.rcv_adv = 0 #receive window in the last segment we sent
+        self.ack_every = self.proto.ACK_EVERY #ACK every this many in-order segments
+        self.ack_delay = self.proto.ACK_DELAY #longest an in-order segment waits for its ACK
+        self.ack_now = self.proto.ACK_NOW #events that flush the ACK right away
+        self.ack_pending = 0 #segments received since our last ACK
+        self.ack_timer = None #delayed ACK timer
+        self.fin_rcvd = None #seq of the peer's FIN, once it's arrived
+        self.scheduler = self.proto.timers #blocking calls wait through the protocol timers
 
     def bind(self, port):
         ###print(f"bind: attempting to bind {port}.")
+        if self.closed:
+            raise StreamSocket.Closed
         #lock
-        self.proto.lock.acquire()
-        #if in use by another system
-        if(self.proto.bound_ports.get(port) != None):
-            raise StreamSocket.AddressInUse
-        #check if alr connected
-        if(self.state == 'CONNECTED'):
-            raise StreamSocket.AlreadyConnected
-        
-        #set fields and bind
-        self.proto.bound_ports[port] = self
-        self.proto.lock.release()
+        with self.proto.lock:
+            #if in use by another system
+            if(self.proto.bound_ports.get(port) != None):
+                raise StreamSocket.AddressInUse
+            #check if alr connected
+            if(self.state == 'CONNECTED'):
+                raise StreamSocket.AlreadyConnected
+
+            #set fields and bind
+            self.proto.bound_ports[port] = self
 
         self.lock.acquire()
         self.port = port
         self.state = "BOUND"
         self.lock.release()
-        
+
 
     def listen(self):
-        
+
         ###print("listen: arrived")
         #err checking
+        if self.closed:
+            raise StreamSocket.Closed
         if(self.port == None):
             raise StreamSocket.NotBound
         if(self.state == 'CONNECTED'):
             raise StreamSocket.AlreadyConnected
-        
+
+        #the accept queue has to exist before SYNs can find us
+        with self.lock:
+            if self.conn_q is None:
+                self.conn_q = self.new_queue()
+
         #add to protocol server sockets and change state
         self.proto.lock.acquire()
         self.proto.server_sockets[self.port] = self
@@ -76,261 +180,972 @@ class RDTSocket(StreamSocket):
     def accept(self):
 
         ###print(f'accept: arrived at port - ({self.port})')
+        if self.closed:
+            raise StreamSocket.Closed
         if(self.state != 'LISTENING'):
             raise StreamSocket.NotListening
-        
+
         ###print('accept: checking q for connection')
-        new_sock, rhost, rport = self.conn_q.get(5) #check connection q for new conns
+        if not self.blocking:
+            try:
+                conn = self.conn_q.get_nowait()
+            except queue.Empty:
+                raise StreamSocket.WouldBlock
+            return self.accepted(conn)
+        conn = self.proto.timers.get(self.conn_q) #check connection q for new conns
         ###print('accept: connection accepted')
-        
+        return self.accepted(conn)
+
+    def accepted(self, conn):
+        '''
+        Hands a (socket, rhost, rport) item from conn_q to the application.
+        '''
+        if conn is None:
+            #the listener closed, leave the marker for the next accept
+            self.conn_q.put(None)
+            raise StreamSocket.Closed
+        new_sock, rhost, rport = conn
+
         #set state
         new_sock.lock.acquire()
         new_sock.state = 'CONNECTED'
         new_sock.lock.release()
 
         return (new_sock, (rhost, rport)) #return conn
-        
+
 
     def connect(self, addr):
         ###print(f"connect: self port - {self.port} arrived w/ address: {addr}")
-        #exceptions
+        key = self.start_connect(addr)
+
+        #nonblocking - the protocol finishes the handshake when the SYNACK
+        #arrives, and poll reports POLLOUT once it has
+        if not self.blocking:
+            if self.state != 'CONNECTED':
+                raise StreamSocket.WouldBlock
+            return
+
+        #wait for SYNACK, or the error that ended the handshake
+        seg_q = self.seg_q
+        while True:
+            synack: Segment = self.proto.timers.get(seg_q)
+            if isinstance(synack, Exception):
+                raise synack
+
+            if self.our_synack(synack):
+                break
+
+        self.finish_connect(synack, key)
+
+    def our_synack(self, seg):
+        '''
+        Whether a segment from seg_q is the SYNACK for our SYN.
+        '''
+        return seg.flags == SYN | ACK and seg.ack == seq_add(self.isn, 1)
+
+    def start_connect(self, addr):
+        '''
+        First half of connect - picks a port if we have none and sends the
+        SYN, which the protocol timer resends until finish_connect. Returns
+        the connection's demux key.
+        '''
+        #exceptions - a closed socket's port may already belong to another
+        if self.closed:
+            raise StreamSocket.Closed
         if(self.state == 'CONNECTED'):
             raise StreamSocket.AlreadyConnected
         if(self.state == 'LISTENING'):
             raise StreamSocket.AlreadyListening
-        
+        if(self.state == 'CONNECTING'):
+            raise StreamSocket.WouldBlock #a nonblocking connect still going
+
         #reset instance vars
-        ###print('connect: waiting for sock lock')
         self.lock.acquire()
-        ###print('connect: sock lock acquired')
         self.remote_addr = addr
-        ###print('connect: sock lock released')
-        
 
-        #handle port not bound
-        if(self.port == None):
-            #ephem range - 49152 to 65535
-            rand_port = random.randint(49152, 65535)
-            while(self.proto.bound_ports.get(rand_port) != None):
-                rand_port = random.randint(49152, 65535)
-            self.port = rand_port
-        
-        ###print(f"connect: self port - {self.port}")
+        #handle port not bound - take an ephemeral one
+        allocated = self.port is None
+        if allocated:
+            try:
+                self.port = self.proto.alloc_port(self)
+            except StreamSocket.AddressInUse:
+                self.lock.release()
+                raise
+
         #assemble SYN segment
-        flags = 0 | 1 << 1 | 0 << 2
-        self.seq_num = 0  # Initial sequence number
-        #print(f"connect: seq_num - {self.seq_num}")
+        self.state = 'CONNECTING'
         self.lock.release()
-        data_len = 0
-
-        precheck = struct.pack(PRECHK_HDR_FRMT, self.port, self.remote_addr[1], self.seq_num, 0, flags, data_len)
-        checksum = get_checksum(precheck)
-        syn_seg = struct.pack(HDR_FRMT, self.port, self.remote_addr[1], self.seq_num, 0, flags, data_len, checksum[0])
-
-        #keep sending SYN until SYNACK is recieved
-        segment = None
-        while(segment == None):
-            ###print('connect: sending SYN')
-            ###print(f'connect: storing connection - ({self.port}, {addr[0]}, {addr[1]})')
-            self.proto.connecting_socks[(self.proto.host.ip, self.port, addr[0], addr[1])] = self #store connection in connecting table
-            
-            self.lock.acquire()
-            self.state = 'CONNECTING'
-            self.lock.release()
+        syn_seg = make_segment(self.port, addr[1], self.isn, 0, SYN,
+                               struct.pack(SYN_OPTS_FRMT, self.mss, self.checksum.ident),
+                               rwnd=self.adv_wnd())
+
+        #store connection in connecting table, with a queue for the SYNACK
+        self.seg_q = self.new_queue()
+        key = (self.proto.host.ip, self.port, addr[0], addr[1])
+        with self.proto.key_lock(key):
+            self.proto.connecting_socks[key] = self
+
+        give_up = self.proto.timers.now() + self.proto.HANDSHAKE_TIMEOUT
 
-            #wait for SYNACK
+        def syn_resender():
+            with self.lock:
+                if self.state != 'CONNECTING':
+                    return
+                timed_out = self.proto.timers.now() >= give_up
+                if not timed_out:
+                    #back off and resend, the SYN can't be timed anymore
+                    self.rtt.backoff()
+                    self.hs_sent = None
+                    self.hs_timer = self.proto.timers.call_later(self.rtt.rto, syn_resender)
             try:
+                if timed_out:
+                    raise StreamSocket.Timeout
                 self.output(syn_seg, addr[0])
-                segment = self.seg_q.get(timeout=.001)
-            except queue.Empty: 
-                segment = None
-                continue
-            
-            ###print("connect: Something put in q!")
-            rport, _, seq_num, ack_num, flags, _, _= struct.unpack(HDR_FRMT, segment[:HDR_SIZE])
-            
-            #if not SYN ACK
-            if(flags != 3):
-                segment = None
-                ###print("connect: incorrect response")
-            else:
-                x = 1
-                #print("connect: SYNACK recieved!")
-            
+            except Exception as err:
+                self.abort_connect(key, allocated, err)
+
+        #send SYN, the protocol timer resends it until SYNACK is recieved
+        with self.lock:
+            self.hs_sent = self.proto.timers.now()
+            self.hs_timer = self.proto.timers.call_later(self.rtt.rto, syn_resender)
+        try:
+            self.output(syn_seg, addr[0])
+        except Exception as err:
+            self.abort_connect(key, allocated, err)
+            raise
+        return key
 
-        #assemble ACK segment        
-        flags = 1 | 0 << 1 | 0 << 2 #just doing this for myself lol
-        data_len = 0
+    def abort_connect(self, key, allocated, err):
+        '''
+        Undoes start_connect once the handshake failed with err, and hands err
+        to a connect waiting for the SYNACK.
+        '''
+        with self.lock:
+            if self.state != 'CONNECTING':
+                return
+            if self.hs_timer is not None:
+                self.hs_timer.cancel()
+            self.hs_timer = self.hs_sent = None
+            with self.proto.key_lock(key):
+                if self.proto.connecting_socks.get(key) is self:
+                    del self.proto.connecting_socks[key]
+            #an ephemeral port goes back, a bound one stays ours
+            if allocated:
+                with self.proto.lock:
+                    if self.proto.bound_ports.get(self.port) is self:
+                        del self.proto.bound_ports[self.port]
+                        self.proto.release_port(self.port)
+                self.port = None
+            self.remote_addr = None
+            self.state = 'CLOSED' if allocated else 'BOUND'
+            self.seg_q.put(err)
+        self.proto.wakeup_pollers()
 
+    def finish_connect(self, synack, key):
+        '''
+        Second half of connect, once our SYNACK has arrived - sets up both
+        directions from it and sends the handshake ACK.
+        '''
+        addr = self.remote_addr
+
+        #both directions start right after the ISNs
         self.lock.acquire()
-        self.seq_num ^= 1
-        self.last_recieved_num = 1 #need to set this for two way conn
+        if self.state != 'CONNECTING':
+            #a nonblocking connect already finished on a resent SYNACK
+            self.lock.release()
+            return
+        self.hs_timer.cancel()
+        self.hs_timer = None
+        if self.hs_sent is not None:
+            self.rtt.sample(self.proto.timers.now() - self.hs_sent)
+        self.send_base = self.next_seq = seq_add(self.isn, 1)
+        self.rcv_next = seq_add(synack.seq, 1)
+        self.snd_wnd = synack.rwnd
+        self.snd_wl1, self.snd_wl2 = synack.seq, synack.ack
+        peer_mss, csum_id = parse_syn_opts(synack.payload)
+        self.send_mss = min(self.mss, peer_mss)
+        #the server picks the engine, from here on every segment uses it
+        self.checksum = CHECKSUM_IDS.get(csum_id, self.checksum)
+        self.start_congestion()
+        self.state = "CONNECTED"
+        self.seg_q = None #handshake's over
         self.lock.release()
-        #print(f"({self.port}connect: seq_num - {self.seq_num}")
 
-        precheck = struct.pack(PRECHK_HDR_FRMT, self.port, self.remote_addr[1], self.seq_num, seq_num ^ 1, flags, data_len)
-        checksum = get_checksum(precheck)
-        ack_seg = struct.pack(HDR_FRMT, self.port, self.remote_addr[1], self.seq_num, seq_num ^ 1, flags, data_len, checksum[0])
+        #assemble ACK segment
+        ack_seg = make_segment(self.port, addr[1], self.next_seq, self.rcv_next, ACK,
+                               checksum=self.checksum, rwnd=self.adv_wnd())
 
         #move from connecting to connected
-        self.proto.lock.acquire()
-        self.proto.connecting_socks.pop((self.proto.host.ip, self.port, addr[0], addr[1]))
-        self.proto.connected_socks[(self.proto.host.ip, self.port, addr[0], addr[1])] = self
-        self.proto.lock.release()
-
-        self.state = "CONNECTED"
+        with self.proto.key_lock(key):
+            self.proto.connecting_socks.pop(key, None)
+            self.proto.connected_socks[key] = self
 
         #send ACK, if dropped -> server resends SYNACK -> client resends ACK
         self.output(ack_seg, addr[0])
-        self.seq_num ^= 1
-        #print(f'{self.port}client: conn established')
-        return
-
+        self.proto.wakeup_pollers()
 
 
     def send(self, data):
         '''
-        stop and wait -> only finish the send once the ACK is recieved 
-        resend after _ s
+        Copies data into the send buffer and returns once no more than
+        self.sndbuf bytes are waiting to be sent or acked.
         '''
 
-        ###print(f"({self.port}) send: arrived")
-        
+        #nonblocking - take the data only if the buffer has room, and don't
+        #wait for it to drain
+        if not self.blocking:
+            if self.state == 'CONNECTED' and not self.sndbuf_ok():
+                raise StreamSocket.WouldBlock
+            self.write(data)
+            return
+
+        self.write(data)
+
+        #block until the buffer is back under its limit
+        self.wait_send(self.sndbuf_ok)
+
+    def write(self, data):
+        '''
+        Copies data into the send buffer and transmits what the window
+        allows, without waiting for anything.
+        '''
         #check if connected
         if(self.state != 'CONNECTED'):
             raise StreamSocket.NotConnected
-        
-        #create segment
-        flags = 0
-        precheck = struct.pack(PRECHK_HDR_FRMT, self.port, self.remote_addr[1], self.seq_num, 0, flags, len(data)) #TODO ACK and Seq nums
-        checksum = get_checksum(precheck + data)
-        hdr = struct.pack(HDR_FRMT, self.port, self.remote_addr[1], self.seq_num, 0, flags, len(data), checksum[0])
-
-        #send
-
-        #wait for ack 
-        ack_seg = None
-        while ack_seg is None:
+
+        with self.lock:
+            self.unsent += data
+        self.transmit()
+
+    def sndbuf_ok(self):
+        '''
+        Whether the send buffer is within self.sndbuf, so send() can return.
+        '''
+        return self.unacked_bytes + len(self.unsent) <= self.sndbuf
+
+    def flushed(self):
+        '''
+        Whether everything written has been acked.
+        '''
+        return not (self.unacked or self.unsent)
+
+    def wait_send(self, predicate):
+        '''
+        Blocks until predicate() is true, rechecking whenever the window
+        moves, or raises Closed if the socket is torn down first.
+        '''
+        with self.lock:
+            if predicate():
+                return
+            if self.send_cond is None:
+                self.send_cond = threading.Condition(self.lock)
+            self.proto.timers.wait_for(lambda: predicate() or self.state == 'CLOSED',
+                                       self.send_cond)
+            if not predicate():
+                raise StreamSocket.Closed
+
+    def new_queue(self):
+        '''
+        A queue for seg_q or conn_q, made when connecting or listening.
+        '''
+        return queue.Queue()
+
+    def poll_events(self, events):
+        '''
+        Which of events (POLLIN/POLLOUT bits) the socket is ready for right
+        now, plus POLLERR if it's neither connected nor listening.
+        '''
+        revents = 0
+        if self.state == 'LISTENING':
+            if self.conn_q.qsize():
+                revents |= POLLIN
+        elif self.state == 'CONNECTED':
+            if self.buffered or self.eof:
+                revents |= POLLIN
+            if self.sndbuf_ok():
+                revents |= POLLOUT
+        elif self.state != 'CONNECTING':
+            revents |= POLLERR
+        return revents & (events | POLLERR)
+
+    def delivered(self):
+        self.proto.wakeup_pollers()
+
+    def flush(self):
+        '''
+        Blocks until everything written with send() has been acked. A
+        nonblocking socket raises WouldBlock instead while some isn't.
+        '''
+        if not self.blocking:
+            if not self.flushed():
+                raise StreamSocket.WouldBlock
+            return
+        self.wait_send(self.flushed)
+
+    def sendall(self, data):
+        '''
+        Like send, but only returns once all of data has been acked.
+        '''
+        self.send(data)
+        self.flush()
+
+    def close(self):
+        '''
+        Closes the socket without waiting - buffered data and then a FIN still go
+        out, see finish_close. A closed socket can't be bound or connected again.
+        '''
+        with self.lock:
+            self.closed = True
+            state = self.state
+            if state == 'CONNECTED':
+                self.state = 'LAST_ACK' if self.eof else 'FIN_WAIT'
+            elif state in ('FIN_WAIT', 'LAST_ACK', 'TIME_WAIT'):
+                return
+            else:
+                self.teardown()
+
+        if state == 'CONNECTED':
+            #the FIN goes out behind the buffered data, and only then does
+            #the clock start, so a virtual one can't skip past it
+            self.transmit()
+            with self.lock:
+                if self.state in ('FIN_WAIT', 'LAST_ACK') and self.close_timer is None:
+                    self.close_timer = self.proto.timers.call_later(self.proto.CLOSE_TIMEOUT,
+                                                                    self.close_timeout)
+        elif state == 'LISTENING':
+            while True:
+                try:
+                    child, _, _ = self.conn_q.get_nowait()
+                except queue.Empty:
+                    break
+                child.state = 'CONNECTED'
+                child.close()
+            #wakes a blocked accept
+            self.conn_q.put(None)
+
+    def finish_close(self):
+        '''
+        Tears the socket down, or enters TIME_WAIT, once both FINs are through
+        (call with lock held).
+        '''
+        if self.fin_seq is None or self.send_base != seq_add(self.fin_seq, 1):
+            return
+        if self.state == 'LAST_ACK':
+            self.teardown()
+        elif self.state == 'FIN_WAIT' and self.eof:
+            self.state = 'TIME_WAIT'
+            if self.close_timer is not None:
+                self.close_timer.cancel()
+            self.close_timer = self.proto.timers.call_later(self.proto.TIME_WAIT, self.close_timeout)
+
+    def close_timeout(self):
+        '''
+        TIME_WAIT is over, or the peer never finished closing - run by the
+        protocol timer.
+        '''
+        with self.lock:
+            if self.state in ('FIN_WAIT', 'LAST_ACK', 'TIME_WAIT'):
+                self.teardown()
+
+    def teardown(self):
+        '''
+        Forget the socket - stop its timers, remove it from every protocol
+        table and release its port (call with lock held). The state only
+        turns CLOSED once all of that is done.
+        '''
+        for timer in (self.hs_timer, self.retx_timer, self.persist_timer,
+                      self.ack_timer, self.close_timer):
+            if timer is not None:
+                timer.cancel()
+        self.hs_timer = self.retx_timer = self.persist_timer = None
+        self.ack_timer = self.close_timer = None
+
+        proto = self.proto
+        if self.remote_addr is not None:
+            key = (proto.host.ip, self.port, self.remote_addr[0], self.remote_addr[1])
+            with proto.key_lock(key):
+                if proto.connected_socks.get(key) is self:
+                    del proto.connected_socks[key]
+                if proto.connecting_socks.get(key) is self:
+                    del proto.connecting_socks[key]
+                    if self.parent is not None:
+                        self.parent.half_open_add(-1)
+        with proto.lock:
+            #child sockets share the listener's port, only the owner frees it
+            if proto.bound_ports.get(self.port) is self:
+                del proto.bound_ports[self.port]
+                proto.release_port(self.port)
+            if proto.server_sockets.get(self.port) is self:
+                del proto.server_sockets[self.port]
+        self.state = 'CLOSED'
+
+        #wake whoever still waits on the socket - connect and send raise
+        #Closed, recv sees the end of the stream
+        if self.seg_q is not None:
+            self.seg_q.put(StreamSocket.Closed())
+        if self.send_cond is not None:
+            self.send_cond.notify_all()
+        if not self.eof:
+            self.deliver_eof()
+        proto.wakeup_pollers()
+
+    def transmit(self):
+        '''
+        Moves buffered data, then the FIN, into the window as send_mss segments.
+        One thread transmits at a time, anyone else just returns.
+        '''
+        with self.lock:
+            if self.transmitting:
+                return
+            self.transmitting = True
+
+        while True:
+            with self.lock:
+                size = min(self.send_mss, len(self.unsent))
+                if not self.unacked:
+                    #nothing in flight - send whatever fits, even into a small window
+                    size = min(size, self.snd_wnd)
+                fin = (self.state in ('FIN_WAIT', 'LAST_ACK') and self.fin_seq is None
+                       and not self.unsent and len(self.unacked) < self.window)
+                #otherwise wait for room for a whole segment rather than
+                #dribble out small ones (silly window syndrome)
+                if not fin and (not size or len(self.unacked) >= self.window or self.cwnd_full(size)
+                                or self.unacked_bytes + size > self.snd_wnd):
+                    self.transmitting = False
+                    self.arm_persist()
+                    return
+
+                #create segment
+                seq = self.next_seq
+                self.next_seq = seq_add(seq, 1)
+                if fin:
+                    seg = make_segment(self.port, self.remote_addr[1], seq, self.rcv_next, FIN | ACK,
+                                       checksum=self.checksum, rwnd=self.adv_wnd())
+                    self.fin_seq = seq
+                else:
+                    #copy the payload straight from the buffer into the segment,
+                    #piggybacking our cumulative ACK so no separate one is needed
+                    with memoryview(self.unsent) as buf:
+                        seg = make_segment(self.port, self.remote_addr[1], seq, self.rcv_next, ACK,
+                                           buf[:size], checksum=self.checksum, rwnd=self.adv_wnd())
+                    del self.unsent[:size]
+                self.cancel_delayed_ack()
+                now = self.proto.timers.now()
+                if not self.unacked:
+                    self.unacked = collections.deque()
+                self.unacked.append(TxSegment(seq, seg, now + self.rtt.rto))
+                self.unacked_bytes += size
+                if self.timed is None:
+                    self.timed = (seq, now)
+                self.arm_retx()
+
+            #send, never holding the lock - the ACK may come back on this thread
             try:
-                #print(f"({self.port}) sending data")
-                self.output(hdr+data, self.remote_addr[0])
-                ack_seg = self.seg_q.get(timeout=0.001)
-            except queue.Empty:
-                #print(f"({self.port}) send: nothing in q - ACK or data must've dropped")
-                ack_seg = None
-                # loop again until we receive an ACK
-                pass
-        
-        #print(f"({self.port}) send: ack recieved")
-        self.seq_num ^= 1
+                self.output(seg, self.remote_addr[0])
+            except BaseException:
+                with self.lock:
+                    self.transmitting = False
+                raise
+
+    def start_congestion(self):
+        '''
+        Create the congestion controller named by self.congestion, if any,
+        now that send_mss is known (call with lock held).
+        '''
+        if self.congestion is not None:
+            self.cc = CONTROLLERS[self.congestion](self.send_mss, self.proto.timers.now())
+
+    def cwnd_full(self, size):
+        '''
+        Whether sending size more bytes would overrun the congestion window
+        (call with lock held). One segment may always be in flight.
+        '''
+        return self.cc is not None and self.unacked and self.unacked_bytes + size > self.cc.cwnd
+
+    def arm_persist(self):
+        '''
+        Start the zero window probe timer if the peer's window is all that's
+        holding our data back, and with nothing in flight no ACK is coming
+        to reopen it (call with lock held).
+        '''
+        if self.persist_timer is None and self.unsent and not self.unacked and not self.snd_wnd:
+            delay = min(self.rtt.rto * (1 << self.persist_backoffs), self.rtt.rto_max)
+            self.persist_timer = self.proto.timers.call_later(delay, self.persist_timeout)
+
+    def persist_timeout(self):
+        '''
+        Zero window probe, run by the protocol timer - resends the seq before
+        send_base so the peer ACKs it with its current window.
+        '''
+        with self.lock:
+            self.persist_timer = None
+            if not self.unsent or self.unacked or self.snd_wnd:
+                return
+            if self.rtt.rto * (1 << self.persist_backoffs) < self.rtt.rto_max:
+                self.persist_backoffs += 1
+            probe = make_segment(self.port, self.remote_addr[1], seq_add(self.send_base, -1),
+                                 self.rcv_next, 0, checksum=self.checksum, rwnd=self.adv_wnd())
+            self.arm_persist()
+        self.output(probe, self.remote_addr[0])
+
+    def pending_retx(self):
+        '''
+        Segments the retransmission timer is watching (call with lock held).
+        gbn -> the whole window; sr -> everything not selectively ACKed
+        '''
+        if self.arq == 'sr':
+            return [tx for tx in self.unacked if not tx.sacked]
+        return list(self.unacked)
+
+    def arm_retx(self):
+        '''
+        Schedule the retransmission timer for the earliest deadline, unless
+        it's already running (call with lock held). Deadlines pushed back by
+        ACKs don't touch the timer - retx_timeout just reschedules itself.
+        '''
+        if self.retx_timer is not None:
+            return
+        pending = self.pending_retx()
+        if pending:
+            deadline = min(tx.deadline for tx in pending)
+            self.retx_timer = self.proto.timers.call_at(deadline, self.retx_timeout)
+
+    def retx_timeout(self):
+        '''
+        Retransmission timer, run by the protocol timer.
+        gbn -> resend the whole window from send_base
+        sr  -> resend only the segments whose deadline expired
+        '''
+        with self.lock:
+            self.retx_timer = None
+            now = self.proto.timers.now()
+            pending = self.pending_retx()
+            if not pending or min(tx.deadline for tx in pending) > now:
+                self.arm_retx()
+                return
+
+            if self.arq == 'sr':
+                pending = [tx for tx in pending if tx.deadline <= now]
+            #back off, and per Karn's rule stop timing - an ACK could now
+            #be for either copy
+            self.rtt.backoff()
+            self.timed = None
+            #tell congestion control, once per window - everything sent
+            #before the last loss has to be acked before another counts
+            if self.cc is not None and (self.recover is None or
+                    seq_diff(self.send_base, self.recover) <= seq_diff(self.next_seq, self.recover)):
+                self.recover = self.next_seq
+                self.cc.on_loss(now)
+            for tx in pending:
+                tx.deadline = now + self.rtt.rto
+            segs = [tx.seg for tx in pending]
+            self.arm_retx()
+
+        for seg in segs:
+            self.output(seg, self.remote_addr[0])
+
+    def handle_ack(self, ack_num, sack_num=None, rwnd=None, seq=None):
+        '''
+        Cumulative ACK for everything before ack_num, plus sack_num if given.
+        rwnd only counts from segments no older than the last (SND.WL1/WL2).
+        '''
+        with self.lock:
+            now = self.proto.timers.now()
+            sample = None
+            #mark the selectively acked segment so it isn't resent
+            if sack_num is not None:
+                idx = seq_diff(sack_num, self.send_base)
+                if idx < len(self.unacked):
+                    self.unacked[idx].sacked = True
+                if self.timed is not None and self.timed[0] == sack_num:
+                    sample = now - self.timed[1]
+                    self.rtt.sample(sample)
+                    self.timed = None
+
+            #ignore stale and bogus cumulative ACKs
+            acked = seq_diff(ack_num, self.send_base)
+            if acked > len(self.unacked):
+                return
+
+            #only a segment at least as new as the last window update has the
+            #peer's latest window - newer seq, or the same seq and a newer ack
+            if rwnd is not None and seq is not None:
+                newer = seq_diff(seq, self.snd_wl1)
+                if newer >= SEQ_MOD // 2 or (not newer and seq_diff(ack_num, self.snd_wl2) >= SEQ_MOD // 2):
+                    rwnd = None
+            opened = rwnd is not None and rwnd > self.snd_wnd
+            if rwnd is not None:
+                self.snd_wnd = rwnd
+                if seq is not None:
+                    self.snd_wl1 = seq
+                self.snd_wl2 = ack_num
+            if opened:
+                self.persist_backoffs = 0
+            if not acked and not opened:
+                return
+
+            if acked:
+                #finish timing if this ACK covers the timed segment
+                if self.timed is not None and seq_diff(self.timed[0], self.send_base) < acked:
+                    sample = now - self.timed[1]
+                    self.rtt.sample(sample)
+                    self.timed = None
 
+                acked_bytes = 0
+                for _ in range(acked):
+                    acked_bytes += len(self.unacked.popleft().seg) - HDR_SIZE
+                if not self.unacked:
+                    self.unacked = ()
+                self.unacked_bytes -= acked_bytes
+                self.send_base = ack_num
+                self.rtt.reset_backoff()
+                if self.cc is not None:
+                    self.cc.on_ack(acked_bytes, sample, now)
 
-    def handle_syn(self,seg, rhost):
+                #restart the timer for whatever is still outstanding
+                if self.arq != 'sr' and self.unacked:
+                    deadline = now + self.rtt.rto
+                    for tx in self.unacked:
+                        tx.deadline = deadline
+                if self.send_cond is not None:
+                    self.send_cond.notify_all()
+                self.finish_close()
+
+        self.proto.wakeup_pollers()
+        #the window just opened, keep the send buffer draining
+        self.transmit()
+
+
+    def handle_syn(self, seg: 'Segment', rhost):
+        '''
+        A SYN for this listening socket - answered by a half-open child, or a
+        SYN cookie, or dropped once proto.SYN_BACKLOG children are waiting.
+        '''
         ###print("Handle Segment: arrived")
-        rport, dport, seq_num, ack_num, flags, data_len, checksum = struct.unpack(HDR_FRMT, seg[:HDR_SIZE])
-        ###print(f"Handle Segment: rport-{rport} dport-{dport} seq-{seq_num} ack-num{ack_num} flags-{flags} checksum-{checksum}")
-        
-        #handle the SYN case 
-        ###print("Handle Segment: SYN Packet Recieved")
+        rport, dport = seg.sport, seg.dport
 
-        #check if specified port is listening 
+        #check if specified port is listening
         dest_sock: RDTSocket = self.proto.bound_ports.get(dport)
 
-        #raise exception if port isn't bound or isn't listening 
+        #raise exception if port isn't bound or isn't listening
         if(dest_sock == None):
             ###print(f"Handle Segment: port {dport} is not bound")
             raise Exception
-        
+
         ###print(f"Handle Segment: dest sock state: {dest_sock.state}")
         if(dest_sock.state != 'LISTENING'):
             raise StreamSocket.NotListening
-        
-        self.lock.acquire()
-        self.last_recieved_num = seq_num
-        #print(f"handle syn: Last rec - {self.last_recieved_num} ")
-        self.seq_num = 0
-        self.lock.release()
 
+        key = (self.proto.host.ip, self.port, rhost, rport)
+        peer_mss, csum_id = parse_syn_opts(seg.payload)
+        cookies = self.proto.SYN_COOKIES
+        with self.proto.key_lock(key):
+            #a retransmitted SYN that lost the race with the handshake ACK -
+            #a new child would steal the finished connection
+            if key in self.proto.connected_socks:
+                return
+            child = self.proto.connecting_socks.get(key)
+        full = self.half_open >= self.proto.SYN_BACKLOG
+        if child is None and (cookies == 'always' or cookies == 'overflow' and full):
+            self.send_cookie(seg, rhost, peer_mss, csum_id)
+            return
+        if child is None:
+            if full:
+                return
+            new_sock = self.new_child(rhost, rport, 0, seq_add(seg.seq, 1), seg.rwnd, peer_mss, csum_id)
+            with self.proto.key_lock(key):
+                #another thread may have handled a copy of this SYN meanwhile
+                if key in self.proto.connected_socks:
+                    return
+                child = self.proto.connecting_socks.get(key)
+                if child is None and self.half_open_add(1):
+                    # store the child socket in connecting_socks BEFORE arming the resender
+                    self.proto.connecting_socks[key] = new_sock
+            if child is None:
+                if self.proto.connecting_socks.get(key) is new_sock:
+                    new_sock.arm_synack(key)
+                return
+
+        #a resent SYN - our SYNACK was lost, so resend it now rather than
+        #wait for the timer, and don't time it (Karn)
+        with child.lock:
+            if child.state != 'CONNECTING' or child.hs_seg is None:
+                return
+            child.hs_sent = None
+            synack = child.hs_seg
+        self.output(synack, rhost)
+
+    def half_open_add(self, n, force=False):
+        '''
+        Counts children joining (n=1) or leaving (n=-1) connecting_socks on
+        this listener. Returns False instead of counting one more past
+        proto.SYN_BACKLOG, unless force is set.
+        '''
+        with self.lock:
+            if n > 0 and not force and self.half_open >= self.proto.SYN_BACKLOG:
+                return False
+            self.half_open += n
+            return True
+
+    def new_child(self, rhost, rport, isn, rcv_next, rwnd, peer_mss, csum_id):
+        '''
+        Creates the socket for a connection to this listener, from what the
+        client's SYN told us, and the SYNACK that answers it.
+        '''
         #create new socket for conn
         new_sock: RDTSocket = self.proto.socket()
         new_sock.port = self.port
         new_sock.parent = self
         new_sock.remote_addr = (rhost, rport)
         new_sock.state = 'CONNECTING'
+        new_sock.isn = isn
+        new_sock.send_base = new_sock.next_seq = seq_add(isn, 1)
+        new_sock.rcv_next = rcv_next
+        new_sock.snd_wnd = rwnd
+        new_sock.snd_wl1, new_sock.snd_wl2 = seq_add(rcv_next, -1), new_sock.send_base
+        new_sock.send_mss = min(new_sock.mss, peer_mss)
+        #take the client's checksum engine if we have it, otherwise ours
+        new_sock.checksum = CHECKSUM_IDS.get(csum_id, new_sock.checksum)
+        new_sock.congestion = self.congestion
+        new_sock.start_congestion()
 
-        #send SYN ACK
-        flags = 1 | 1 << 1 | 0 << 2
-        data_len = 0
-        pre_check = struct.pack(PRECHK_HDR_FRMT, new_sock.port, rport, self.seq_num, seq_num ^ 1, flags, data_len)
-        checksum = get_checksum(pre_check)
-        synack_seg = struct.pack(HDR_FRMT, new_sock.port, rport, self.seq_num, seq_num ^ 1, flags, data_len, checksum[0])
-        
-        # Make sure the ACK event is cleared before starting
-        self.ack_event.clear()
-        
-        # store the child socket in connecting_socks BEFORE starting resender
-        self.proto.connecting_socks[(self.proto.host.ip, self.port, rhost, rport)] = new_sock
-
-        # send first SYN-ACK immediately
-        self.output(synack_seg, rhost)
+        #SYN ACK, advertising our MSS and the chosen engine back
+        new_sock.hs_seg = make_segment(new_sock.port, rport, isn, rcv_next, SYN | ACK,
+                                       struct.pack(SYN_OPTS_FRMT, new_sock.mss, new_sock.checksum.ident),
+                                       rwnd=new_sock.adv_wnd())
+        return new_sock
+
+    def arm_synack(self, key):
+        '''
+        Sends a half-open child's SYNACK and has the protocol timer resend it
+        until the handshake is done, or proto.HANDSHAKE_TIMEOUT has passed.
+        '''
+        proto = self.proto
+        rhost = self.remote_addr[0]
+        give_up = proto.timers.now() + proto.HANDSHAKE_TIMEOUT
 
         def synack_resender():
-            while not self.ack_event.wait(timeout=.001):  # Wait up to 5 seconds for ACK
-                # If event wasn't set (timeout occurred), resend
-                self.output(synack_seg, rhost)
+            with self.lock:
+                # handshake finished, or this child was dropped
+                if self.state != 'CONNECTING' or proto.connecting_socks.get(key) is not self:
+                    return
+                # client went away - forget the half-open connection
+                if proto.timers.now() >= give_up:
+                    with proto.key_lock(key):
+                        if proto.connecting_socks.get(key) is self:
+                            del proto.connecting_socks[key]
+                            self.parent.half_open_add(-1)
+                    return
+                # back off and resend
+                self.rtt.backoff()
+                self.hs_sent = None
+                self.hs_timer = proto.timers.call_later(self.rtt.rto, synack_resender)
+                synack = self.hs_seg
+            self.output(synack, rhost)
 
-        # start as daemon so it won't block process exit
-        t = threading.Thread(target=synack_resender, daemon=True)
-        t.start()
-        #print(f"({self.port})server: conn established")
-        # return immediately (do NOT wait here)
-        return
-        
+        # send first SYN-ACK immediately, the protocol timer resends it
+        with self.lock:
+            self.hs_sent = proto.timers.now()
+            self.hs_timer = proto.timers.call_later(self.rtt.rto, synack_resender)
+        self.output(self.hs_seg, rhost)
+
+    def send_cookie(self, seg, rhost, peer_mss, csum_id):
+        '''
+        Answers a SYN with a SYNACK whose seq is a SYN cookie, keeping no
+        state. There's no resender either, the client resends its SYN.
+        '''
+        key = (self.proto.host.ip, self.port, rhost, seg.sport)
+        checksum = CHECKSUM_IDS.get(csum_id, CHECKSUMS[self.proto.CHECKSUM])
+        cookie = self.proto.syn_cookie(key, seg.seq, peer_mss, checksum.ident)
+        synack_seg = make_segment(self.port, seg.sport, cookie, seq_add(seg.seq, 1), SYN | ACK,
+                                  struct.pack(SYN_OPTS_FRMT, self.mss, checksum.ident),
+                                  rwnd=min(self.proto.RECV_BUFFER, MAX_RWND))
+        self.output(synack_seg, rhost)
+
+
+    def handle_data(self, seg: 'Segment', rhost):
+        '''
+        gbn -> deliver only the next in-order segment
+        sr  -> buffer out-of-order segments in self.reorder until the gap fills
+        ACKs are delayed per ack_every/ack_delay, except for those in ack_now.
+        '''
+        seq_num = seg.seq
+        sack = self.arq == 'sr'
+
+        with self.lock:
+            if seg.flags & FIN:
+                self.fin_rcvd = seq_num
+            if seq_num == self.rcv_next and len(seg.payload) > self.rcv_wnd():
+                #no room for it (a sender ignoring our window) - drop it and
+                #ACK, which tells the sender how much room there is
+                now = True
+                sack = False
+            elif seq_num == self.rcv_next:
+                #deliver data plus anything buffered right behind it
+                chunks = [seg.payload]
+                nxt = seq_add(seq_num, 1)
+                while nxt in self.reorder:
+                    chunks.append(self.reorder.pop(nxt))
+                    nxt = seq_add(nxt, 1)
+                if nxt == self.fin_rcvd:
+                    nxt = seq_add(nxt, 1)
+                self.deliver(b''.join(chunks))
+                self.rcv_next = nxt
+                #everything up to the peer's FIN is in, so that's the end
+                fin = self.fin_rcvd is not None and nxt == seq_add(self.fin_rcvd, 1)
+                if fin:
+                    self.deliver_eof()
+                    self.finish_close()
+                self.ack_pending += 1
+                now = (self.ack_pending >= self.ack_every or fin
+                       or len(chunks) > 1 and 'fill' in self.ack_now)
+                #the cumulative ACK covers this one, no need to SACK it
+                sack = False
+            elif seq_diff(seq_num, self.rcv_next) < self.window:
+                if sack and not seg.flags & FIN:
+                    self.reorder[seq_num] = seg.payload
+                self.ack_pending += 1
+                now = self.ack_pending >= self.ack_every or 'reorder' in self.ack_now
+            else:
+                #a duplicate - the peer is retransmitting, so it needs an ACK
+                if seq_diff(self.rcv_next, seq_num) > self.window:
+                    #neither a duplicate nor inside the window, don't vouch for it
+                    sack = False
+                now = True
+            ack_num = self.rcv_next
+
+            if not now:
+                if self.ack_timer is None:
+                    self.ack_timer = self.proto.timers.call_later(self.ack_delay, self.delayed_ack)
+                return
+            self.cancel_delayed_ack()
+
+        self.ack(ack_num, seq_num if sack else None)
+
+    def ack(self, ack_num, sack_num=None):
+        '''
+        Send a cumulative ACK for ack_num, selectively ACKing sack_num too
+        if given. Called without the lock held.
+        '''
+        if sack_num is not None:
+            ack_seg = make_segment(self.port, self.remote_addr[1], sack_num, ack_num, ACK | SACK,
+                                   checksum=self.checksum, rwnd=self.adv_wnd())
+        else:
+            #a pure ACK's seq is the next one we'll send, which orders its
+            #window against our data segments for the peer (see handle_ack)
+            ack_seg = make_segment(self.port, self.remote_addr[1], self.next_seq, ack_num, ACK,
+                                   checksum=self.checksum, rwnd=self.adv_wnd())
+        self.output(ack_seg, self.remote_addr[0])
+
+    def rcv_wnd(self):
+        '''
+        Free space in the receive buffer, in bytes. Only data the app
+        hasn't read counts; the reorder buffer is bounded by self.window.
+        '''
+        return min(max(self.rcvbuf - self.buffered, 0), MAX_RWND)
+
+    def adv_wnd(self):
+        '''
+        rcv_wnd, remembered as the window we last advertised - for putting
+        in an outgoing segment.
+        '''
+        self.rcv_adv = self.rcv_wnd()
+        return self.rcv_adv
+
+    def consumed(self, n):
+        '''
+        The app just read n bytes. If that opened our window by an MSS (or
+        half the buffer, if smaller) since we last advertised it, send a
+        window update so a sender held back by it can carry on.
+        '''
+        with self.lock:
+            if self.state != 'CONNECTED' or self.rcv_wnd() - self.rcv_adv < min(self.rcvbuf // 2, self.mss):
+                return
+            #the update is a full cumulative ACK too
+            self.cancel_delayed_ack()
+            ack_num = self.rcv_next
+        self.ack(ack_num)
+
+    def cancel_delayed_ack(self):
+        '''
+        Forget about any delayed ACK, one is about to go out that covers it
+        (call with lock held).
+        '''
+        self.ack_pending = 0
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+
+    def delayed_ack(self):
+        '''
+        Delayed ACK timer, run by the protocol timer - ACK whatever arrived
+        in order since the last ACK.
+        '''
+        with self.lock:
+            self.ack_timer = None
+            if not self.ack_pending:
+                return
+            self.ack_pending = 0
+            ack_num = self.rcv_next
+        self.ack(ack_num)
 
-    def handle_data(self, seg, rhost):
 
-        ###print("Handle Segment: arrived")
-        rport, dport, seq_num, ack_num, flags, data_len, checksum = struct.unpack(HDR_FRMT, seg[:HDR_SIZE])
-        #print(f"({self.port}) handle data: rec'd seq_num -{seq_num} last_recieved - {self.last_recieved_num} ")
-        #if incorrect seq num then resend last ack 
-        if(seq_num != self.last_recieved_num ^ 1):
-            #print("handle data: incorrect seq num")
-            #assemble ACK
-            precheck = struct.pack(PRECHK_HDR_FRMT, self.port, self.remote_addr[1], 0, self.last_recieved_num ^ 1, 1, 0)
-            checksum = get_checksum(precheck)
-            seg = struct.pack(HDR_FRMT, self.port, self.remote_addr[1], 0, self.last_recieved_num ^ 1, 1, 0, checksum[0])
-            
-            #send ACK
-            self.output(seg, self.remote_addr[0])
-            return
-            
-        
-        #deliver data
-        ###print(f"Handle Segment: rport-{rport} dport-{dport} seq-{seq_num} ack-num{ack_num} flags-{flags} checksum-{checksum}")
-        #print("Handle Segment: Delivering data")
-        self.deliver(seg[HDR_SIZE:])
-        self.last_recieved_num = seq_num
-        # assemble ACK
-        ack_num = seq_num + 1
-        data_len = 0
-        flags = 1
-
-        # PRECHK_HDR_FRMT layout is: srcport, dstport, seq, ack, flags, datalen
-        precheck = struct.pack(PRECHK_HDR_FRMT, self.port, self.remote_addr[1], 0, ack_num, flags, data_len)
-        checksum = get_checksum(precheck)
-        seg = struct.pack(HDR_FRMT, self.port, self.remote_addr[1], 0, ack_num, flags, data_len, checksum[0])
-
-        # send ACK
-        #print("Handle Segment: Data delivered, sending ACK ")
-
-        self.output(seg, self.remote_addr[0])
-
-    
 
 class RDTProtocol(Protocol):
     PROTO_ID = IPPROTO_RDT
     SOCKET_CLS = RDTSocket
-    
+    # Default retransmission strategy; 'gbn' (Go-Back-N) or 'sr' (Selective Repeat)
+    ARQ = 'gbn'
+    # Default window in segments; 1 is stop and wait
+    WINDOW = 1
+    # Largest segment payload in bytes, advertised to the peer during the handshake
+    MSS = 1400
+    # Bytes send() may leave unsent or unacked before it blocks; 0 makes every
+    # send wait for its ACKs
+    SEND_BUFFER = 2 ** 16
+    # Most unread bytes a socket buffers for the application; what's free is
+    # advertised to the peer as its receive window
+    RECV_BUFFER = 2 ** 16
+    # Retransmission timeout bounds in seconds; the RTO starts at RTO_INITIAL
+    # and then follows the measured RTT. The first RTO has to cover a
+    # handshake round trip, and the floor has to stay above the scheduling
+    # jitter of a thread per host, or timeouts fire for segments still in flight
+    RTO_INITIAL = 0.02
+    RTO_MIN = 0.01
+    RTO_MAX = 1.0
+    # Ports connect() picks from when the socket isn't bound, inclusive
+    EPHEMERAL_PORTS = (49152, 65535)
+    # Locks the connection tables are split over, see key_lock
+    DEMUX_STRIPES = 64
+    # Most half-open connections a listening socket keeps at once; further
+    # SYNs are dropped, the clients resend them
+    SYN_BACKLOG = 1024
+    # SYN cookies: None never, 'overflow' instead of dropping SYNs when the
+    # backlog is full, 'always' to keep no state before the handshake ACK
+    SYN_COOKIES = None
+    # Seconds a handshake is retried before it's given up - a listener drops
+    # the half-open connection, connect raises StreamSocket.Timeout
+    HANDSHAKE_TIMEOUT = 30.0
+    # Seconds the side that closes first lingers in TIME_WAIT, to ACK a resent
+    # FIN, before its port and table entries are released; at least twice
+    # RTO_MAX, so the peer gets to resend its FIN
+    TIME_WAIT = 2.0
+    # Seconds a closed socket keeps sending what's left and its FIN before it
+    # gives up on the peer and is released anyway
+    CLOSE_TIMEOUT = 30.0
+    # Checksum engine proposed for new connections; a key of CHECKSUMS
+    CHECKSUM = 'crc32'
+    # Congestion controller for new connections, a key of congestion.CONTROLLERS
+    # ('reno', 'cubic', 'bbr'); None limits bytes in flight by WINDOW alone
+    CONGESTION = None
+    # Delayed ACKs: ACK every ACK_EVERY in-order segments, or ACK_DELAY seconds
+    # after the first one still unACKed; 1 ACKs every segment immediately
+    ACK_EVERY = 1
+    ACK_DELAY = 0.0005
+    # Events that send an ACK at once even when delaying: 'reorder' for an
+    # out-of-order segment, 'fill' for one that fills a gap
+    ACK_NOW = frozenset({'reorder', 'fill'})
+
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -339,116 +1154,487 @@ class RDTProtocol(Protocol):
         self.connecting_socks = {} #dict stores sockets waiting for S SA A handshake ACK (remip, remport, sport) -> socket
         self.connected_socks = {} #dict stores sockets that have finished handshake
         self.server_sockets = {}
+        #lock guards the port tables (bound_ports, server_sockets and the free
+        #ports), and for the connection tables every key hashes to one of the
+        #stripes - so handshakes and teardowns of different connections
+        #don't wait on each other. Lookups in input don't lock at all
         self.lock = threading.Lock()
-        
-    #TODO - add locks
-    #TODO - handle handshake ACKs 
-    def input(self, seg, rhost):
+        self.stripes = [threading.Lock() for _ in range(self.DEMUX_STRIPES)]
+        self.cookie_secret = os.urandom(16) #keys the SYN cookie hash
+        #ephemeral ports never handed out yet come first, in an order walked
+        #by a cursor - a random start and a stride coprime with the range, so
+        #it visits every port once without building a list of them. Then the
+        #released ones, oldest first, so a port that just left TIME_WAIT is
+        #the last to be reused. released_set marks which ports are in there
+        lo, hi = self.EPHEMERAL_PORTS
+        span = hi - lo + 1
+        self.port_cursor = random.randrange(span)
+        self.port_stride = random.randrange(span) + 1
+        while math.gcd(self.port_stride, span) != 1:
+            self.port_stride += 1
+        self.fresh_ports = span #ports the cursor has yet to visit
+        self.released = collections.deque()
+        self.released_set = set()
+        #one timer thread for every socket on this host, or the network's
+        #own scheduler when it's a virtual clock simulation
+        net_timers = self.host.net.scheduler
+        self.timers = net_timers if net_timers.virtual else Scheduler()
+        self.poll_cond = threading.Condition() #notified when a socket may have become ready
+        self.pollers = 0 #threads waiting in poll
+
+    def key_lock(self, key):
+        '''
+        The lock for key's entries in connecting_socks and connected_socks, taken
+        after the socket's own lock, before the listener's and the protocol's.
+        '''
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def alloc_port(self, sock):
+        '''
+        Claims a free ephemeral port for sock in bound_ports and returns it.
+        Raises StreamSocket.AddressInUse if every one is taken.
+        '''
+        lo, hi = self.EPHEMERAL_PORTS
+        with self.lock:
+            while self.fresh_ports or self.released:
+                if self.fresh_ports:
+                    self.fresh_ports -= 1
+                    port = lo + self.port_cursor
+                    self.port_cursor = (self.port_cursor + self.port_stride) % (hi - lo + 1)
+                else:
+                    port = self.released.popleft()
+                    self.released_set.discard(port)
+                if port not in self.bound_ports:
+                    self.bound_ports[port] = sock
+                    return port
+        raise StreamSocket.AddressInUse
+
+    def release_port(self, port):
+        '''
+        Hands a port that just left bound_ports back to alloc_port, if it's an
+        ephemeral one (call with lock held).
+        '''
+        lo, hi = self.EPHEMERAL_PORTS
+        if lo <= port <= hi and port not in self.released_set:
+            self.released_set.add(port)
+            self.released.append(port)
+
+    def syn_cookie(self, key, client_isn, peer_mss, csum_id):
+        '''
+        The ISN for a SYNACK that keeps no state - a keyed hash of the connection,
+        the client's ISN and the time, with the MSS and checksum ids in its low bits.
+        '''
+        mss_idx = max(i for i, mss in enumerate(COOKIE_MSS) if mss <= peer_mss)
+        slot = int(self.timers.now() // COOKIE_SLOT) % 32
+        meta = slot << 5 | mss_idx << 2 | csum_id
+        return self.cookie_hash(key, client_isn, meta) << 10 | meta
+
+    def cookie_hash(self, key, client_isn, meta):
+        h = hashlib.blake2s(key=self.cookie_secret, digest_size=4)
+        h.update(repr((key, client_isn, meta)).encode())
+        return int.from_bytes(h.digest(), 'big') >> 10
+
+    def cookie_child(self, seg, raw, key):
+        '''
+        Checks whether seg acks one of our SYN cookies, and if so creates the
+        half-open child its SYN would have, for input to finish the
+        handshake with. Returns the child, or None.
+        '''
+        listener = self.server_sockets.get(key[1])
+        if listener is None or listener.state != 'LISTENING':
+            return None
+        cookie = seq_add(seg.ack, -1)
+        client_isn = seq_add(seg.seq, -1)
+        meta = cookie & 0x3FF
+        slot, mss_idx, csum_id = meta >> 5, meta >> 2 & 0x7, meta & 0x3
+        #a cookie is good for one to two COOKIE_SLOTs
+        age = (int(self.timers.now() // COOKIE_SLOT) - slot) % 32
+        checksum = CHECKSUM_IDS.get(csum_id)
+        if (age > 1 or checksum is None or cookie >> 10 != self.cookie_hash(key, client_isn, meta)
+                or not verify_checksum(raw, checksum)):
+            return None
+        child = listener.new_child(key[2], key[3], cookie, seg.seq, seg.rwnd,
+                                   COOKIE_MSS[mss_idx], csum_id)
+        with self.key_lock(key):
+            if key in self.connected_socks or key in self.connecting_socks:
+                return self.connected_socks.get(key) or self.connecting_socks.get(key)
+            #cookies are for when the backlog is full, so this child doesn't
+            #have to fit in it
+            listener.half_open_add(1, force=True)
+            self.connecting_socks[key] = child
+        return child
+
+    def poll(self, socks, events=POLLIN, timeout=None):
+        '''
+        Waits until one of socks (sockets, or a dict of socket -> events) is
+        ready, like poll(2), and returns (socket, revents) pairs - [] on timeout.
+        '''
+        if not isinstance(socks, dict):
+            socks = dict.fromkeys(socks, events)
+        ready = []
+        def check():
+            ready.clear()
+            for sock, mask in socks.items():
+                revents = sock.poll_events(mask)
+                if revents:
+                    ready.append((sock, revents))
+            return ready
+
+        with self.poll_cond:
+            self.pollers += 1
+            try:
+                self.timers.wait_for(check, self.poll_cond, timeout)
+            finally:
+                self.pollers -= 1
+        return ready
+
+    def wakeup_pollers(self):
+        '''
+        Called by sockets whenever they may have become ready, so poll
+        checks them again.
+        '''
+        if self.pollers:
+            with self.poll_cond:
+                self.poll_cond.notify_all()
+
+    #table lookups here don't lock; changes to them take key_lock (see its
+    #docstring for the lock order)
+    def input(self, raw, rhost):
 
         #we want to perform err check and then send to proper socket
-        #extract fields
+        #decode the header once, everything downstream gets the Segment
         try:
-            ###print("Proto Input: arrived")
-            rport, dport, seq_num, ack_num, flags, data_len, checksum = struct.unpack(HDR_FRMT, seg[:HDR_SIZE])
-            ###print(f"Proto Input: rport-{rport} dport-{dport} seq-{seq_num} ack-num{ack_num} flags-{flags} datalen-{data_len} checksum-{checksum}")
-        except Exception as e: 
-            ###print(f"Proto Input: err while unpacking segment - {e}")
+            seg = Segment(raw)
+        except struct.error:
             return
-        
+        rport, dport, flags = seg.sport, seg.dport, seg.flags
+
         # Prevent loopback: ignore packets sent by this same host+port
         if (rhost, rport) == (self.host.ip, dport):
-            ###print(f"Proto Input: loopback detected on ({rhost}, {rport}) — dropping packet")
-            return
-        #err check
-        if(not verify_checksum(seg)):
-            ###print('wrong checksum')
-            #drop packet
             return
-        
+
+        key = (self.host.ip, dport, rhost, rport)
+
+        #err check - SYNs and SYNACKs are checked with the handshake engine,
+        #everything else with the engine of the connection it's for
+        if flags & SYN:
+            if not verify_checksum(raw, HANDSHAKE_CHECKSUM):
+                #drop packet
+                return
+        else:
+            dest_sock = self.connected_socks.get(key) or self.connecting_socks.get(key)
+            if dest_sock is None and self.SYN_COOKIES and flags & ACK:
+                #maybe the ACK for a SYNACK we sent with a cookie
+                dest_sock = self.cookie_child(seg, raw, key)
+            if dest_sock is None or not verify_checksum(raw, dest_sock.checksum):
+                return
+
         #check if SYN
-        if(flags == 2):
-            ###print("Proto Input: SYN Recieved")
+        if(flags == SYN):
             #demux to listening ports
             dest_sock = self.server_sockets.get(dport)
             if(dest_sock == None):
                 raise RDTSocket.NotBound()
             dest_sock.handle_syn(seg, rhost)
             return
-        #check if SYNACK 
-        elif(flags == 3):
-            ###print(f"Proto Input: SYNACK - looking for key ({dport}, {rhost}, {rport})")
+        #check if SYNACK
+        elif(flags == SYN | ACK):
             # First check if we're still connecting
-            dest_sock = self.connecting_socks.get((self.host.ip, dport, rhost, rport))
+            dest_sock = self.connecting_socks.get(key)
             if dest_sock is not None:
-                ###print(f'Proto Input: placing SYNACK on {dest_sock.port}\'s q ')
-                dest_sock.seg_q.put(seg)
+                seg_q = dest_sock.seg_q
+                if dest_sock.blocking and seg_q is not None:
+                    seg_q.put(seg)
+                elif dest_sock.our_synack(seg):
+                    #nobody waits on a nonblocking connect, finish it here
+                    dest_sock.finish_connect(seg, key)
                 return
-                
+
             # If not in connecting_socks, check if we're already connected
-            dest_sock = self.connected_socks.get((self.host.ip, dport, rhost, rport))
-            if dest_sock is not None:
+            dest_sock = self.connected_socks.get(key)
+            if dest_sock is not None and dest_sock.state == 'CONNECTED':
                 # We already received SYNACK and sent ACK before, but server didn't get it
-                # Resend the ACK
-                flags = 1  # ACK flag
-                data_len = 0
-                precheck = struct.pack(PRECHK_HDR_FRMT, dport, rport, dest_sock.seq_num ^ 1, seq_num ^ 1, flags, data_len)
-                checksum = get_checksum(precheck)
-                ack_seg = struct.pack(HDR_FRMT, dport, rport, dest_sock.seq_num ^ 1, seq_num ^ 1, flags, data_len, checksum[0])
+                # Resend the ACK. Once we're closing the server is past its
+                # handshake, so this SYNACK is from a stale duplicate SYN and
+                # acking it would open a connection nobody is on
+                ack_seg = make_segment(dport, rport, dest_sock.send_base, seq_add(seg.seq, 1), ACK,
+                                       checksum=dest_sock.checksum, rwnd=dest_sock.adv_wnd())
                 dest_sock.output(ack_seg, rhost)
             return
+        elif flags & SYN:
+            return
 
-        #check if handshake ACK 
-
-        ###print(f"Proto Input: ACK - looking for key ({dport}, {rhost}, {rport})")
-        ###print(f"Proto Input: Available connecting keys: {list(self.connecting_socks.keys())}")
-        dest_sock: RDTSocket = self.connecting_socks.pop((self.host.ip, dport, rhost, rport), None)
-
-        if(flags == 1 and dest_sock != None):
-            ###print("Proto Input: handshake ACK found!")
-            
-            # Add to connected sockets before setting event
-            self.connected_socks[(self.host.ip, dport, rhost, rport)] = dest_sock
-            
-            # Put on connection queue first
-            dest_sock.parent.conn_q.put((dest_sock, rhost, rport))
-            dest_sock.last_recieved_num = seq_num
-            #print(f"proto input: last recieved dest sock - {dest_sock.last_recieved_num}")
-            
-            # Set the event last - this unblocks the handle_syn thread
-            dest_sock.parent.ack_event.set()
-
-        else: #data or data ACK recieved
-            #check if there's a conn
-            dest_sock: RDTSocket = self.connected_socks.get((self.host.ip, dport, rhost, rport))
-            if(dest_sock == None):
-                ###print(f"Proto Input: no connected tuple found for ({dport}, {rhost}, {rport}), flags={flags}")
-                return
-            if flags == 1: #ACK recieved, place on seg q
-                dest_sock.seg_q.put(seg)
+        #check if this finishes a handshake - either the handshake ACK or,
+        #if that was lost, the first data segment from the client
+        dest_sock: RDTSocket = self.connecting_socks.get(key)
+        if(dest_sock != None and dest_sock.parent != None):
+            with self.key_lock(key):
+                dest_sock = self.connecting_socks.pop(key, None)
+                if dest_sock is not None:
+                    # Add to connected sockets before setting event
+                    self.connected_socks[key] = dest_sock
+                    dest_sock.parent.half_open_add(-1)
+
+            if dest_sock is not None:
+                # stop the SYNACK resender, a pure handshake ACK also times it,
+                # and let the timer and SYNACK go
+                with dest_sock.lock:
+                    if dest_sock.hs_timer is not None:
+                        dest_sock.hs_timer.cancel()
+                    if flags == ACK and dest_sock.hs_sent is not None:
+                        dest_sock.rtt.sample(self.timers.now() - dest_sock.hs_sent)
+                    dest_sock.hs_timer = dest_sock.hs_seg = None
+                parent = dest_sock.parent
+                with parent.lock:
+                    listening = parent.state == 'LISTENING'
+                    if listening:
+                        parent.conn_q.put((dest_sock, rhost, rport))
+                if listening:
+                    self.wakeup_pollers()
+                else:
+                    #the listener closed while this was half-open
+                    dest_sock.state = 'CONNECTED'
+                    dest_sock.close()
+
+        #data or data ACK recieved
+        #check if there's a conn
+        dest_sock: RDTSocket = self.connected_socks.get(key)
+        if(dest_sock == None):
+            return
+        if flags & ACK:
+            if flags & SACK:
+                dest_sock.handle_ack(seg.ack, seg.seq, seg.rwnd)
             else:
-                #pass to socket
-                #print(f"{dest_sock.port} Proto Input: handing off to socket")
-                dest_sock.handle_data(seg, rhost)
-            
+                dest_sock.handle_ack(seg.ack, None, seg.rwnd, seg.seq)
+        if seg.data_len or flags & FIN or not flags & ACK:
+            #pass to socket
+            dest_sock.handle_data(seg, rhost)
+
+
 
 
-                
 ##HELPERS##
 
-def get_checksum(precheck: bytes) -> bytes:
-    """Return 1-byte checksum as bytes object."""
-    checksum_val = (~(sum(precheck) & 0xFF)) & 0xFF  # invert and mask to 1 byte
-    ##print(f"checksum val: {checksum_val}")
-    ##print(f"precheck no and: {sum(precheck)}")
-    ##print(f"precheck sum: {sum(precheck) & 0xFF}")
-    temp = (sum(precheck)& 0xFF ) + (~(sum(precheck)& 0xFF))
-    ##print(f"temp: {temp}")
-    ##print(f"0xFF: {0xFF}")
-    return bytes([checksum_val])
-
-
-def verify_checksum(segment: bytes) -> bool:
-    """Verify simple 1-byte checksum."""
-    total = sum(segment) & 0xFF
-    ##print(f"total: {total}")
-    return total == 0xFF
\ No newline at end of file
+class Segment:
+    """
+    A received segment, decoded once in RDTProtocol.input and then passed
+    through demux, queues and handlers as is. payload is a memoryview into
+    the raw segment, so nothing is sliced or copied along the way.
+    """
+    __slots__ = ('sport', 'dport', 'seq', 'ack', 'flags', 'data_len', 'rwnd', 'checksum', 'raw', 'payload')
+
+    def __init__(self, raw):
+        (self.sport, self.dport, self.seq, self.ack,
+         self.flags, self.data_len, self.rwnd, self.checksum) = HDR.unpack_from(raw)
+        self.raw = raw
+        self.payload = memoryview(raw)[HDR_SIZE:]
+
+
+class TxSegment:
+    """A sent segment waiting in the send window for its ACK."""
+    __slots__ = ('seq', 'seg', 'deadline', 'sacked')
+
+    def __init__(self, seq, seg, deadline):
+        self.seq = seq
+        self.seg = seg
+        self.deadline = deadline #protocol timer time of the next retransmission
+        self.sacked = False #peer has it buffered (sr only)
+
+
+class RTTEstimator:
+    """
+    Jacobson/Karels smoothed RTT and RTO for one connection (RFC 6298).
+    Callers keep Karn's rule: only segments never retransmitted are sampled.
+    """
+    __slots__ = ('rto_min', 'rto_max', 'srtt', 'rttvar', 'base_rto', 'backoffs')
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+
+    def __init__(self, rto_initial, rto_min, rto_max):
+        self.rto_min = rto_min
+        self.rto_max = rto_max
+        self.srtt = None
+        self.rttvar = None
+        self.base_rto = min(max(rto_initial, rto_min), rto_max)
+        self.backoffs = 0 #consecutive timeouts without progress
+
+    @property
+    def rto(self):
+        """Current timeout in seconds, including any backoff."""
+        return min(self.base_rto * (1 << self.backoffs), self.rto_max)
+
+    def sample(self, rtt):
+        """Fold a measured round trip time (seconds) into the estimate."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.base_rto = min(max(self.srtt + self.K * self.rttvar, self.rto_min), self.rto_max)
+        self.backoffs = 0
+
+    def backoff(self):
+        """Double the RTO after a timeout, up to rto_max."""
+        if self.rto < self.rto_max:
+            self.backoffs += 1
+
+    def reset_backoff(self):
+        """
+        Drop the backoff once an ACK acknowledges new data. Under heavy loss
+        Karn's rule can starve us of samples, so a sample alone isn't enough.
+        """
+        self.backoffs = 0
+
+
+def seq_add(seq, n):
+    """Advance a sequence number by n, wrapping at 32 bits."""
+    return (seq + n) % SEQ_MOD
+
+
+def seq_diff(a, b):
+    """Return how far sequence number a is ahead of b, modulo 2^32."""
+    return (a - b) % SEQ_MOD
+
+
+def parse_syn_opts(payload):
+    """
+    Return (mss, checksum engine id) from a SYN/SYNACK payload. A payload
+    without options gives (MAX_MSS, None).
+    """
+    try:
+        mss, csum_id = struct.unpack_from(SYN_OPTS_FRMT, payload)
+    except struct.error:
+        return MAX_MSS, None
+    return max(mss, 1), csum_id
+
+
+def make_segment(sport, dport, seq_num, ack_num, flags, data=b'', checksum=None, rwnd=0):
+    """
+    Assemble a checksummed segment (header + data) in one bytearray, copying
+    data once. checksum defaults to HANDSHAKE_CHECKSUM, rwnd is our receive window.
+    """
+    seg = bytearray(HDR_SIZE + len(data))
+    HDR.pack_into(seg, 0, sport, dport, seq_num, ack_num, flags, len(data), rwnd, 0)
+    seg[HDR_SIZE:] = data
+    struct.pack_into(CHECKSUM_FRMT, seg, CHECKSUM_OFS, get_checksum(seg, checksum))
+    return seg
+
+
+def get_checksum(segment, checksum=None) -> int:
+    """Return the checksum of a segment, skipping its checksum field."""
+    if checksum is None:
+        checksum = HANDSHAKE_CHECKSUM
+    with memoryview(segment) as view:
+        return checksum.func(view[:CHECKSUM_OFS], view[HDR_SIZE:])
+
+
+def verify_checksum(segment, checksum=None) -> bool:
+    """Verify a segment against the checksum in its header."""
+    stored, = struct.unpack_from(CHECKSUM_FRMT, segment, CHECKSUM_OFS)
+    return get_checksum(segment, checksum) == stored
+
+
+def verify_batch(segments, checksum=None) -> list:
+    """
+    Verify many segments at once, returning a bool for each. Uses the
+    engine's NumPy batch function if it has one and NumPy is installed,
+    otherwise checks them one at a time with verify_checksum.
+    """
+    if checksum is None:
+        checksum = HANDSHAKE_CHECKSUM
+    if checksum.batch is None or np is None or not segments:
+        return [verify_checksum(seg, checksum) for seg in segments]
+    return checksum.batch(segments).tolist()
+
+
+##CHECKSUM ENGINES##
+#each takes the pieces of a segment that are covered by the checksum, in
+#order, and returns a value for the 32 bit checksum field
+
+def sum8_checksum(*pieces) -> int:
+    """The original 1-byte inverted sum. Cheap, but blind to reordered bytes."""
+    return ~sum(sum(piece) for piece in pieces) & 0xFF
+
+
+def inet16_checksum(*pieces) -> int:
+    """
+    16-bit one's complement Internet checksum (RFC 1071), computed as the
+    number mod 0xFFFF. Every piece but the last must have an even length.
+    """
+    total = 0
+    for piece in pieces:
+        if len(piece) % 2:
+            piece = bytes(piece) + b'\0'
+        total += int.from_bytes(piece, 'big')
+    return ~(total % 0xFFFF) & 0xFFFF
+
+
+def crc32_checksum(*pieces) -> int:
+    """CRC-32 via zlib; catches all burst errors up to 32 bits."""
+    crc = 0
+    for piece in pieces:
+        crc = zlib.crc32(piece, crc)
+    return crc
+
+
+def _batch_layout(segments):
+    """
+    Segments joined for the NumPy batch verifiers, each padded to an even
+    length - returns the bytes, the offsets and the checksum fields.
+    """
+    padded = [seg if len(seg) % 2 == 0 else bytes(seg) + b'\0' for seg in segments]
+    lens = np.fromiter(map(len, padded), dtype=np.int64, count=len(padded))
+    starts = np.zeros_like(lens)
+    np.cumsum(lens[:-1], out=starts[1:])
+    data = np.frombuffer(b''.join(padded), dtype=np.uint8)
+    field = data[starts[:, None] + CHECKSUM_OFS + np.arange(4)].astype(np.uint64)
+    stored = field @ np.array([1 << 24, 1 << 16, 1 << 8, 1], dtype=np.uint64)
+    return data, starts, field, stored
+
+
+def sum8_batch(segments):
+    """sum8_checksum over a batch of segments, vectorised with NumPy."""
+    data, starts, field, stored = _batch_layout(segments)
+    #sum everything, then take the checksum field back out
+    sums = np.add.reduceat(data, starts, dtype=np.uint64) - field.sum(axis=1)
+    return (~sums & 0xFF) == stored
+
+
+def inet16_batch(segments):
+    """inet16_checksum over a batch of segments, vectorised with NumPy."""
+    data, starts, field, stored = _batch_layout(segments)
+    words = data.view('>u2')
+    sums = np.add.reduceat(words, starts // 2, dtype=np.uint64)
+    sums -= field @ np.array([1 << 8, 1, 1 << 8, 1], dtype=np.uint64)
+    return (~(sums % 0xFFFF) & 0xFFFF) == stored
+
+
+class ChecksumEngine:
+    """
+    A segment checksum a connection can negotiate in its handshake. ident
+    is what goes on the wire in the SYN options; batch, if set, verifies a
+    list of segments at once and needs NumPy.
+    """
+    __slots__ = ('ident', 'name', 'func', 'batch')
+
+    def __init__(self, ident, name, func, batch=None):
+        self.ident = ident
+        self.name = name
+        self.func = func
+        self.batch = batch
+
+    def __repr__(self):
+        return f'<ChecksumEngine {self.name}>'
+
+
+CHECKSUMS = {engine.name: engine for engine in (
+    ChecksumEngine(1, 'sum8', sum8_checksum, sum8_batch),
+    ChecksumEngine(2, 'inet16', inet16_checksum, inet16_batch),
+    ChecksumEngine(3, 'crc32', crc32_checksum),
+)}
+CHECKSUM_IDS = {engine.ident: engine for engine in CHECKSUMS.values()}
+#SYN and SYNACK always use this, the connection's engine isn't known until
+#the handshake picks it
+HANDSHAKE_CHECKSUM = CHECKSUMS['crc32']
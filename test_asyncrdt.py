@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import sys
+import os.path
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
+
+from network import *
+from asyncrdt import *
+
+import asyncio
+import threading
+import unittest
+
+SERVER = ('10.0.0.1', 8080)
+CLIENT = '10.0.0.2'
+
+
+class AsyncNetworkTest(unittest.IsolatedAsyncioTestCase):
+    """Sets up a server and client host running AsyncRDTProtocol"""
+    PROTO = AsyncRDTProtocol
+    NET = {}
+    QUEUED = False
+
+    async def asyncSetUp(self):
+        self.net = Network(**type(self).NET)
+        self.server = Host(self.net, SERVER[0], queued=type(self).QUEUED)
+        self.client = Host(self.net, CLIENT, queued=type(self).QUEUED)
+        for h in (self.server, self.client):
+            h.register_protocol(type(self).PROTO)
+        self.listener = self.server.socket(self.PROTO.getid())
+        self.listener.bind(SERVER[1])
+        self.listener.listen()
+
+    def socket(self):
+        return self.client.socket(self.PROTO.getid())
+
+    async def connect(self):
+        c = self.socket()
+        (s, _), _ = await asyncio.gather(self.listener.accept(), c.connect(SERVER))
+        return c, s
+
+
+class A_AsyncSocketTest(AsyncNetworkTest):
+    async def test_01_connect(self):
+        c, s = await self.connect()
+        self.assertEqual(c.state, 'CONNECTED')
+        self.assertEqual(s.state, 'CONNECTED')
+        self.assertEqual(s.remote_addr[1], c.port)
+
+    async def test_02_send_recv(self):
+        c, s = await self.connect()
+        await c.send(b'hello')
+        self.assertEqual(await s.recv(), b'hello')
+        await s.sendall(b'world')
+        self.assertEqual(await c.recv_exactly(5), b'world')
+
+    async def test_03_recv_into(self):
+        c, s = await self.connect()
+        await c.send(b'abcdef')
+        buf = bytearray(4)
+        self.assertEqual(await s.recv_into(buf), 4)
+        self.assertEqual(buf, b'abcd')
+        self.assertEqual(await s.recv(), b'ef')
+
+    async def test_04_recv_timeout(self):
+        c, s = await self.connect()
+        with self.assertRaises(StreamSocket.Timeout):
+            await s.recv(timeout=0.01)
+        await c.send(b'late')
+        self.assertEqual(await s.recv(timeout=1), b'late')
+
+    async def test_05_async_for(self):
+        async def serve():
+            got = []
+            async for s, _ in self.listener:
+                got.append(await s.recv_exactly(1))
+                if len(got) == 3:
+                    return sorted(got)
+
+        async def client(i):
+            c = self.socket()
+            await c.connect(SERVER)
+            await c.send(bytes([i]))
+
+        got, *_ = await asyncio.gather(serve(), *(client(i) for i in range(3)))
+        self.assertEqual(got, [b'\x00', b'\x01', b'\x02'])
+
+    async def test_06_no_threads(self):
+        """Thousands of connections on the loop thread, without new threads"""
+        before = set(threading.enumerate())
+
+        async def serve(s):
+            await s.sendall(await s.recv_exactly(4))
+
+        async def client(i):
+            c = self.socket()
+            await c.connect(SERVER)
+            await c.send(i.to_bytes(4, 'big'))
+            return int.from_bytes(await c.recv_exactly(4), 'big')
+
+        async def accept_all(n):
+            tasks = []
+            async for s, _ in self.listener:
+                tasks.append(asyncio.create_task(serve(s)))
+                if len(tasks) == n:
+                    return await asyncio.gather(*tasks)
+
+        n = 1000
+        _, *echoed = await asyncio.gather(accept_all(n), *(client(i) for i in range(n)))
+        self.assertEqual(echoed, list(range(n)))
+        self.assertFalse(set(threading.enumerate()) - before)
+
+    async def test_07_close(self):
+        c, s = await self.connect()
+        await c.send(b'bye')
+        c.close()
+        self.assertEqual(await s.recv(), b'bye')
+        self.assertEqual(await s.recv(), b'')
+        with self.assertRaises(StreamSocket.EndOfStream):
+            await s.recv_exactly(1)
+        # instant links, so the FINs and their ACKs are through already
+        s.close()
+        self.assertEqual(c.state, 'TIME_WAIT')
+        self.assertEqual(s.state, 'CLOSED')
+
+    async def test_08_close_accept(self):
+        accept = asyncio.create_task(self.listener.accept())
+        await asyncio.sleep(0)
+        self.listener.close()
+        with self.assertRaises(StreamSocket.Closed):
+            await accept
+
+
+class B_AsyncLossyTest(AsyncNetworkTest):
+    NET = dict(loss=0.1, per=0.1)
+
+    async def test_01_transfer(self):
+        c, s = await self.connect()
+        data = bytes(range(256)) * 200
+        send = asyncio.create_task(c.sendall(data))
+        self.assertEqual(await s.recv_exactly(len(data)), data)
+        await send
+
+
+class C_AsyncWindowTest(AsyncNetworkTest):
+    class PROTO(AsyncRDTProtocol):
+        ARQ = 'sr'
+        WINDOW = 16
+        SEND_BUFFER = 2 ** 16
+        RECV_BUFFER = 2 ** 13
+
+    async def test_01_flow_control(self):
+        c, s = await self.connect()
+        data = bytes(range(256)) * 1000
+        # send only returns once the reader has freed enough of its window
+        send = asyncio.create_task(c.send(data))
+        got = bytearray()
+        while len(got) < len(data):
+            got += await s.recv(1000)
+        await send
+        await c.flush()
+        self.assertEqual(got, data)
+
+
+class D_AsyncThreadsTest(AsyncNetworkTest):
+    """Segments arriving on other threads are handed over to the loop"""
+    NET = dict(delay=0.002, jitter=0.0005)
+    QUEUED = True
+
+    async def test_01_transfer(self):
+        c, s = await self.connect()
+        data = bytes(range(256)) * 40
+        send = asyncio.create_task(c.sendall(data))
+        self.assertEqual(await s.recv_exactly(len(data)), data)
+        await send
+        await s.sendall(b'back')
+        self.assertEqual(await c.recv(), b'back')
+
+    async def test_02_virtual(self):
+        with self.assertRaises(ValueError):
+            AsyncRDTProtocol(Host(Network(virtual=True), '10.0.0.3'))
+
+
+if __name__ == '__main__':
+    unittest.main()
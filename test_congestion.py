@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import sys
+import os.path
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
+
+from congestion import *
+
+import unittest
+
+MSS = 1000
+
+
+class A_RenoTest(unittest.TestCase):
+    def setUp(self):
+        self.cc = Reno(MSS, 0.0)
+
+    def test_slow_start(self):
+        self.assertEqual(self.cc.cwnd, INITIAL_WINDOW * MSS)
+        self.cc.on_ack(4 * MSS, 0.1, 0.1)
+        self.assertEqual(self.cc.cwnd, 8 * MSS)
+
+    def test_avoidance(self):
+        self.cc.ssthresh = 10 * MSS
+        self.cc.on_ack(8 * MSS, 0.1, 0.1)
+        # 6 segments of slow start, then 2 more bytes-acked at 1/10 MSS each
+        self.assertAlmostEqual(self.cc.cwnd, 10 * MSS + 2 * MSS / 10)
+
+    def test_loss(self):
+        self.cc.cwnd = 20 * MSS
+        self.cc.on_loss(1.0)
+        self.assertEqual(self.cc.ssthresh, 10 * MSS)
+        self.assertEqual(self.cc.cwnd, MSS)
+        self.cc.on_loss(2.0)
+        self.assertEqual(self.cc.ssthresh, 2 * MSS)
+
+
+class B_CubicTest(unittest.TestCase):
+    RTT = 0.1
+
+    def setUp(self):
+        self.cc = Cubic(MSS, 0.0)
+        self.cc.cwnd = 100 * MSS
+        self.cc.on_loss(0.0)
+        # skip the slow start back up to ssthresh
+        self.cc.cwnd = self.cc.ssthresh
+
+    def run_rounds(self, start, end):
+        """Acks a full window every RTT from start to end, returns cwnd in segments"""
+        t = start
+        while t < end:
+            t += self.RTT
+            self.cc.on_ack(self.cc.cwnd, self.RTT, t)
+        return self.cc.cwnd / MSS
+
+    def test_loss(self):
+        self.assertEqual(self.cc.w_max, 100)
+        self.assertAlmostEqual(self.cc.ssthresh, 70 * MSS)
+        self.assertEqual(self.cc.cwnd, 70 * MSS)
+
+    def test_plateau(self):
+        k = (30 / Cubic.C) ** (1 / 3)
+        before = self.run_rounds(0.0, k / 2)
+        self.assertLess(before, 100)
+        self.assertGreater(before, 90)
+        at = self.run_rounds(k / 2, k)
+        self.assertAlmostEqual(at, 100, delta=2)
+        after = self.run_rounds(k, 2 * k)
+        self.assertGreater(after, 110)
+
+    def test_fast_convergence(self):
+        self.cc.on_loss(1.0)
+        # lost again below the old maximum, so give some of it up
+        self.assertAlmostEqual(self.cc.w_max, 70 * (1 + Cubic.BETA) / 2)
+
+
+class C_BBRTest(unittest.TestCase):
+    RTT = 0.01
+    RATE = 1e6
+
+    def setUp(self):
+        self.cc = BBR(MSS, 0.0)
+
+    def run_rounds(self, n, rate=RATE):
+        """Delivers min(cwnd, rate * RTT) bytes per round trip"""
+        t = 0.0
+        for _ in range(n):
+            t += self.RTT
+            self.cc.on_ack(min(self.cc.cwnd, rate * self.RTT), self.RTT, t)
+
+    def test_startup(self):
+        self.cc.on_ack(4 * MSS, self.RTT, self.RTT)
+        self.assertEqual(self.cc.cwnd, 8 * MSS)
+        self.assertFalse(self.cc.filled)
+
+    def test_converge(self):
+        self.run_rounds(50)
+        self.assertTrue(self.cc.filled)
+        self.assertAlmostEqual(self.cc.bw, self.RATE)
+        self.assertAlmostEqual(self.cc.cwnd, BBR.CWND_GAIN * self.RATE * self.RTT)
+
+    def test_ignores_loss(self):
+        self.run_rounds(50)
+        cwnd = self.cc.cwnd
+        self.cc.on_loss(1.0)
+        self.assertEqual(self.cc.cwnd, cwnd)
+
+    def test_loss_ends_startup(self):
+        self.run_rounds(2, rate=self.RATE / 2)
+        self.assertEqual(self.cc.cwnd, 13 * MSS)
+        self.cc.on_loss(1.0)
+        self.assertTrue(self.cc.filled)
+        self.assertAlmostEqual(self.cc.cwnd, BBR.CWND_GAIN * self.RATE / 2 * self.RTT)
+
+
+class D_ControllersTest(unittest.TestCase):
+    def test_registry(self):
+        self.assertEqual(set(CONTROLLERS), {'reno', 'cubic', 'bbr'})
+        for cls in CONTROLLERS.values():
+            cc = cls(MSS, 0.0)
+            self.assertEqual(cc.cwnd, INITIAL_WINDOW * MSS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,9 @@ import os.path
 sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
 
 from network import *
+from exthread import *
 
+import threading
 import unittest
 import unittest.mock as mock
 
@@ -143,6 +145,76 @@ class A2_ErrorNetworkTest(unittest.TestCase):
     def test_90pct(self):
         self._test_corruption(90)
 
+class A3_LinkTest(unittest.TestCase):
+    def test_delay(self):
+        link = Link(delay=0.5)
+        self.assertFalse(link.instant)
+        self.assertEqual(link.schedule(100, 1.0), 1.5)
+
+    def test_jitter(self):
+        link = Link(delay=1.0, jitter=0.25)
+        for i in range(100):
+            self.assertTrue(0.75 <= link.schedule(100, 0.0) <= 1.25)
+
+    def test_rate(self):
+        link = Link(rate=1000)
+        self.assertEqual(link.schedule(500, 0.0), 0.5)
+        self.assertEqual(link.schedule(500, 0.0), 1.0)
+        self.assertEqual(link.schedule(500, 0.25), 1.5)
+        self.assertEqual(link.schedule(500, 3.0), 3.5)
+
+    def test_queue(self):
+        link = Link(delay=1.0, queue=2)
+        self.assertIsNotNone(link.schedule(100, 0.0))
+        self.assertIsNotNone(link.schedule(100, 0.0))
+        self.assertIsNone(link.schedule(100, 0.0))
+        link.delivered()
+        self.assertIsNotNone(link.schedule(100, 0.0))
+
+    def test_reorder(self):
+        link = Link(delay=1.0, rate=1000, reorder=1.0)
+        self.assertEqual(link.schedule(500, 0.0), 0.5)
+
+class A4_DelayedNetworkTest(unittest.TestCase):
+    def setUp(self):
+        self.n = Network(delay=0.02, rate=100000)
+        self.mh = mock.MagicMock(name='host 1', spec=Host)
+        self.mh2 = mock.MagicMock(name='host 2', spec=Host)
+        self.n.attach(self.mh, '192.168.10.1')
+        self.n.attach(self.mh2, '192.168.10.2')
+        self.called = threading.Condition()
+        def input(*args):
+            with self.called:
+                self.called.notify_all()
+        self.mh2.input.side_effect = input
+
+    def wait_calls(self, n):
+        wait_for(self.n.scheduler, lambda: self.mh2.input.call_count >= n, self.called)
+
+    def test_delayed(self):
+        self.n.tx(9, b'test-delayed', '192.168.10.1', '192.168.10.2')
+        self.mh2.input.assert_not_called()
+        self.wait_calls(1)
+        self.mh2.input.assert_called_once_with(9, b'test-delayed', '192.168.10.1')
+        self.mh.input.assert_not_called()
+
+    def test_in_order(self):
+        msgs = [b'test-in-order%d' % i * 10 for i in range(50)]
+        for msg in msgs:
+            self.n.tx(9, msg, '192.168.10.1', '192.168.10.2')
+        self.wait_calls(len(msgs))
+        self.assertEqual([c.args[1] for c in self.mh2.input.call_args_list], msgs)
+
+    def test_links(self):
+        fast = self.n.link('192.168.10.1', '192.168.10.2', delay=0.0, rate=None)
+        self.assertTrue(fast.instant)
+        self.assertTrue(self.n.get_link('192.168.10.2', '192.168.10.1').instant)
+        self.n.tx(9, b'test-fast', '192.168.10.1', '192.168.10.2')
+        self.mh2.input.assert_called_once_with(9, b'test-fast', '192.168.10.1')
+        slow = self.n.link('192.168.10.2', '192.168.10.1', symmetric=False, delay=1.0)
+        self.assertEqual(slow.rate, 100000)
+        self.assertTrue(self.n.get_link('192.168.10.1', '192.168.10.2').instant)
+
 
 class B_HostTest(unittest.TestCase):
     def setUp(self):
@@ -192,6 +264,61 @@ class B_HostTest(unittest.TestCase):
         with self.assertRaises(KeyError):
             s = self.h1.socket(2)
 
+class B2_QueuedHostTest(unittest.TestCase):
+    def setUp(self):
+        self.n = Network()
+        self.h = Host(self.n, '192.168.10.1', queued=True, backlog=2)
+        self.h.register_protocol(PC1)
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.got = []
+        self.got_cond = threading.Condition()
+        def input(data, src):
+            self.entered.set()
+            self.release.wait(5)
+            with self.got_cond:
+                self.got.append(data)
+                self.got_cond.notify_all()
+        PC1.last_inst.input = input
+
+    def wait_got(self, n):
+        wait_for(self.n.scheduler, lambda: len(self.got) >= n, self.got_cond)
+
+    def test_async(self):
+        self.n.tx(1, b'test-async', '192.168.10.2', '192.168.10.1')
+        self.assertTrue(self.entered.wait(5))
+        self.assertEqual(self.got, [])
+        self.release.set()
+        self.wait_got(1)
+        self.assertEqual(self.got, [b'test-async'])
+
+    def test_backlog(self):
+        self.n.tx(1, b'test-backlog0', '192.168.10.2', '192.168.10.1')
+        self.assertTrue(self.entered.wait(5))
+        for i in range(1, 4):
+            self.n.tx(1, b'test-backlog%d' % i, '192.168.10.2', '192.168.10.1')
+        self.assertEqual(self.h.dropped, 1)
+        self.release.set()
+        self.wait_got(3)
+        self.assertEqual(self.got, [b'test-backlog0', b'test-backlog1', b'test-backlog2'])
+
+    def test_virtual(self):
+        with self.assertRaises(ValueError):
+            Host(Network(virtual=True), '192.168.10.3', queued=True)
+
+    def test_idle(self):
+        self.h.IDLE = 0.2
+        self.release.set()
+        self.n.tx(1, b'test-idle0', '192.168.10.2', '192.168.10.1')
+        worker = self.h.worker
+        self.wait_got(1)
+        worker.join(5)
+        self.assertFalse(worker.is_alive())
+        self.assertIsNone(self.h.worker)
+        self.n.tx(1, b'test-idle1', '192.168.10.2', '192.168.10.1')
+        self.wait_got(2)
+        self.assertEqual(self.got, [b'test-idle0', b'test-idle1'])
+
 class C_L3CommTest(unittest.TestCase):
     def setUp(self):
         self.n = Network()
@@ -282,5 +409,77 @@ class H_StreamSocketTest(unittest.TestCase):
         self.assertEqual(self.ss.recv(4), b"lo w")
         self.assertEqual(self.ss.recv(), b"orld")
 
+    def test_recv_blocks(self):
+        t = threading.Timer(0.05, self.ss.deliver, (b"late",))
+        t.start()
+        self.assertEqual(self.ss.recv(), b"late")
+        t.join()
+
+    def test_recv_timeout(self):
+        with self.assertRaises(StreamSocket.Timeout):
+            self.ss.recv(timeout=0.01)
+        self.ss.deliver(b"hello")
+        self.assertEqual(self.ss.recv(timeout=0), b"hello")
+
+    def test_recv_exactly(self):
+        self.ss.deliver(b"hel")
+        t = threading.Timer(0.05, self.ss.deliver, (b"lo world",))
+        t.start()
+        self.assertEqual(self.ss.recv_exactly(5), b"hello")
+        t.join()
+        with self.assertRaises(StreamSocket.Timeout):
+            self.ss.recv_exactly(10, timeout=0.01)
+        self.assertEqual(self.ss.recv(), b" world")
+
+    def test_recv_into(self):
+        self.ss.deliver(b"hello")
+        self.ss.deliver(b" world")
+        buf = bytearray(8)
+        self.assertEqual(self.ss.recv_into(buf), 8)
+        self.assertEqual(buf, b"hello wo")
+        self.assertEqual(self.ss.recv_into(buf, 1), 1)
+        self.assertEqual(buf[:1], b"r")
+        self.assertEqual(self.ss.recv_into(buf), 2)
+        self.assertEqual(buf[:2], b"ld")
+        with self.assertRaises(StreamSocket.Timeout):
+            self.ss.recv_into(buf, timeout=0.01)
+
+    def test_many_chunks(self):
+        for i in range(1000):
+            self.ss.deliver(b"%03d" % i)
+        self.assertEqual(self.ss.recv(4), b"0000")
+        self.assertEqual(self.ss.recv_exactly(5), b"01002")
+        rest = self.ss.recv()
+        self.assertEqual(rest, b"".join(b"%03d" % i for i in range(3, 1000)))
+        self.assertEqual(self.ss.buffered, 0)
+
+    def test_consumed(self):
+        with mock.patch.object(StreamSocket, 'consumed') as consumed:
+            self.ss.deliver(b"hello world")
+            self.ss.recv(3)
+            self.ss.recv_exactly(2)
+            self.ss.recv_into(bytearray(10))
+            self.assertEqual(consumed.call_args_list,
+                             [mock.call(3), mock.call(2), mock.call(6)])
+
+    def test_delivered(self):
+        with mock.patch.object(StreamSocket, 'delivered') as delivered:
+            self.ss.deliver(b"hello")
+            self.ss.deliver(b"")
+            self.ss.deliver_eof()
+            self.assertEqual(delivered.call_count, 2)
+
+    def test_read(self):
+        with self.assertRaises(StreamSocket.Timeout):
+            self.ss.read(timeout=0)
+        self.assertIsNone(self.ss.dataready)
+        self.ss.deliver(b"hello")
+        self.assertEqual(self.ss.read(2, 0), b"he")
+        with self.assertRaises(StreamSocket.Timeout):
+            self.ss.read(5, 0, exactly=True)
+        buf = bytearray(5)
+        self.assertEqual(self.ss.read(0, 0, into=buf), 3)
+        self.assertEqual(buf[:3], b"llo")
+
 if __name__ == '__main__':
     unittest.main()
@@ -2,16 +2,23 @@
 
 import threading
 import unittest
+from unittest import mock
 import random
 import itertools
 import base64
 import sys
 import time
 import os.path
+import struct
+import zlib
+import gc
+import weakref
+import tracemalloc
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
 from network import *
 from rdt import *
+from congestion import CONTROLLERS, INITIAL_WINDOW
 from exthread import *
 
 class BaseNetworkTest(unittest.TestCase):
@@ -21,6 +28,12 @@ class BaseNetworkTest(unittest.TestCase):
     # Provide defaults
     LOSS = 0.00
     PER = 0.00
+    # Link parameters for the network, instant by default
+    LINK = {}
+    # Run the network and every timer on a virtual clock
+    VIRTUAL = False
+    # Give each host an inbound queue and receive worker
+    QUEUED = False
     # List of client socket addresses (bound if port is not None)
     CLIENTS = []
     # List of listening socket addresses (port must be set)
@@ -60,11 +73,13 @@ class BaseNetworkTest(unittest.TestCase):
         pid = type(self).PROTO.getid()
 
         # Create network and hosts
-        n = Network(loss=type(self).LOSS, per=type(self).PER)
+        n = Network(loss=type(self).LOSS, per=type(self).PER, virtual=type(self).VIRTUAL,
+                    **type(self).LINK)
+        self.net = n
         self.h = {}
         # Use set comprehension to eliminate duplicates
         for ip in {fst for fst, _ in itertools.chain(caddrs, laddrs)}:
-            h = Host(n, ip)
+            h = Host(n, ip, queued=type(self).QUEUED)
             h.register_protocol(type(self).PROTO)
             self.h[ip] = h
 
@@ -90,6 +105,17 @@ class BaseNetworkTest(unittest.TestCase):
         self.c = {}
         self.makeconns(conns)
 
+    def wait_for(self, predicate):
+        """Waits until predicate() is true, failing the test after 10 seconds"""
+        wait_for(self.net.scheduler, predicate)
+
+    def recv_total(self, sock, total):
+        """Reads from sock until total bytes have arrived"""
+        data = b''
+        while len(data) < total:
+            data += sock.recv()
+        return data
+
     def test_00_connect(self):
         """Connection setup is successful"""
         pass
@@ -185,6 +211,18 @@ class A0_ErrorChecking(BaseNetworkTest):
                     self.assertEqual(host, type(self).CLIENTS[2][0])
                     self.assertEqual(port, 8383)
 
+    def test_13_connectnotbound(self):
+        """A refused connect leaves no handshake behind and can be retried"""
+        c = self.c['a']
+        with self.assertRaises(StreamSocket.NotBound):
+            c.connect((type(self).LISTEN[0][0], 4455))
+        self.assertEqual(c.state, 'CLOSED')
+        self.assertIsNone(c.hs_timer)
+        self.assertEqual(c.proto.connecting_socks, {})
+        self.assertEqual(c.proto.bound_ports, {})
+        c.connect(type(self).LISTEN[0])
+        self.l['l'].accept()
+
 class A1_Lossless_1x1(BaseNetworkTest):
     CLIENTS = [('192.168.10.1', None), ('192.168.10.2', None)]
     LISTEN = [('192.168.10.1', 26093), ('192.168.10.2', 2531)]
@@ -228,8 +266,8 @@ class A1_Lossless_1x1(BaseNetworkTest):
             self.c['c'].send(b'test-onew')
             self.c['c'].send(b'')
             self.c['c'].send(b'ay-pcs' + str(i).encode())
-            self.assertEqual(self.s['c'].recv(),
-                             b'test-oneway-pcs' + str(i).encode())
+            expected = b'test-oneway-pcs' + str(i).encode()
+            self.assertEqual(self.s['c'].recv_exactly(len(expected)), expected)
 
     def test_05_twoway(self):
         """Data can be sent both directions over a connected socket"""
@@ -320,9 +358,9 @@ class A3_Lossless_1x2(BaseNetworkTest):
             self.c['b'].send(b'_te')
             self.c['b'].send(b'st3-3mux_')
             self.c['a'].send(b'mux2')
-            self.assertEqual(self.s['b'].recv(), b'_test3-3mux_',
+            self.assertEqual(self.s['b'].recv_exactly(12), b'_test3-3mux_',
                              'iteration {}'.format(i))
-            self.assertEqual(self.s['a'].recv(), b'2test-mux2',
+            self.assertEqual(self.s['a'].recv_exactly(10), b'2test-mux2',
                              'iteration {}'.format(i))
 
             self.c['a'].send(b'test2/mux2')
@@ -396,6 +434,18 @@ class A7_Lossless_ManyConns(BaseNetworkTest):
     LISTEN = [('192.168.40.253', 48000 + i) for i in range(10)]
     CONNS = {'{}->{}'.format(i, i % 10): (i, i % 10) for i in range(1000)}
 
+class A8_Lossless_ManyConnsThreads(BaseNetworkTest):
+    CLIENTS = [('192.168.41.253', None) for i in range(200)]
+    LISTEN = [('192.168.41.254', 48000)]
+    CONNS = {}
+
+    def test_01_threads(self):
+        """Thread count does not grow with the number of connections"""
+        self.makeconns({'a': (0, 0)})
+        before = threading.active_count()
+        self.makeconns({str(i): (i, 0) for i in range(1, 200)})
+        self.assertLessEqual(threading.active_count(), before)
+
 class B1_Corrupt02_1x1(A1_Lossless_1x1):
     PER = 0.02
 class B2_Corrupt02_SameHost(A2_Lossless_SameHost):
@@ -508,5 +558,1123 @@ class H7_Corrupt10Lose10_ManyConns(A7_Lossless_ManyConns):
     LOSS = 0.10
     PER = 0.10
 
+class GoBackNProtocol(RDTProtocol):
+    WINDOW = 16
+
+class I1_GoBackN_1x1(BaseNetworkTest):
+    PROTO = GoBackNProtocol
+    CLIENTS = [('10.20.30.1', None)]
+    LISTEN = [('10.20.30.2', 7070)]
+    CONNS = {'c': (0, 0)}
+
+    def test_01_window(self):
+        """Sends return with a full window in flight and the rest buffered"""
+        cs = self.c['c']
+        net = self.h[type(self).CLIENTS[0][0]].net
+        # nothing gets through, so nothing is acked while we send
+        loss, net.loss = net.loss, itertools.repeat(True)
+        msgs = [b'test-gbn' + str(i).encode() for i in range(500)]
+        for msg in msgs:
+            cs.send(msg)
+            self.assertLessEqual(len(cs.unacked), self.PROTO.WINDOW)
+        self.assertEqual(len(cs.unacked), self.PROTO.WINDOW)
+        self.assertTrue(cs.unsent)
+        net.loss = loss
+        expected = b''.join(msgs)
+        self.assertEqual(self.recv_total(self.s['c'], len(expected)), expected)
+
+    def server_stress(self, TOTAL, data):
+        self.received = self.recv_total(self.s['c'], TOTAL)
+
+    def test_02_stress(self):
+        """A lot of data can be pipelined through the window"""
+        MAX, TOTAL = 1400, 2 ** 20
+        data = bytes(random.getrandbits(8) for _ in range(TOTAL))
+        with ExThread(target=self.server_stress, args=(TOTAL, data)):
+            for ofs in range(0, TOTAL, MAX):
+                self.c['c'].send(data[ofs:ofs+MAX])
+        self.assertEqual(self.received, data)
+
+    def test_04_large_write(self):
+        """A single large send is split into segments automatically"""
+        TOTAL = 2 ** 20 + 12345
+        data = os.urandom(TOTAL)
+        with ExThread(target=self.server_stress, args=(TOTAL, data)):
+            self.c['c'].send(data)
+        self.assertEqual(self.received, data)
+
+    def test_05_mss(self):
+        """Both ends send with the smaller of the two advertised MSSs"""
+        self.assertEqual(self.c['c'].send_mss, self.PROTO.MSS)
+        cs = self.h[type(self).CLIENTS[0][0]].socket(IPPROTO_RDT)
+        cs.mss = 300
+        with ExThread(target=cs.connect, args=(type(self).LISTEN[0],)):
+            ss, _ = self.l['c'].accept()
+        self.assertEqual(cs.send_mss, 300)
+        self.assertEqual(ss.send_mss, 300)
+        base = ss.next_seq
+        ss.send(b'mss' * 300)
+        self.assertEqual(seq_diff(ss.next_seq, base), 3)
+        self.assertEqual(self.recv_total(cs, 900), b'mss' * 300)
+
+    def test_06_checksum(self):
+        """The server takes the client's checksum engine if it knows it"""
+        engine = CHECKSUMS[self.PROTO.CHECKSUM]
+        self.assertIs(self.c['c'].checksum, engine)
+        self.assertIs(self.s['c'].checksum, engine)
+        for proposed in CHECKSUMS.values():
+            cs = self.h[type(self).CLIENTS[0][0]].socket(IPPROTO_RDT)
+            cs.checksum = proposed
+            with ExThread(target=cs.connect, args=(type(self).LISTEN[0],)):
+                ss, _ = self.l['c'].accept()
+            self.assertIs(cs.checksum, proposed)
+            self.assertIs(ss.checksum, proposed)
+            ss.send(b'checksum')
+            self.assertEqual(self.recv_total(cs, 8), b'checksum')
+
+class I2_GoBackN_Corrupt10Lose10_1x1(I1_GoBackN_1x1):
+    LOSS = 0.10
+    PER = 0.10
+
+class Sum8Protocol(GoBackNProtocol):
+    CHECKSUM = 'sum8'
+
+class I3_GoBackN_Sum8_Corrupt10Lose10_1x1(I2_GoBackN_Corrupt10Lose10_1x1):
+    PROTO = Sum8Protocol
+
+class SelectiveRepeatProtocol(RDTProtocol):
+    ARQ = 'sr'
+    WINDOW = 16
+
+class J1_SelectiveRepeat_1x1(I1_GoBackN_1x1):
+    PROTO = SelectiveRepeatProtocol
+
+    def test_03_reorder(self):
+        """Out-of-order segments are buffered and delivered as one run"""
+        cs, ss = self.c['c'], self.s['c']
+        base = cs.next_seq
+        segs = [make_segment(cs.port, ss.port, seq_add(base, i), 0, 0,
+                             b'reorder' + str(i).encode(), checksum=cs.checksum)
+                for i in range(3)]
+        host = self.h[type(self).LISTEN[0][0]]
+        host.input(IPPROTO_RDT, segs[2], type(self).CLIENTS[0][0])
+        host.input(IPPROTO_RDT, segs[1], type(self).CLIENTS[0][0])
+        with self.assertRaises(StreamSocket.Timeout):
+            ss.recv(timeout=0)
+        self.assertEqual(len(ss.reorder), 2)
+        host.input(IPPROTO_RDT, segs[0], type(self).CLIENTS[0][0])
+        self.assertEqual(ss.recv(), b'reorder0reorder1reorder2')
+        self.assertEqual(ss.reorder, {})
+
+class J2_SelectiveRepeat_Lose05_1x1(J1_SelectiveRepeat_1x1):
+    LOSS = 0.05
+
+class J3_SelectiveRepeat_Corrupt10Lose10_1x1(J1_SelectiveRepeat_1x1):
+    LOSS = 0.10
+    PER = 0.10
+
+class Inet16Protocol(SelectiveRepeatProtocol):
+    CHECKSUM = 'inet16'
+
+class J4_SelectiveRepeat_Inet16_Corrupt10Lose10_1x1(J3_SelectiveRepeat_Corrupt10Lose10_1x1):
+    PROTO = Inet16Protocol
+
+class K0_RTTEstimator(unittest.TestCase):
+    def setUp(self):
+        self.est = RTTEstimator(1.0, 0.2, 60.0)
+
+    def test_01_initial(self):
+        """RTO starts at the initial value"""
+        self.assertEqual(self.est.rto, 1.0)
+        self.assertIsNone(self.est.srtt)
+
+    def test_02_first_sample(self):
+        """First sample sets SRTT and RTTVAR directly"""
+        self.est.sample(0.5)
+        self.assertAlmostEqual(self.est.srtt, 0.5)
+        self.assertAlmostEqual(self.est.rttvar, 0.25)
+        self.assertAlmostEqual(self.est.rto, 1.5)
+
+    def test_03_smoothing(self):
+        """Later samples are smoothed with alpha and beta"""
+        self.est.sample(0.5)
+        self.est.sample(1.3)
+        self.assertAlmostEqual(self.est.rttvar, 0.75 * 0.25 + 0.25 * 0.8)
+        self.assertAlmostEqual(self.est.srtt, 0.875 * 0.5 + 0.125 * 1.3)
+
+    def test_04_clamp(self):
+        """RTO is kept within the configured bounds"""
+        self.est.sample(0.001)
+        self.assertEqual(self.est.rto, 0.2)
+        self.est.sample(100)
+        self.assertEqual(self.est.rto, 60.0)
+
+    def test_05_backoff(self):
+        """Timeouts double the RTO until a new sample arrives"""
+        self.est.sample(0.5)
+        self.est.backoff()
+        self.assertAlmostEqual(self.est.rto, 3.0)
+        for i in range(10):
+            self.est.backoff()
+        self.assertEqual(self.est.rto, 60.0)
+        self.est.sample(0.5)
+        self.assertAlmostEqual(self.est.rto, 0.5 + 4 * 0.1875)
+
+    def test_06_reset_backoff(self):
+        """Forward progress undoes the backoff without a new sample"""
+        self.est.sample(0.5)
+        self.est.backoff()
+        self.est.backoff()
+        self.assertAlmostEqual(self.est.rto, 6.0)
+        self.est.reset_backoff()
+        self.assertAlmostEqual(self.est.rto, 1.5)
+
+class K1_Segment(unittest.TestCase):
+    def test_01_layout(self):
+        """Segments are header + data with a valid checksum"""
+        seg = make_segment(1234, 80, 7, 9, ACK, memoryview(b'payload'))
+        self.assertEqual(HDR_SIZE, 24)
+        self.assertEqual(CHECKSUM_OFS % 4, 0)
+        self.assertEqual(HDR.unpack_from(seg)[:6], (1234, 80, 7, 9, ACK, 7))
+        self.assertEqual(seg[HDR_SIZE:], b'payload')
+        self.assertTrue(verify_checksum(seg))
+
+    def test_02_corrupt(self):
+        """Single-byte corruption is detected"""
+        seg = make_segment(1234, 80, 7, 9, 0, b'payload')
+        seg[HDR_SIZE + 2] ^= 0x10
+        self.assertFalse(verify_checksum(seg))
+
+    def test_03_parse(self):
+        """Received segments are decoded once, payload without copying"""
+        raw = make_segment(1234, 80, 7, 9, ACK | SACK, b'payload', rwnd=70000)
+        seg = Segment(raw)
+        self.assertEqual((seg.sport, seg.dport, seg.seq, seg.ack, seg.flags, seg.data_len, seg.rwnd),
+                         (1234, 80, 7, 9, ACK | SACK, 7, 70000))
+        self.assertIsInstance(seg.payload, memoryview)
+        self.assertIs(seg.payload.obj, raw)
+        self.assertEqual(seg.payload, b'payload')
+        with self.assertRaises(AttributeError):
+            seg.extra = 1
+
+class K2_Checksum(unittest.TestCase):
+    def segments(self, engine, count=50):
+        rng = random.Random(11)
+        return [make_segment(rng.getrandbits(16), 80, i, 0, 0,
+                             rng.randbytes(rng.randrange(100)), checksum=engine)
+                for i in range(count)]
+
+    def test_01_known_values(self):
+        """Engines match their reference algorithms"""
+        data = b'\x00\x01\xf2\x03\xf4\xf5\xf6\xf7'
+        self.assertEqual(CHECKSUMS['inet16'].func(data), 0x220d)  # RFC 1071 example
+        self.assertEqual(CHECKSUMS['inet16'].func(data[:4], data[4:]), 0x220d)
+        self.assertEqual(CHECKSUMS['crc32'].func(data[:3], data[3:]), zlib.crc32(data))
+        self.assertEqual(CHECKSUMS['sum8'].func(data), ~sum(data) & 0xFF)
+
+    def test_02_roundtrip(self):
+        """Every engine verifies its own segments and no one else's"""
+        for engine in CHECKSUMS.values():
+            for seg in self.segments(engine):
+                self.assertTrue(verify_checksum(seg, engine))
+                seg[HDR_SIZE - 5] ^= 1
+                self.assertFalse(verify_checksum(seg, engine))
+
+    def test_03_swap(self):
+        """Reordered bytes get past sum8 but not CRC32"""
+        for name, missed in (('sum8', True), ('crc32', False)):
+            seg = make_segment(1, 2, 3, 4, 0, b'ab', checksum=CHECKSUMS[name])
+            seg[HDR_SIZE:] = b'ba'
+            self.assertEqual(verify_checksum(seg, CHECKSUMS[name]), missed)
+
+    def test_04_batch(self):
+        """Batch verification agrees with verifying one at a time"""
+        for engine in CHECKSUMS.values():
+            segs = self.segments(engine)
+            for seg in segs[::3]:
+                seg[random.randrange(len(seg))] ^= 0x40
+            self.assertEqual(verify_batch(segs, engine),
+                             [verify_checksum(seg, engine) for seg in segs])
+        self.assertEqual(verify_batch([]), [])
+
+    def test_05_syn_opts(self):
+        """SYN options carry the MSS and checksum engine"""
+        opts = struct.pack(SYN_OPTS_FRMT, 900, CHECKSUMS['inet16'].ident)
+        self.assertEqual(parse_syn_opts(opts), (900, CHECKSUMS['inet16'].ident))
+        self.assertEqual(parse_syn_opts(b''), (MAX_MSS, None))
+
+    @unittest.skipIf(np is None, 'NumPy is not installed')
+    def test_06_numpy_batch(self):
+        """The NumPy batch verifiers agree with verify_checksum"""
+        engines = [engine for engine in CHECKSUMS.values() if engine.batch is not None]
+        self.assertTrue(engines)
+        for engine in engines:
+            segs = self.segments(engine)
+            segs.append(make_segment(1, 2, 3, 4, ACK, checksum=engine))
+            for seg in segs[::3]:
+                seg[random.randrange(len(seg))] ^= 0x40
+            self.assertEqual(engine.batch(segs).tolist(),
+                             [verify_checksum(seg, engine) for seg in segs])
+
+class BufferedProtocol(RDTProtocol):
+    ARQ = 'sr'
+    WINDOW = 16
+    SEND_BUFFER = 2 ** 16
+
+class L1_SendBuffer_1x1(BaseNetworkTest):
+    PROTO = BufferedProtocol
+    CLIENTS = [('10.20.40.1', None)]
+    LISTEN = [('10.20.40.2', 7070)]
+    CONNS = {'c': (0, 0)}
+
+    def test_01_async(self):
+        """Send returns before the data is acked while the buffer has room"""
+        net = self.h[type(self).CLIENTS[0][0]].net
+        loss = net.loss
+        net.loss = itertools.repeat(True)
+        self.c['c'].send(b'test-buffered' * 1000)
+        self.assertEqual(self.c['c'].unacked_bytes + len(self.c['c'].unsent), 13000)
+        net.loss = loss
+        self.c['c'].flush()
+        self.assertEqual(self.c['c'].unacked_bytes, 0)
+        self.assertEqual(self.recv_total(self.s['c'], 13000), b'test-buffered' * 1000)
+
+    def test_04_retx_reuse(self):
+        """Retransmissions resend the segment object built on first send"""
+        net = self.h[type(self).CLIENTS[0][0]].net
+        loss, tx = net.loss, net.tx
+        sent = []
+        def record(proto, data, src, dst):
+            sent.append(data)
+            return tx(proto, data, src, dst)
+        net.loss = itertools.repeat(True)
+        net.tx = record
+        self.c['c'].send(b'test-reuse')
+        seg = self.c['c'].unacked[0].seg
+        def resent():
+            return [d for d in sent if d[HDR_SIZE:] == b'test-reuse']
+        # other segments go out too, so count the data segment's copies
+        self.wait_for(lambda: len(resent()) >= 3)
+        net.loss = loss
+        self.c['c'].flush()
+        net.tx = tx
+        retx = resent()
+        self.assertGreaterEqual(len(retx), 3)
+        for d in retx:
+            self.assertIs(d, seg)
+
+    def test_02_sendall(self):
+        """Sendall returns only once everything is acked"""
+        for i in range(100):
+            self.c['c'].send(b'test-sendall' + str(i).encode())
+        self.c['c'].sendall(b'test-sendall-end')
+        self.assertFalse(self.c['c'].unacked)
+        self.assertFalse(self.c['c'].unsent)
+        expected = b''.join(b'test-sendall' + str(i).encode() for i in range(100))
+        expected += b'test-sendall-end'
+        self.assertEqual(self.recv_total(self.s['c'], len(expected)), expected)
+
+    def server_stress(self, TOTAL):
+        self.received = self.recv_total(self.s['c'], TOTAL)
+
+    def test_03_stress(self):
+        """Many small writes are coalesced and pipelined"""
+        MAX, TOTAL = 100, 2 ** 20
+        data = os.urandom(TOTAL)
+        with ExThread(target=self.server_stress, args=(TOTAL,)):
+            for ofs in range(0, TOTAL, MAX):
+                self.c['c'].send(data[ofs:ofs+MAX])
+            self.c['c'].flush()
+        self.assertEqual(self.received, data)
+
+class L2_SendBuffer_Corrupt10Lose10_1x1(L1_SendBuffer_1x1):
+    LOSS = 0.10
+    PER = 0.10
+
+class DelayedAckProtocol(BufferedProtocol):
+    ACK_EVERY = 4
+
+class M1_DelayedAck_1x1(L1_SendBuffer_1x1):
+    PROTO = DelayedAckProtocol
+
+    def record_acks(self):
+        """Replace net.tx with one that records pure ACKs sent by the server"""
+        net = self.h[type(self).LISTEN[0][0]].net
+        tx = net.tx
+        acks = []
+        def record(proto, data, src, dst):
+            seg = Segment(data)
+            if src == type(self).LISTEN[0][0] and seg.flags & ACK and not seg.data_len:
+                acks.append((seg.ack, seg.seq if seg.flags & SACK else None))
+            return tx(proto, data, src, dst)
+        net.tx = record
+        self.addCleanup(setattr, net, 'tx', tx)
+        return acks
+
+    def test_05_every(self):
+        """In-order segments get one cumulative ACK per ACK_EVERY"""
+        cs, ss = self.c['c'], self.s['c']
+        ss.ack_delay = 60
+        net = self.h[type(self).CLIENTS[0][0]].net
+        loss, per = net.loss, net.per
+        net.loss = net.per = itertools.repeat(False)
+        acks = self.record_acks()
+        base = cs.next_seq
+        cs.sendall(b'x' * cs.send_mss * 8)
+        net.loss, net.per = loss, per
+        self.assertEqual(acks, [(seq_add(base, 4), None), (seq_add(base, 8), None)])
+        self.assertEqual(len(self.recv_total(ss, cs.send_mss * 8)), cs.send_mss * 8)
+
+    def test_06_timer(self):
+        """A lone segment is ACKed once the delay runs out"""
+        cs, ss = self.c['c'], self.s['c']
+        acks = self.record_acks()
+        base = cs.next_seq
+        cs.sendall(b'test-delayed')
+        self.assertEqual(acks[0][0], seq_add(base, 1))
+        self.assertEqual(ss.ack_pending, 0)
+        self.assertEqual(self.recv_total(ss, 12), b'test-delayed')
+
+    def test_07_ack_now(self):
+        """Out-of-order and gap-filling segments are ACKed at once if configured"""
+        cs, ss = self.c['c'], self.s['c']
+        ss.ack_delay = 60
+        acks = self.record_acks()
+        host = self.h[type(self).LISTEN[0][0]]
+        base = cs.next_seq
+        segs = [make_segment(cs.port, ss.port, seq_add(base, i), 0, 0, b'now' + str(i).encode(),
+                             checksum=cs.checksum) for i in range(4)]
+        host.input(IPPROTO_RDT, segs[1], type(self).CLIENTS[0][0])
+        self.assertEqual(acks, [(base, seq_add(base, 1))])
+        host.input(IPPROTO_RDT, segs[0], type(self).CLIENTS[0][0])
+        self.assertEqual(acks[-1], (seq_add(base, 2), None))
+        #without the rules, both wait for the timer
+        ss.ack_now = frozenset()
+        host.input(IPPROTO_RDT, segs[3], type(self).CLIENTS[0][0])
+        host.input(IPPROTO_RDT, segs[2], type(self).CLIENTS[0][0])
+        self.assertEqual(len(acks), 2)
+        self.assertEqual(ss.ack_pending, 2)
+        self.assertEqual(self.recv_total(ss, 16), b'now0now1now2now3')
+
+    def test_08_piggyback(self):
+        """A reply sent before the delayed ACK is due carries the ACK"""
+        cs, ss = self.c['c'], self.s['c']
+        ss.ack_delay = 60
+        acks = self.record_acks()
+        base = cs.next_seq
+        for i in range(10):
+            cs.send(b'request' + str(i).encode())
+            self.assertEqual(self.recv_total(ss, 8), b'request' + str(i).encode())
+            ss.send(b'response' + str(i).encode())
+            self.assertEqual(self.recv_total(cs, 9), b'response' + str(i).encode())
+        cs.flush()
+        ss.flush()
+        self.assertEqual(seq_diff(cs.send_base, base), 10)
+        #lost or corrupted replies make the client retransmit, and those dups get ACKed
+        if not self.LOSS and not self.PER:
+            self.assertEqual(acks, [])
+
+class M2_DelayedAck_Corrupt10Lose10_1x1(M1_DelayedAck_1x1):
+    LOSS = 0.10
+    PER = 0.10
+
+class RenoProtocol(BufferedProtocol):
+    WINDOW = 64
+    CONGESTION = 'reno'
+
+class N1_Reno_1x1(L1_SendBuffer_1x1):
+    PROTO = RenoProtocol
+
+    def test_05_cwnd(self):
+        """No more than cwnd bytes are in flight, and ACKs open it up"""
+        cs = self.c['c']
+        self.assertIsInstance(cs.cc, CONTROLLERS[self.PROTO.CONGESTION])
+        self.assertIsInstance(self.s['c'].cc, CONTROLLERS[self.PROTO.CONGESTION])
+        net = self.h[type(self).CLIENTS[0][0]].net
+        loss = net.loss
+        net.loss = itertools.repeat(True)
+        with cs.lock:
+            cwnd = cs.cc.cwnd
+        cs.send(b'x' * cs.send_mss * 32)
+        self.assertLessEqual(cs.unacked_bytes, cwnd)
+        self.assertLess(len(cs.unacked), 32)
+        net.loss = loss
+        cs.flush()
+        self.assertEqual(len(self.recv_total(self.s['c'], cs.send_mss * 32)), cs.send_mss * 32)
+
+    def test_06_growth(self):
+        """A clean bulk transfer grows the window past its initial size"""
+        cs = self.c['c']
+        net = self.h[type(self).CLIENTS[0][0]].net
+        loss, per = net.loss, net.per
+        net.loss = net.per = itertools.repeat(False)
+        with ExThread(target=self.server_stress, args=(2 ** 18,)):
+            cs.sendall(b'x' * 2 ** 18)
+        net.loss, net.per = loss, per
+        self.assertGreater(cs.cc.cwnd, INITIAL_WINDOW * cs.send_mss)
+
+class N2_Reno_Corrupt10Lose10_1x1(N1_Reno_1x1):
+    LOSS = 0.10
+    PER = 0.10
+
+class CubicProtocol(RenoProtocol):
+    CONGESTION = 'cubic'
+
+class N3_Cubic_1x1(N1_Reno_1x1):
+    PROTO = CubicProtocol
+
+class N4_Cubic_Corrupt10Lose10_1x1(N3_Cubic_1x1):
+    LOSS = 0.10
+    PER = 0.10
+
+class BBRProtocol(RenoProtocol):
+    CONGESTION = 'bbr'
+
+class N5_BBR_1x1(N1_Reno_1x1):
+    PROTO = BBRProtocol
+
+    def test_06_growth(self):
+        """The window settles on twice the measured bandwidth-delay product"""
+        cs = self.c['c']
+        with ExThread(target=self.server_stress, args=(2 ** 18,)):
+            cs.sendall(b'x' * 2 ** 18)
+        with cs.lock:
+            self.assertTrue(cs.cc.filled)
+            self.assertGreater(cs.cc.bw, 0)
+            self.assertEqual(cs.cc.cwnd, cs.cc.bdp_window())
+
+class N6_BBR_Corrupt10Lose10_1x1(N5_BBR_1x1):
+    LOSS = 0.10
+    PER = 0.10
+
+class FlowControlProtocol(BufferedProtocol):
+    RECV_BUFFER = 2 ** 14
+
+class O1_FlowControl_1x1(L1_SendBuffer_1x1):
+    PROTO = FlowControlProtocol
+
+    def test_05_bounded(self):
+        """A reader that falls behind holds back the sender"""
+        cs, ss = self.c['c'], self.s['c']
+        data = os.urandom(self.PROTO.RECV_BUFFER * 2)
+        cs.send(data)
+        self.wait_for(lambda: cs.snd_wnd == 0 and not cs.unacked)
+        self.assertLessEqual(ss.buffered, self.PROTO.RECV_BUFFER)
+        self.assertTrue(cs.unsent)
+        self.assertEqual(self.recv_total(ss, len(data)), data)
+        cs.flush()
+
+    def test_06_probe(self):
+        """A lost window update is recovered by the zero window probe"""
+        cs, ss = self.c['c'], self.s['c']
+        net = self.h[type(self).CLIENTS[0][0]].net
+        half = self.PROTO.RECV_BUFFER
+        data = os.urandom(half * 2)
+        cs.send(data)
+        self.wait_for(lambda: cs.snd_wnd == 0 and not cs.unacked)
+        loss = net.loss
+        net.loss = itertools.repeat(True)
+        first = ss.recv_exactly(half)
+        net.loss = loss
+        self.assertEqual(cs.snd_wnd, 0)
+        self.assertEqual(first + self.recv_total(ss, half), data)
+        cs.flush()
+
+    def test_07_stale_window(self):
+        """A replayed old segment doesn't undo a newer window update"""
+        cs, ss = self.c['c'], self.s['c']
+        def from_server(seq, flags, data=b'', rwnd=0):
+            seg = make_segment(ss.port, cs.port, seq, cs.send_base, flags, data,
+                               checksum=ss.checksum, rwnd=rwnd)
+            cs.proto.input(bytes(seg), ss.proto.host.ip)
+        old = ss.next_seq
+        from_server(old, ACK, b'old', rwnd=100)
+        self.assertEqual(cs.snd_wnd, 100)
+        self.assertEqual(cs.recv(), b'old')
+        from_server(seq_add(old, 1), ACK, rwnd=50000)
+        self.assertEqual(cs.snd_wnd, 50000)
+        # the data segment again, as if retransmitted, still says 100
+        from_server(old, ACK, b'old', rwnd=100)
+        self.assertEqual(cs.snd_wnd, 50000)
+
+class O2_FlowControl_Corrupt10Lose10_1x1(O1_FlowControl_1x1):
+    LOSS = 0.10
+    PER = 0.10
+
+class P1_Link_1x1(L1_SendBuffer_1x1):
+    PROTO = RenoProtocol
+    LINK = dict(delay=0.002, jitter=0.0005, rate=2e7, queue=64, reorder=0.01)
+
+    def test_05_rtt(self):
+        """The RTT estimate reflects the propagation delay"""
+        cs = self.c['c']
+        data = os.urandom(2 ** 16)
+        with ExThread(target=self.server_stress, args=(len(data),)):
+            cs.sendall(data)
+        self.assertEqual(self.received, data)
+        # the odd reordered segment skips the delay, so allow for those
+        with cs.lock:
+            self.assertGreater(cs.rtt.srtt, self.LINK['delay'])
+
+class Q1_Virtual_Corrupt10Lose10_1x1(H1_Corrupt10Lose10_1x1):
+    VIRTUAL = True
+class Q2_Virtual_Corrupt10Lose10_1x2(H3_Corrupt10Lose10_1x2):
+    VIRTUAL = True
+class Q3_Virtual_Corrupt10Lose10_2x1(H5_Corrupt10Lose10_2x1):
+    VIRTUAL = True
+class Q4_Virtual_SendBuffer_Corrupt10Lose10_1x1(L2_SendBuffer_Corrupt10Lose10_1x1):
+    VIRTUAL = True
+
+class Q5_Virtual_Link_1x1(P1_Link_1x1):
+    VIRTUAL = True
+    LINK = dict(delay=0.01, jitter=0.002, rate=1e6, queue=64, reorder=0.01)
+
+    def test_06_virtual_time(self):
+        """Simulated delays pass in virtual time, not real time"""
+        cs = self.c['c']
+        clock = self.h[type(self).CLIENTS[0][0]].net.scheduler.clock
+        data = os.urandom(2 ** 20)
+        start, real = clock(), time.monotonic()
+        with ExThread(target=self.server_stress, args=(len(data),)):
+            cs.sendall(data)
+        self.assertEqual(self.received, data)
+        # at least the serialization time at 1 MB/s plus a one-way delay
+        self.assertGreater(clock() - start, len(data) / 1e6 + 0.008)
+        self.assertLess(time.monotonic() - real, clock() - start)
+
+class R1_Queued_Corrupt10Lose10_1x1(H1_Corrupt10Lose10_1x1):
+    QUEUED = True
+class R2_Queued_Corrupt10Lose10_2x1(H5_Corrupt10Lose10_2x1):
+    QUEUED = True
+class R3_Queued_ManyConnsThreads(A8_Lossless_ManyConnsThreads):
+    QUEUED = True
+class R4_Queued_SendBuffer_Corrupt10Lose10_1x1(L2_SendBuffer_Corrupt10Lose10_1x1):
+    QUEUED = True
+class R5_Queued_Link_1x1(P1_Link_1x1):
+    QUEUED = True
+
+class PollProtocol(RDTProtocol):
+    SEND_BUFFER = 2 ** 12
+    RECV_BUFFER = 2 ** 12
+
+class S1_Poll_ManyConns(BaseNetworkTest):
+    PROTO = PollProtocol
+    CLIENTS = [('10.30.40.1', None) for i in range(50)]
+    LISTEN = [('10.30.40.2', 7070)]
+    CONNS = {i: (i, 0) for i in range(50)}
+
+    def client_send(self, msg):
+        for n, c in self.c.items():
+            c.sendall(msg + str(n).encode())
+
+    def test_01_readable(self):
+        """One thread reads every connection as poll reports it readable"""
+        socks = {self.s[n]: n for n in self.c}
+        for sock in socks:
+            sock.setblocking(False)
+        proto = self.s[0].proto
+        self.assertEqual(proto.poll(list(socks), timeout=0), [])
+        expected = {n: b'test-poll' + str(n).encode() for n in self.c}
+        received = {n: b'' for n in self.c}
+        with ExThread(target=self.client_send, args=(b'test-poll',)):
+            while received != expected:
+                for sock, revents in proto.poll(list(socks)):
+                    self.assertEqual(revents, POLLIN)
+                    received[socks[sock]] += sock.recv()
+        self.assertEqual(received, expected)
+        with self.assertRaises(StreamSocket.WouldBlock):
+            self.s[0].recv()
+
+    def test_02_accept(self):
+        """A nonblocking connect is reported writable, the listener readable"""
+        ls, c = self.l[0], self.h[type(self).CLIENTS[0][0]].socket(self.PROTO.getid())
+        ls.setblocking(False)
+        c.setblocking(False)
+        with self.assertRaises(StreamSocket.WouldBlock):
+            ls.accept()
+        try:
+            c.connect(type(self).LISTEN[0])
+        except StreamSocket.WouldBlock:
+            pass
+        self.assertEqual(c.proto.poll([c], POLLOUT, timeout=5), [(c, POLLOUT)])
+        self.assertEqual(ls.proto.poll([ls], timeout=5), [(ls, POLLIN)])
+        s, _ = ls.accept()
+        c.send(b'test-accept')
+        self.assertEqual(self.recv_total(s, 11), b'test-accept')
+
+    def test_03_writable(self):
+        """send would block while the peer's window and our buffer are full"""
+        c, s = self.c[0], self.s[0]
+        proto = c.proto
+        c.setblocking(False)
+        data = os.urandom(2 ** 14)
+        c.send(data)
+        self.assertEqual(proto.poll([c], POLLOUT, timeout=0.01), [])
+        with self.assertRaises(StreamSocket.WouldBlock):
+            c.send(b'more')
+        with self.assertRaises(StreamSocket.WouldBlock):
+            c.flush()
+        received = self.recv_total(s, len(data))
+        self.assertEqual(proto.poll([c], POLLOUT, timeout=5), [(c, POLLOUT)])
+        self.assertEqual(received, data)
+
+    def test_04_error(self):
+        """A socket that isn't connected is reported with POLLERR"""
+        c = self.h[type(self).CLIENTS[0][0]].socket(self.PROTO.getid())
+        self.assertEqual(c.proto.poll([c], POLLIN | POLLOUT, timeout=0), [(c, POLLERR)])
+
+class S2_Poll_Corrupt10Lose10_ManyConns(S1_Poll_ManyConns):
+    LOSS = 0.10
+    PER = 0.10
+
+class CloseProtocol(BufferedProtocol):
+    RTO_MAX = 0.02
+    TIME_WAIT = 0.05
+    # the last ACK can still get lost every time the FIN is resent
+    CLOSE_TIMEOUT = 1.0
+    # and a late duplicate SYN leaves a half-open child behind
+    HANDSHAKE_TIMEOUT = 1.0
+
+class T1_Close_1x1(BaseNetworkTest):
+    PROTO = CloseProtocol
+    CLIENTS = [('10.40.40.1', None)]
+    LISTEN = [('10.40.40.2', 7070)]
+    CONNS = {'c': (0, 0)}
+
+    def tables_empty(self, sock):
+        proto = sock.proto
+        return not (proto.connected_socks or proto.connecting_socks
+                    or set(proto.bound_ports) - set(proto.server_sockets))
+
+    def test_01_eof(self):
+        """The peer reads everything sent before close, then b''"""
+        c, s = self.c['c'], self.s['c']
+        c.send(b'test-close' * 100)
+        c.close()
+        self.assertEqual(self.recv_total(s, 1000), b'test-close' * 100)
+        self.assertEqual(s.recv(), b'')
+        self.assertEqual(s.recv(), b'')
+        with self.assertRaises(StreamSocket.NotConnected):
+            c.send(b'test-closed')
+        s.close()
+        self.wait_for(lambda: s.state == 'CLOSED' and c.state == 'CLOSED')
+        self.assertTrue(self.tables_empty(c))
+        self.assertTrue(self.tables_empty(s))
+
+    def test_02_time_wait(self):
+        """Whoever closes first lingers in TIME_WAIT, holding its port"""
+        c, s = self.c['c'], self.s['c']
+        # long enough to outlast the client's close, however lossy
+        s.proto.TIME_WAIT = 0.5
+        s.close()
+        self.assertEqual(c.recv(), b'')
+        c.close()
+        self.wait_for(lambda: c.state == 'CLOSED')
+        self.assertTrue(self.tables_empty(c))
+        self.assertEqual(s.state, 'TIME_WAIT')
+        self.assertIn(s, s.proto.connected_socks.values())
+        self.wait_for(lambda: s.state == 'CLOSED')
+        self.assertTrue(self.tables_empty(s))
+
+    def test_03_simultaneous(self):
+        """Both sides closing at once both end up closed"""
+        c, s = self.c['c'], self.s['c']
+        c.close()
+        s.close()
+        self.wait_for(lambda: s.state == 'CLOSED' and c.state == 'CLOSED')
+        self.assertTrue(self.tables_empty(c))
+        self.assertTrue(self.tables_empty(s))
+
+    def test_04_end_of_stream(self):
+        """recv_exactly can't be satisfied once the stream has ended"""
+        c, s = self.c['c'], self.s['c']
+        c.send(b'short')
+        c.close()
+        with self.assertRaises(StreamSocket.EndOfStream):
+            s.recv_exactly(10)
+        self.assertEqual(s.recv_exactly(5), b'short')
+
+    def test_05_listener(self):
+        """A closed listener releases its port"""
+        ip, port = type(self).LISTEN[0]
+        self.l['c'].close()
+        proto = self.l['c'].proto
+        self.assertNotIn(port, proto.server_sockets)
+        self.assertNotIn(port, proto.bound_ports)
+        ls = self.h[ip].socket(self.PROTO.getid())
+        ls.bind(port)
+        ls.listen()
+
+    def test_06_reclaim(self):
+        """Short connections leave nothing behind once closed"""
+        cip, lip = type(self).CLIENTS[0][0], type(self).LISTEN[0]
+        pid = self.PROTO.getid()
+        socks = []
+        #all on this thread, so a virtual clock only moves while we wait
+        for i in range(200):
+            c = self.h[cip].socket(pid)
+            c.connect(lip)
+            c.send(b'test-reclaim')
+            c.close()
+            s, _ = self.l['c'].accept()
+            self.assertEqual(s.recv_exactly(12), b'test-reclaim')
+            self.assertEqual(s.recv(), b'')
+            s.close()
+            socks += [weakref.ref(c), weakref.ref(s)]
+        del c, s
+        self.c['c'].close()
+        self.s['c'].close()
+        self.wait_for(lambda: self.tables_empty(self.l['c']) and self.tables_empty(self.c['c']))
+        def collected():
+            gc.collect()
+            return not any(ref() for ref in socks)
+        self.wait_for(collected)
+
+    def test_07_reuse(self):
+        """A closed socket can't connect again on the port it gave back"""
+        c, s = self.c['c'], self.s['c']
+        lip = type(self).LISTEN[0]
+        c.close()
+        s.close()
+        self.wait_for(lambda: c.state == 'CLOSED' and s.state == 'CLOSED')
+        self.assertNotIn(c.port, c.proto.bound_ports)
+        for call in (lambda: c.connect(lip), lambda: c.bind(7071), c.listen):
+            with self.assertRaises(StreamSocket.Closed):
+                call()
+        self.assertTrue(self.tables_empty(c))
+        # the port is free for a new socket
+        c2 = c.proto.socket()
+        c2.bind(c.port)
+        c2.connect(lip)
+        self.l['c'].accept()
+
+    def test_08_handshake_timeout(self):
+        """connect gives up once nothing has answered for HANDSHAKE_TIMEOUT"""
+        cip, lip = type(self).CLIENTS[0][0], type(self).LISTEN[0]
+        net = self.h[cip].net
+        c = self.h[cip].socket(self.PROTO.getid())
+        loss, net.loss = net.loss, itertools.repeat(True)
+        with self.assertRaises(StreamSocket.Timeout):
+            c.connect(lip)
+        net.loss = loss
+        self.assertEqual(c.state, 'CLOSED')
+        self.assertIsNone(c.port)
+        self.assertNotIn(c, c.proto.connecting_socks.values())
+        c.connect(lip)
+        self.l['c'].accept()
+
+    def test_09_close_wakes(self):
+        """Closing from another thread wakes a blocked flush, recv or accept"""
+        c, s, l = self.c['c'], self.s['c'], self.l['c']
+        # nothing gets through, so flush and recv only end with the close
+        self.net.loss = itertools.repeat(True)
+        c.send(b'test-wake')
+        with ExThread(target=c.close):
+            with self.assertRaises(StreamSocket.Closed):
+                c.flush()
+        with ExThread(target=s.close):
+            self.assertEqual(s.recv(), b'')
+        with ExThread(target=l.close):
+            with self.assertRaises(StreamSocket.Closed):
+                l.accept()
+
+class T2_Close_Corrupt10Lose10_1x1(T1_Close_1x1):
+    LOSS = 0.10
+    PER = 0.10
+
+class T3_Virtual_Close_Corrupt10Lose10_1x1(T2_Close_Corrupt10Lose10_1x1):
+    VIRTUAL = True
+
+class PortsProtocol(CloseProtocol):
+    EPHEMERAL_PORTS = (50000, 50003)
+
+class U0_EphemeralPorts(unittest.TestCase):
+    def setUp(self):
+        self.proto = PortsProtocol(Host(Network(), '10.50.50.1'))
+
+    def test_01_exhaust(self):
+        """Every port is handed out once, then AddressInUse"""
+        socks = [object() for _ in range(4)]
+        ports = [self.proto.alloc_port(sock) for sock in socks]
+        self.assertEqual(sorted(ports), [50000, 50001, 50002, 50003])
+        self.assertEqual([self.proto.bound_ports[p] for p in ports], socks)
+        with self.assertRaises(StreamSocket.AddressInUse):
+            self.proto.alloc_port(object())
+
+    def test_02_release_fifo(self):
+        """A released port goes behind the ones never used"""
+        first = self.proto.alloc_port(object())
+        with self.proto.lock:
+            del self.proto.bound_ports[first]
+            self.proto.release_port(first)
+            self.proto.release_port(first)
+        ports = [self.proto.alloc_port(object()) for _ in range(4)]
+        self.assertNotIn(first, ports[:3])
+        self.assertEqual(ports[3], first)
+
+    def test_03_skip_bound(self):
+        """Ports bound explicitly are never handed out"""
+        for port in (50000, 50002):
+            self.proto.socket().bind(port)
+        ports = {self.proto.alloc_port(object()) for _ in range(2)}
+        self.assertEqual(ports, {50001, 50003})
+        with self.assertRaises(StreamSocket.AddressInUse):
+            self.proto.alloc_port(object())
+
+    def test_04_threads(self):
+        """Concurrent connects never share a port"""
+        class ManyPorts(RDTProtocol):
+            EPHEMERAL_PORTS = (49152, 65535)
+        proto = ManyPorts(Host(Network(), '10.50.50.2'))
+        got = [[] for _ in range(8)]
+        def alloc(out):
+            for i in range(1000):
+                out.append(proto.alloc_port(object()))
+        threads = [ExThread(target=alloc, args=(out,)) for out in got]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ports = [p for out in got for p in out]
+        self.assertEqual(len(set(ports)), len(ports))
+
+    def test_05_cheap(self):
+        """A protocol doesn't pay for its ephemeral range up front"""
+        class ManyPorts(RDTProtocol):
+            EPHEMERAL_PORTS = (1024, 65535)
+        host = Host(Network(), '10.50.50.3')
+        tracemalloc.start()
+        try:
+            proto = ManyPorts(host)
+            used = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(used, 32 * 1024)
+        ports = {proto.alloc_port(object()) for _ in range(65535 - 1024 + 1)}
+        self.assertEqual(ports, set(range(1024, 65536)))
+
+class U1_EphemeralPorts_1x1(BaseNetworkTest):
+    PROTO = PortsProtocol
+    CLIENTS = [('10.50.50.1', None)]
+    LISTEN = [('10.50.50.2', 7070)]
+    CONNS = {}
+
+    def test_01_reuse(self):
+        """Ports come back once TIME_WAIT is over, not before"""
+        cip, lip = type(self).CLIENTS[0][0], type(self).LISTEN[0]
+        pid = self.PROTO.getid()
+        for i in range(3):
+            conns = []
+            for _ in range(4):
+                c = self.h[cip].socket(pid)
+                c.connect(lip)
+                s, _ = self.lsocks[lip].accept()
+                conns.append((c, s))
+            with self.assertRaises(StreamSocket.AddressInUse):
+                self.h[cip].socket(pid).connect(lip)
+            for c, s in conns:
+                c.close()
+                s.close()
+            self.assertEqual({c.state for c, _ in conns}, {'TIME_WAIT'})
+            with self.assertRaises(StreamSocket.AddressInUse):
+                self.h[cip].socket(pid).connect(lip)
+            self.wait_for(lambda: all(c.state == 'CLOSED' for c, _ in conns))
+
+class U2_Virtual_EphemeralPorts_1x1(U1_EphemeralPorts_1x1):
+    VIRTUAL = True
+
+class BacklogProtocol(RDTProtocol):
+    SYN_BACKLOG = 4
+
+class CookieProtocol(RDTProtocol):
+    SYN_COOKIES = 'always'
+
+class V0_SynBacklog(unittest.TestCase):
+    """SYNs from a client address nobody answers for, so the listener's
+    SYNACKs go nowhere"""
+    PROTO = BacklogProtocol
+    CLIENT = '10.60.60.9'
+
+    def setUp(self):
+        self.host = Host(Network(), '10.60.60.1')
+        self.host.register_protocol(self.PROTO)
+        self.proto = self.host.protos[self.PROTO.getid()]
+        self.listener = self.proto.socket()
+        self.listener.bind(7070)
+        self.listener.listen()
+
+    def syn(self, port, seq=0):
+        seg = make_segment(port, 7070, seq, 0, SYN, struct.pack(SYN_OPTS_FRMT, 1400, 3))
+        self.proto.input(bytes(seg), self.CLIENT)
+
+    def ack(self, port, seq, ack):
+        seg = make_segment(port, 7070, seq, ack, ACK, checksum=CHECKSUMS['crc32'])
+        self.proto.input(bytes(seg), self.CLIENT)
+
+    def test_01_duplicates(self):
+        """Resent SYNs reuse the half-open child"""
+        created = []
+        cls = type(self.listener)
+        new_child = cls.new_child
+        def counting(*args):
+            created.append(new_child(*args))
+            return created[-1]
+        with mock.patch.object(cls, 'new_child', counting):
+            for _ in range(5):
+                self.syn(50000)
+        self.assertEqual(len(created), 1)
+        self.assertEqual(list(self.proto.connecting_socks.values()), created)
+        self.assertEqual(self.listener.half_open, 1)
+
+    def test_02_bounded(self):
+        """SYNs past the backlog are dropped until a handshake finishes"""
+        for port in range(50000, 50010):
+            self.syn(port)
+        self.assertEqual(len(self.proto.connecting_socks), 4)
+        self.assertEqual(self.listener.half_open, 4)
+        self.ack(50000, 1, 1)
+        self.assertEqual(self.listener.half_open, 3)
+        self.assertEqual(self.listener.conn_q.qsize(), 1)
+        self.syn(50009)
+        self.assertEqual(self.listener.half_open, 4)
+        self.assertIn(('10.60.60.1', 7070, self.CLIENT, 50009), self.proto.connecting_socks)
+
+    def test_03_cookies(self):
+        """With cookies there's no state until a valid ACK comes in"""
+        self.proto.SYN_COOKIES = 'always'
+        self.syn(50000, seq=1000)
+        self.assertEqual(self.proto.connecting_socks, {})
+        self.assertEqual(self.listener.half_open, 0)
+        key = ('10.60.60.1', 7070, self.CLIENT, 50000)
+        cookie = self.proto.syn_cookie(key, 1000, 1400, 3)
+        #a wrong cookie, or the right one from elsewhere, is ignored
+        self.ack(50000, 1001, seq_add(cookie, 2))
+        self.ack(50001, 1001, seq_add(cookie, 1))
+        self.assertEqual(self.listener.conn_q.qsize(), 0)
+        self.ack(50000, 1001, seq_add(cookie, 1))
+        self.assertEqual(self.listener.conn_q.qsize(), 1)
+        s, addr = self.listener.accept()
+        self.assertEqual(addr, (self.CLIENT, 50000))
+        self.assertEqual((s.isn, s.rcv_next, s.send_mss), (cookie, 1001, 1400))
+        self.assertEqual(self.listener.half_open, 0)
+
+    def test_04_overflow(self):
+        """'overflow' only falls back to cookies once the backlog is full"""
+        self.proto.SYN_COOKIES = 'overflow'
+        for port in range(50000, 50006):
+            self.syn(port)
+        self.assertEqual(len(self.proto.connecting_socks), 4)
+        key = ('10.60.60.1', 7070, self.CLIENT, 50005)
+        self.ack(50005, 1, seq_add(self.proto.syn_cookie(key, 0, 1400, 3), 1))
+        self.assertEqual(self.listener.conn_q.qsize(), 1)
+
+class V1_Cookies_1x1(A1_Lossless_1x1):
+    PROTO = CookieProtocol
+
+class V2_Cookies_ManyConns(A7_Lossless_ManyConns):
+    class PROTO(BacklogProtocol):
+        SYN_BACKLOG = 0
+        SYN_COOKIES = 'overflow'
+
+class W1_ParallelHandshakes_Corrupt10Lose10(BaseNetworkTest):
+    LOSS = 0.10
+    PER = 0.10
+    CLIENTS = [('10.70.70.{}'.format(i % 4 + 1), None) for i in range(64)]
+    LISTEN = [('10.70.70.100', 7070)]
+
+    def test_01_handshakes(self):
+        """Handshakes racing on one listener each finish on their own child"""
+        lip = type(self).LISTEN[0]
+        listener = self.lsocks[lip]
+        start = threading.Barrier(len(self.csocks) + 1)
+        def client(c, i):
+            start.wait()
+            c.connect(lip)
+            c.send(struct.pack('!I', i))
+        threads = [ExThread(target=client, args=(c, i)) for i, c in enumerate(self.csocks)]
+        for t in threads:
+            t.start()
+        start.wait()
+        got = {}
+        for _ in threads:
+            s, (host, port) = listener.accept()
+            got[host, port] = struct.unpack('!I', s.recv_exactly(4))[0]
+        for t in threads:
+            t.join()
+        self.assertEqual(got, {(c.proto.host.ip, c.port): i for i, c in enumerate(self.csocks)})
+        self.assertEqual(listener.proto.connecting_socks, {})
+        self.assertEqual(listener.half_open, 0)
+
+    def test_02_key_lock(self):
+        """A key always maps to the same stripe"""
+        proto = self.lsocks[type(self).LISTEN[0]].proto
+        key = ('10.70.70.100', 7070, '10.70.70.1', 50000)
+        self.assertIs(proto.key_lock(key), proto.key_lock(tuple(list(key))))
+        self.assertEqual(len({id(proto.key_lock(key[:3] + (p,))) for p in range(50000, 51000)}),
+                         proto.DEMUX_STRIPES)
+
+class X0_ConnectionMemory(unittest.TestCase):
+    """Idle connections hold no queues, conditions or buffers"""
+
+    def setUp(self):
+        net = Network()
+        self.server = Host(net, '10.80.80.1')
+        self.client = Host(net, '10.80.80.2')
+        for h in (self.server, self.client):
+            h.register_protocol(RDTProtocol)
+        self.listener = self.server.socket(IPPROTO_RDT)
+        self.listener.bind(8080)
+        self.listener.listen()
+
+    def connect(self):
+        c = self.client.socket(IPPROTO_RDT)
+        c.connect(('10.80.80.1', 8080))
+        s, _ = self.listener.accept()
+        return c, s
+
+    def assertIdle(self, sock):
+        self.assertFalse(hasattr(sock, '__dict__'))
+        for name in ('seg_q', 'conn_q', 'send_cond', 'dataready', 'hs_timer', 'hs_seg'):
+            self.assertIsNone(getattr(sock, name), name)
+        self.assertEqual(sock.unacked, ())
+        self.assertEqual(sock.chunks, ())
+
+    def test_01_lazy(self):
+        self.assertIsNotNone(self.listener.conn_q)
+        c, s = self.connect()
+        self.assertIdle(c)
+        self.assertIdle(s)
+        c.send(b'ping')
+        self.assertEqual(s.recv(), b'ping')
+        s.send(b'pong')
+        self.assertEqual(c.recv(), b'pong')
+        # the buffers go again once drained
+        self.assertIdle(c)
+        self.assertIdle(s)
+
+    def test_02_blocked_reader(self):
+        c, s = self.connect()
+        t = threading.Timer(0.05, c.send, (b'late',))
+        t.start()
+        self.assertEqual(s.recv(), b'late')
+        t.join()
+        self.assertIsNotNone(s.dataready)
+
+    def test_03_budget(self):
+        """A few KB per connection, so 100k fit in well under a GB"""
+        n = 500
+        conns = []
+        gc.collect()
+        tracemalloc.start()
+        try:
+            start = tracemalloc.get_traced_memory()[0]
+            for _ in range(n):
+                conns.append(self.connect())
+            gc.collect()
+            used = tracemalloc.get_traced_memory()[0] - start
+        finally:
+            tracemalloc.stop()
+        self.assertLess(used / n, 4096)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import sys
+import os.path
+sys.path.insert(0, os.path.dirname(os.path.abspath(sys.argv[0])))
+
+from timers import *
+
+import asyncio
+import queue
+import threading
+import time
+import unittest
+
+
+class A_SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.sched = Scheduler()
+        self.fired = []
+        self.done = threading.Event()
+
+    def record(self, name, last=False):
+        self.fired.append(name)
+        if last:
+            self.done.set()
+
+    def test_order(self):
+        self.sched.call_later(0.03, self.record, 'c', True)
+        self.sched.call_later(0.01, self.record, 'a')
+        self.sched.call_later(0.02, self.record, 'b')
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.fired, ['a', 'b', 'c'])
+
+    def test_cancel(self):
+        t = self.sched.call_later(0.01, self.record, 'cancelled')
+        self.sched.call_later(0.02, self.record, 'kept', True)
+        t.cancel()
+        # nothing the callback refers to is kept until the deadline
+        self.assertIsNone(t.callback)
+        self.assertEqual(t.args, ())
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.fired, ['kept'])
+        self.assertEqual(self.sched.pending(), 0)
+
+    def test_reschedule_from_callback(self):
+        def again(n):
+            self.fired.append(n)
+            if n < 5:
+                self.sched.call_later(0, again, n + 1)
+            else:
+                self.done.set()
+        self.sched.call_later(0, again, 0)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.fired, list(range(6)))
+
+    def test_one_thread(self):
+        before = set(threading.enumerate())
+        for i in range(1000):
+            self.sched.call_later(60, self.record, i)
+        self.assertEqual(len(set(threading.enumerate()) - before), 1)
+        self.assertEqual(self.sched.pending(), 1000)
+
+    def test_idle_exit(self):
+        self.sched.IDLE = 0.05
+        self.sched.call_later(0, self.record, 'a', True)
+        self.assertTrue(self.done.wait(5))
+        thread = self.sched.thread
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(self.sched.thread)
+        # the next timer starts a new worker
+        self.done.clear()
+        self.sched.call_later(0, self.record, 'b', True)
+        self.assertTrue(self.done.wait(5))
+        self.assertEqual(self.fired, ['a', 'b'])
+
+class B_VirtualSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.sched = Scheduler(self.clock)
+        self.fired = []
+
+    def test_step(self):
+        self.sched.call_at(5, self.fired.append, 'b')
+        self.sched.call_at(3, self.fired.append, 'a')
+        self.assertTrue(self.sched.step())
+        self.assertEqual((self.fired, self.clock()), (['a'], 3))
+        self.assertFalse(self.sched.step(until=4))
+        self.assertTrue(self.sched.step())
+        self.assertEqual((self.fired, self.clock()), (['a', 'b'], 5))
+        self.assertFalse(self.sched.step())
+
+    def test_no_thread(self):
+        before = set(threading.enumerate())
+        self.sched.call_later(60, self.fired.append, 'x')
+        self.assertFalse(set(threading.enumerate()) - before)
+        self.assertEqual(self.fired, [])
+
+    def test_wait_for(self):
+        def again(n):
+            self.fired.append(n)
+            self.sched.call_later(1, again, n + 1)
+        self.sched.call_later(1, again, 1)
+        start = time.monotonic()
+        self.assertTrue(self.sched.wait_for(lambda: len(self.fired) == 1000))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.clock(), 1000)
+
+    def test_wait_timeout(self):
+        self.sched.call_later(100, self.fired.append, 'late')
+        self.assertFalse(self.sched.wait_for(lambda: self.fired, timeout=10))
+        self.assertEqual(self.clock(), 10)
+        self.assertEqual(self.fired, [])
+
+    def test_wait_cond(self):
+        cond = threading.Condition()
+        self.sched.call_later(2, self.fired.append, 'x')
+        with cond:
+            self.assertTrue(self.sched.wait_for(lambda: self.fired, cond))
+        self.assertEqual(self.clock(), 2)
+
+    def test_get(self):
+        q = queue.Queue()
+        self.sched.call_later(1, q.put, 'x')
+        self.assertEqual(self.sched.get(q), 'x')
+        self.assertEqual(self.clock(), 1)
+        with self.assertRaises(queue.Empty):
+            self.sched.get(q, timeout=1)
+        self.assertEqual(self.clock(), 2)
+
+class C_LoopSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.sched = LoopScheduler(asyncio.get_running_loop())
+        self.fired = []
+
+    async def test_order(self):
+        before = set(threading.enumerate())
+        self.sched.call_later(0.02, self.fired.append, 'b')
+        self.sched.call_later(0.01, self.fired.append, 'a')
+        self.sched.call_later(0.01, self.fired.append, 'cancelled').cancel()
+        self.assertEqual(self.sched.pending(), 2)
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.fired, ['a', 'b'])
+        self.assertEqual(self.sched.pending(), 0)
+        self.assertFalse(set(threading.enumerate()) - before)
+
+    async def test_other_thread(self):
+        done = asyncio.Event()
+        t = threading.Thread(target=self.sched.call_later, args=(0, done.set))
+        t.start()
+        t.join()
+        await asyncio.wait_for(done.wait(), 5)
+
+if __name__ == '__main__':
+    unittest.main()
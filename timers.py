@@ -0,0 +1,282 @@
+import heapq
+import itertools
+import queue
+import sys
+import threading
+import time
+import traceback
+
+
+class Timer:
+    """Handle for a callback scheduled on a Scheduler"""
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """
+        Prevents the callback from running if it hasn't already
+
+        The callback and its arguments are dropped right away, so a
+        cancelled timer waiting for its deadline keeps nothing alive.
+        """
+        self.cancelled = True
+        self.callback = None
+        self.args = ()
+
+    def run(self):
+        """Runs the callback, unless the timer has been cancelled"""
+        # cancel() clears callback before args, so these two reads never
+        # pair a live callback with cleared arguments
+        args = self.args
+        callback = self.callback
+        if callback is not None:
+            callback(*args)
+
+
+class VirtualClock:
+    """
+    A clock for discrete-event simulation that only moves when told to
+
+    Call it for the current time, like time.monotonic.
+    """
+
+    def __init__(self, start=0.0):
+        self.time = start
+
+    def __call__(self):
+        return self.time
+
+    def advance(self, when):
+        """Moves the clock forward to when (never backwards)"""
+        if when > self.time:
+            self.time = when
+
+
+class Scheduler:
+    """
+    Runs timer callbacks for many connections on a single thread
+
+    Timers are kept in a heap ordered by deadline, and the worker thread
+    sleeps until the earliest one is due, so the number of threads and
+    wakeups does not grow with the number of timers.  Cancelled timers are
+    simply skipped when they reach the top of the heap.
+
+    Callbacks run on the scheduler thread without any scheduler lock held,
+    so they may schedule or cancel other timers.  They should not block.
+    The thread exits once it has had no timers for IDLE seconds, and the
+    next call_at starts a new one, so an unused scheduler holds no thread.
+
+    With a VirtualClock there is no worker thread.  Instead, threads that
+    block through wait_for or get run the timers themselves, one at a time
+    and in deadline order, with the clock jumping straight to each
+    deadline.  Time only passes while somebody waits, so a simulation
+    driven from one thread is deterministic and takes no real time for
+    delays and timeouts.
+    """
+    # Real seconds a virtual wait sleeps when there is no timer to run, to
+    # let other threads catch up
+    POLL = 0.001
+    # Seconds the worker thread waits without timers before it exits
+    IDLE = 1.0
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.virtual = isinstance(clock, VirtualClock)
+        self.heap = []
+        self.counter = itertools.count()  # tie-breaker for equal deadlines
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stepping = threading.Lock()  # one virtual step runs at a time
+
+    def now(self):
+        """Returns the current time on this scheduler's clock"""
+        return self.clock()
+
+    def call_at(self, when, callback, *args):
+        """Schedules callback(*args) to run at time when; returns a Timer"""
+        timer = Timer(when, callback, args)
+        with self.cond:
+            heapq.heappush(self.heap, (when, next(self.counter), timer))
+            if self.virtual:
+                pass
+            elif self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            elif self.heap[0][2] is timer:
+                # new earliest deadline; wake the worker to resleep
+                self.cond.notify()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        """Schedules callback(*args) to run delay seconds from now"""
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def pending(self):
+        """Returns the number of timers that have not run or been cancelled"""
+        with self.cond:
+            return sum(not t.cancelled for _, _, t in self.heap)
+
+    def run(self):
+        while True:
+            with self.cond:
+                timer = self.next_due()
+                if timer is None:
+                    self.thread = None
+                    return
+            try:
+                timer.run()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            # don't keep the callback's object alive while we sleep
+            timer = None
+
+    def next_due(self):
+        """
+        Waits for and pops the next live timer (call with cond held), or
+        returns None after IDLE seconds with none
+        """
+        while True:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+            if not self.heap:
+                if not self.cond.wait_for(lambda: self.heap, self.IDLE):
+                    return None
+                continue
+            delay = self.heap[0][0] - self.clock()
+            if delay > 0:
+                self.cond.wait(delay)
+                continue
+            return heapq.heappop(self.heap)[2]
+
+    def step(self, until=None):
+        """
+        Runs the earliest live timer on the calling thread, if it is due by
+        until, first moving a virtual clock forward to its deadline
+
+        Returns whether a timer ran.
+        """
+        with self.stepping:
+            with self.cond:
+                while self.heap and self.heap[0][2].cancelled:
+                    heapq.heappop(self.heap)
+                if not self.heap or (until is not None and self.heap[0][0] > until):
+                    return False
+                when, _, timer = heapq.heappop(self.heap)
+                if self.virtual:
+                    self.clock.advance(when)
+            try:
+                timer.run()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            return True
+
+    def wait_for(self, predicate, cond=None, timeout=None):
+        """
+        Waits until predicate() is true, or timeout seconds have passed, and
+        returns its last value, like threading.Condition.wait_for
+
+        cond, if given, is a Condition the caller holds and whose notify
+        announces changes to predicate; without one the wait polls.  Under a
+        virtual clock the waiting thread runs the timers itself, with cond
+        released, and timeout is in virtual seconds.
+        """
+        if not self.virtual and cond is not None:
+            return cond.wait_for(predicate, timeout)
+        deadline = None if timeout is None else self.clock() + timeout
+        while True:
+            result = predicate()
+            if result or (deadline is not None and self.clock() >= deadline):
+                return result
+            ran = False
+            if self.virtual:
+                if cond is not None:
+                    cond.release()
+                try:
+                    ran = self.step(deadline)
+                finally:
+                    if cond is not None:
+                        cond.acquire()
+            if ran:
+                continue
+            if cond is not None:
+                cond.wait(self.POLL)
+            else:
+                time.sleep(self.POLL)
+            # nothing else happens before the deadline, so skip to it
+            if self.virtual and deadline is not None and not self.due(deadline):
+                self.clock.advance(deadline)
+
+    def due(self, until):
+        """Returns whether a live timer is due by until"""
+        with self.cond:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+            return bool(self.heap) and self.heap[0][0] <= until
+
+    def get(self, q, timeout=None):
+        """
+        Takes an item from the queue.Queue q like q.get(timeout=timeout),
+        running timers while it waits under a virtual clock
+        """
+        if not self.virtual:
+            return q.get(timeout=timeout)
+        item = []
+        def ready():
+            try:
+                item.append(q.get_nowait())
+            except queue.Empty:
+                return False
+            return True
+        if not self.wait_for(ready, timeout=timeout):
+            raise queue.Empty
+        return item[0]
+
+
+class LoopScheduler(Scheduler):
+    """
+    A Scheduler whose timers run as callbacks on an asyncio event loop
+
+    There is no worker thread: call_at hands each timer to the loop, on its
+    own clock, so timers run on the loop's thread between its other
+    callbacks.  Timers may be scheduled from any thread, but the scheduler
+    must be created on the loop's thread.  Its blocking waits must not be
+    used from the loop's thread, since nothing would run the timers.
+    """
+
+    def __init__(self, loop):
+        super().__init__(loop.time)
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.armed = set()  # timers handed to the loop that haven't run
+
+    def on_loop(self):
+        """Returns whether the calling thread is the loop's"""
+        return threading.get_ident() == self.loop_thread
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, callback, args)
+        with self.cond:
+            self.armed.add(timer)
+        if self.on_loop():
+            self.loop.call_at(when, self.fire, timer)
+        else:
+            self.loop.call_soon_threadsafe(self.loop.call_at, when, self.fire, timer)
+        return timer
+
+    def pending(self):
+        with self.cond:
+            return sum(not t.cancelled for t in self.armed)
+
+    def fire(self, timer):
+        with self.cond:
+            self.armed.discard(timer)
+        try:
+            timer.run()
+        except Exception:
+            traceback.print_exc(file=sys.stderr)